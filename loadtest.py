@@ -0,0 +1,777 @@
+"""Нагрузочные прогоны telebot3.py без настоящего Telegram.
+
+Записать реальный трафик (обезличенный):
+    RECORD_UPDATES_PATH=updates.jsonl python telebot3.py
+
+Сгенерировать синтетическую запись «пятничного вечера»:
+    python loadtest.py synth updates.jsonl --users 300 --minutes 30
+
+Воспроизвести запись на копии базы с ускорением:
+    python loadtest.py replay updates.jsonl --db walk_private.db --speed 10
+
+Сравнить HTTP-транспорты на рассылке с заданной конкурентностью:
+    python loadtest.py transport --calls 3000 --concurrency 16 --fanout 200 --connect-delay 0.1
+
+Задержка доставки по классам, когда рядом идёт большая рассылка (очередь по срочности против FIFO):
+    python loadtest.py delivery --users 1000 --rate 100
+
+Сравнить пропускную способность при разном числе процессов-шардов:
+    python loadtest.py shards updates.jsonl --shards 1,2,4
+
+Задержка тихого города, пока соседний по общему пулу (tenants.py) завален обновлениями:
+    python loadtest.py tenants --flood 1000 --workers 8 --max-share 0.5
+
+Прогнать неделю работы фонового потока в виртуальном времени:
+    python loadtest.py simulate --proposals 100000 --users 5000 --days 7
+
+То же с двумя экземплярами и падением ведущего каждые 6 виртуальных часов:
+    python loadtest.py simulate --days 1 --instances 2 --failover-every 6
+
+Воспроизведение идёт через те же обработчики telebot3 (команды, кнопки,
+цепочки register_next_step_handler), а ответы принимает stub_api.py.
+С --ingest обновления проходят через очереди UpdateDispatcher, а рассылки —
+через очередь доставки, как в боевом запуске, и задержка печатается отдельно
+по приоритетам.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import socket
+import subprocess
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import stub_api
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def load_bot_module(db_path, api_url):
+    """Импортирует telebot3 против заглушки API и копии базы."""
+    os.environ.setdefault('BOT_TOKEN', '0:loadtest')
+    os.environ['TELEGRAM_API_URL'] = api_url
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import telebot3
+    telebot3.apihelper.API_URL = api_url
+    telebot3.DB_PATH = db_path
+    telebot3.setup_logging(open(os.path.join(os.path.dirname(db_path), 'bot.log'), 'w', encoding='utf-8'))
+    telebot3.prepare_storage()
+    telebot3.bot.threaded = False
+    return telebot3
+
+
+def copy_database(source, target):
+    if source and os.path.exists(source):
+        with sqlite3.connect(source) as src, sqlite3.connect(target) as dst:
+            src.backup(dst)
+
+
+def read_records(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def replay(args):
+    server, api_url = stub_api.start_stub(latency=args.api_latency, jitter=args.api_latency / 2)
+    workdir = tempfile.mkdtemp(prefix='walk_replay_')
+    db_path = os.path.join(workdir, 'walk_private.db')
+    copy_database(args.db, db_path)
+    bot_module = load_bot_module(db_path, api_url)
+    bot_module.db_metrics.reset()
+    Update = bot_module.types.Update
+
+    latencies, service_times, errors = [], [], []
+    by_priority = {}
+    scheduled = {}
+    lock = threading.Lock()
+
+    def process(updates):
+        update = updates[0]
+        scheduled_at, priority = scheduled.pop(update.update_id)
+        started = time.perf_counter()
+        try:
+            bot_module.bot.process_new_updates(updates)
+        except Exception as e:
+            with lock:
+                errors.append(repr(e))
+        finished = time.perf_counter()
+        with lock:
+            latencies.append(finished - scheduled_at)
+            service_times.append(finished - started)
+            by_priority.setdefault(priority, []).append(finished - scheduled_at)
+
+    dispatcher = None
+    if args.ingest:
+        dispatcher = bot_module.UpdateDispatcher(process, workers=args.workers)
+        dispatcher.start()
+        bot_module.delivery_scheduler.start()
+    mode = "очереди UpdateDispatcher" if dispatcher else "пул потоков"
+    print(f"▶️ Воспроизведение {args.recording} ×{args.speed}, потоков: {args.workers}, {mode}")
+    count = 0
+    first_ts = None
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for record in read_records(args.recording):
+            if first_ts is None:
+                first_ts = record['ts']
+            scheduled_at = wall_start + (record['ts'] - first_ts) / args.speed
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            update = Update.de_json(record['update'])
+            scheduled[update.update_id] = (scheduled_at, bot_module.classify_update(update)[0])
+            if dispatcher:
+                dispatcher.submit([update])
+            else:
+                pool.submit(process, [update])
+            count += 1
+    if dispatcher:
+        while True:
+            snapshot = dispatcher.snapshot()
+            if sum(snapshot['processed']) + sum(snapshot['shed']) >= count:
+                break
+            time.sleep(0.05)
+    elapsed = time.perf_counter() - wall_start
+
+    latencies.sort()
+    service_times.sort()
+    db = bot_module.db_metrics.snapshot()
+    with server.state.lock:
+        api_calls = sum(v for k, v in server.state.counters.items() if k.startswith('calls.'))
+    print(f"📊 Обновлений: {count} за {elapsed:.2f} с → {count / elapsed if elapsed else 0:.1f} upd/s")
+    print("   Задержка от прихода до конца обработки, мс: " + ", ".join(
+        f"p{p}={percentile(latencies, p) * 1000:.1f}" for p in (50, 90, 99)
+    ) + f", max={latencies[-1] * 1000 if latencies else 0:.1f}")
+    print("   Время обработчика, мс: " + ", ".join(
+        f"p{p}={percentile(service_times, p) * 1000:.1f}" for p in (50, 90, 99)
+    ))
+    for priority, values in sorted(by_priority.items()):
+        values.sort()
+        print(f"   {bot_module.PRIORITY_NAMES[priority]}: {len(values)} шт., задержка мс: " + ", ".join(
+            f"p{p}={percentile(values, p) * 1000:.1f}" for p in (50, 99)
+        ))
+    if dispatcher:
+        print(f"   Очереди: {dispatcher.snapshot()}")
+        print(f"   Доставка: {bot_module.delivery_scheduler.snapshot()}")
+    print(f"   БД: транзакций {db['transactions']}, суммарно {db['total_time']:.2f} с, "
+          f"самая долгая {db['max_time'] * 1000:.1f} мс, ошибок блокировки {db['locked_errors']}")
+    print(f"   Кэш предложений: {bot_module.proposal_cache.snapshot()}")
+    print(f"   Вызовов API: {api_calls}, ограничитель: {bot_module.api_guard.snapshot()}")
+    if errors:
+        print(f"   ⚠️ Ошибок обработки: {len(errors)}, первая: {errors[0]}")
+    server.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def transport_bench(args):
+    """Рассылка sendMessage через разные транспорты: скорость, задержки, новые соединения."""
+    server, api_url = stub_api.start_stub(
+        latency=args.api_latency, jitter=args.api_latency / 2, connect_delay=args.connect_delay
+    )
+    workdir = tempfile.mkdtemp(prefix='walk_transport_')
+    bot_module = load_bot_module(os.path.join(workdir, 'walk_private.db'), api_url)
+    apihelper = bot_module.apihelper
+    url = api_url.format(os.environ['BOT_TOKEN'], 'sendMessage')
+
+    variants = [
+        ('apihelper: сессия на поток', lambda m, u, **kw: apihelper._get_req_session().request(m, u, **kw)),
+        ('общий Session, пул по умолчанию (10)', __import__('requests').Session().request),
+        (f'RequestsTransport, пул {bot_module.API_POOL_SIZE}', bot_module.RequestsTransport().request),
+    ]
+    try:
+        variants.append(('httpx (HTTP/1.1 к заглушке без TLS)', bot_module.HttpxTransport().request))
+    except ImportError:
+        print("ℹ️ httpx[http2] не установлен — вариант httpx пропущен")
+
+    print(f"▶️ {args.calls} вызовов sendMessage рассылками по {args.fanout}, потоков: {args.concurrency}, "
+          f"задержка API {args.api_latency * 1000:.0f} мс, новое соединение +{args.connect_delay * 1000:.0f} мс")
+    for name, send in variants:
+        with server.state.lock:
+            connections_before = server.state.counters.get('connections', 0)
+        latencies = []
+        lock = threading.Lock()
+
+        def call(i):
+            started = time.perf_counter()
+            response = send('post', url, params={'chat_id': 1000 + i % 500, 'text': 'bench'}, files=None,
+                            timeout=(3.05, 15), proxies=None)
+            response.json()
+            with lock:
+                latencies.append(time.perf_counter() - started)
+
+        # Каждая рассылка — в новых потоках, как рассылки из фоновых потоков бота:
+        # сессии «на поток» apihelper умирают вместе с потоком
+        wall_start = time.perf_counter()
+        for start in range(0, args.calls, args.fanout):
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                list(pool.map(call, range(start, min(start + args.fanout, args.calls))))
+        elapsed = time.perf_counter() - wall_start
+        with server.state.lock:
+            connections = server.state.counters.get('connections', 0) - connections_before
+        latencies.sort()
+        print(f"   {name}: {args.calls / elapsed:.0f} выз/с, мс: " + ", ".join(
+            f"p{p}={percentile(latencies, p) * 1000:.1f}" for p in (50, 99)
+        ) + f", новых соединений: {connections}")
+    server.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def delivery_bench(args):
+    """Рассылка карточки далёкой прогулки на всех и срочные сообщения посреди неё.
+
+    Через секунду после начала рассылки приходят напоминания, подтверждения и
+    карточка прогулки через полчаса. Тот же сценарий повторяется с очередью,
+    где у всех классов одинаковый срок, то есть с обычным FIFO.
+    """
+    server, api_url = stub_api.start_stub(latency=args.api_latency, jitter=args.api_latency / 2)
+    workdir = tempfile.mkdtemp(prefix='walk_delivery_')
+    bot_module = load_bot_module(os.path.join(workdir, 'walk_private.db'), api_url)
+    for i in range(args.users):
+        bot_module.add_user(10_000 + i, f'u{i}', None)
+    bot_module.subscription_index.rebuild()
+    bot_module.DELIVERY_LATENCY_SAMPLES = args.users * 4
+    slack, window = bot_module.DELIVERY_SLACK, bot_module.DELIVERY_URGENT_WINDOW
+    print(f"▶️ Рассылка на {args.users} человек, бюджет {args.rate} сообщ./с, задержка API {args.api_latency * 1000:.0f} мс")
+
+    for name, fifo in (('по срочности', False), ('FIFO', True)):
+        if fifo:
+            bot_module.DELIVERY_SLACK, bot_module.DELIVERY_URGENT_WINDOW = (0, 0, 0, 0), float('inf')
+        else:
+            bot_module.DELIVERY_SLACK, bot_module.DELIVERY_URGENT_WINDOW = slack, window
+        scheduler = bot_module.DeliveryScheduler(workers=args.workers, rate=args.rate)
+        bot_module.delivery_scheduler = scheduler
+        scheduler.start()
+        now = bot_module.clock.now()
+        far = bot_module.add_proposal(1, 'Автор', '12:00', now + timedelta(days=3))
+        started = time.perf_counter()
+        bot_module.update_all_messages_with_details(far)
+        time.sleep(1)
+        soon = bot_module.add_proposal(2, 'Автор', 'скоро', now + timedelta(minutes=30))
+        bot_module.update_all_messages_with_details(soon)
+        bot_module.delivery_scheduler.fanout(
+            bot_module.new_broadcast_stats('confirmation', soon, 'sendMessage'),
+            [bot_module.DeliveryJob(bot_module.DELIVERY_CONFIRMATION, 10_000 + i, soon, text='✅',
+                                    walk_dt=now + timedelta(minutes=30)) for i in range(args.urgent)]
+        )
+        reminders = [threading.Thread(target=scheduler.call, args=(
+            bot_module.DELIVERY_REMINDER, lambda uid=10_000 + i: bot_module.bot.send_message(uid, '⏰')
+        )) for i in range(args.urgent)]
+        for thread in reminders:
+            thread.start()
+        for thread in reminders:
+            thread.join()
+        while scheduler.snapshot()['queued'] or bot_module.broadcast_counters['pending']:
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        snapshot = scheduler.snapshot()
+        print(f"   {name}: {snapshot['done']} отправок за {elapsed:.1f} с; p50/p95, мс: " + " · ".join(
+            f"{cls} {p50}/{p95}" for cls, p50, p95 in zip(bot_module.DELIVERY_NAMES, snapshot['p50_ms'], snapshot['p95_ms'])
+        ))
+    server.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def start_stub_process(latency):
+    """Заглушка API в отдельном процессе, чтобы она не делила GIL с замеряемым кодом."""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    stub = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub_api.py'),
+         '--port', str(port), '--latency', str(latency), '--jitter', str(latency / 2)],
+        stdout=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return stub, f'http://127.0.0.1:{port}/bot{{0}}/{{1}}'
+
+
+def shard_bench(args):
+    """Пропускная способность обработчиков в зависимости от числа процессов-шардов.
+
+    Запись подаётся пачками по 100, как отдаёт getUpdates, но не быстрее, чем
+    шарды успевают разбирать; замеряется время до конца обработки последнего
+    обновления.
+    """
+    stub, api_url = start_stub_process(args.api_latency)
+    records = list(read_records(args.recording))
+    print(f"▶️ {len(records)} обновлений из {args.recording}, задержка API {args.api_latency * 1000:.0f} мс, "
+          f"ядер: {os.cpu_count()}")
+    baseline = None
+    try:
+        for shards in args.shards:
+            workdir = tempfile.mkdtemp(prefix='walk_shards_')
+            db_path = os.path.join(workdir, 'walk_private.db')
+            copy_database(args.db, db_path)
+            bot_module = load_bot_module(db_path, api_url)
+            updates = [bot_module.types.Update.de_json(record['update']) for record in records]
+            router = bot_module.ShardRouter(shards, db_path, log_dir=workdir)
+            router.start()
+            cpu_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            wall_start = time.perf_counter()
+            for i in range(0, len(updates), 100):
+                # Очередь шарда держим в пределах лимитов UpdateDispatcher: мерим обработку, а не отбрасывание
+                while max(router.backlog()) > 200:
+                    time.sleep(0.005)
+                router.submit(updates[i:i + 100])
+            while sum(router.backlog()):
+                time.sleep(0.01)
+            elapsed = time.perf_counter() - wall_start
+            router.stop()
+            cpu_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu = (cpu_after.ru_utime - cpu_before.ru_utime) + (cpu_after.ru_stime - cpu_before.ru_stime)
+            rate = len(updates) / elapsed
+            baseline = baseline or rate
+            print(f"   шардов {shards}: {rate:.0f} upd/s (×{rate / baseline:.2f}), {elapsed:.2f} с, "
+                  f"CPU шардов {cpu:.1f} с, по шардам {router.routed}")
+            shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        stub.terminate()
+
+
+def tenants_bench(args):
+    """Два города в общем пуле tenants.py: один завален обновлениями, другой получает редкие.
+
+    Замеряется задержка обновлений тихого города без ограничения доли пула
+    (max_share 1.0) и с ограничением.
+    """
+    import tenants
+    stub, api_url = start_stub_process(args.api_latency)
+    os.environ['TELEGRAM_API_URL'] = api_url
+    print(f"▶️ {args.flood} обновлений шумного города, тихий — раз в {args.interval * 1000:.0f} мс; "
+          f"пул {args.workers} потоков, задержка API {args.api_latency * 1000:.0f} мс")
+
+    for max_share in (1.0, args.max_share):
+        workdir = tempfile.mkdtemp(prefix='walk_tenants_')
+        config = {'workers': args.workers, 'max_share': max_share, 'tenants': [
+            {'name': name, 'token': f'{i}:{name}', 'db': os.path.join(workdir, f'{name}.db')}
+            for i, name in enumerate(('busy', 'quiet'), 1)
+        ]}
+        runtime, pool, _ = tenants.build_runtime(config, open(os.path.join(workdir, 'bot.log'), 'w', encoding='utf-8'))
+        busy, quiet = runtime
+        busy.module.apihelper.API_URL = api_url
+        Update = busy.module.types.Update
+        submitted, latencies = {}, []
+        process = quiet.module.update_dispatcher._process
+
+        def timed(updates, process=process):
+            try:
+                process(updates)
+            finally:
+                latencies.append(time.perf_counter() - submitted.pop(updates[0].update_id))
+
+        quiet.module.update_dispatcher._process = timed
+        pool.start()
+
+        def update(update_id, uid):
+            return Update.de_json({'update_id': update_id, 'message': {
+                'message_id': update_id, 'date': int(time.time()), 'text': '/start',
+                'chat': {'id': uid, 'type': 'private', 'first_name': f"u{uid}"},
+                'from': {'id': uid, 'is_bot': False, 'first_name': f"u{uid}"},
+            }})
+
+        started = time.perf_counter()
+        flooded = sent = 0
+        dispatcher = busy.module.update_dispatcher
+        while flooded < args.flood or sum(dispatcher.snapshot()['depth']):
+            # Очередь шумного города держим в пределах лимитов UpdateDispatcher: мерим пул, а не отбрасывание
+            if flooded < args.flood and sum(dispatcher.snapshot()['depth']) < 200:
+                dispatcher.submit([update(flooded + j, 10_000 + (flooded + j) % 400) for j in range(50)])
+                flooded += 50
+            submitted[sent] = time.perf_counter()
+            quiet.module.update_dispatcher.submit([update(sent, 20_000 + sent % 50)])
+            sent += 1
+            time.sleep(args.interval)
+
+        def finished(tenant, count):
+            snapshot = tenant.module.update_dispatcher.snapshot()
+            return sum(snapshot['processed']) + sum(snapshot['shed']) >= count
+
+        while not (finished(busy, flooded) and finished(quiet, sent)):
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        stats = busy.stats()
+        print(f"   max_share {max_share}: шумный {flooded} за {elapsed:.1f} с, отброшено {stats['ingest_shed']}; "
+              f"тихий {len(latencies)} обновлений, задержка мс: " + ", ".join(
+                  f"p{p}={percentile(latencies, p) * 1000:.0f}" for p in (50, 95, 99)
+              ))
+        shutil.rmtree(workdir, ignore_errors=True)
+    stub.terminate()
+
+
+def generate_week(args, start, end):
+    """Предложения с голосами: (created_at, строка proposals, голоса), по времени создания.
+
+    Часть предложений создана до начала симуляции (их прогулки ещё впереди или
+    уже прошли и ждут очистки), остальные появляются по ходу недели.
+    """
+    rng = random.Random(args.seed)
+    users = [10_000 + i for i in range(args.users)]
+    span = (end - timedelta(hours=3) - (start - timedelta(days=2))).total_seconds()
+    proposals = []
+    for _ in range(args.proposals):
+        created = start - timedelta(days=2) + timedelta(seconds=rng.uniform(0, span))
+        walk = created + timedelta(minutes=5 * rng.randint(12, 12 * 72))
+        walk = walk.replace(minute=walk.minute - walk.minute % 5, second=0, microsecond=0)
+        proposer = rng.choice(users)
+        voters = rng.sample(users, rng.randint(1, 5)) if rng.random() < args.vote_share else []
+        proposals.append((created, proposer, walk, voters))
+    proposals.sort(key=lambda p: p[0])
+    reminders = {user_id: rng.choice((5, 10, 15, 30, 60, 120)) for user_id in users if rng.random() < 0.5}
+    return users, reminders, proposals
+
+
+def insert_proposals(conn, batch, next_id, visible_from):
+    """Вставляет предложения пачкой, минуя рассылку.
+
+    Возвращает {id: (proposer_id, walk, visible_from, голосов)}: visible_from — начало
+    окна напоминаний, в котором планировщик впервые видит предложение.
+    """
+    rows, votes, inserted = [], [], {}
+    for created, proposer, walk, voters in batch:
+        rows.append((next_id, proposer, f"u{proposer}", walk.strftime('%H:%M'), walk.strftime('%Y-%m-%d %H:%M:%S'),
+                     'Парк', '', created.strftime('%Y-%m-%d %H:%M:%S')))
+        votes.extend((next_id, voter, f"u{voter}", 'yes') for voter in voters)
+        inserted[next_id] = (proposer, walk, visible_from, len(voters))
+        next_id += 1
+    conn.executemany(
+        "INSERT INTO proposals (id, proposer_id, proposer_name, time_str, walk_datetime, location, comment, timestamp) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows
+    )
+    conn.executemany("INSERT INTO votes (proposal_id, voter_id, voter_name, vote_type) VALUES (?, ?, ?, ?)", votes)
+    conn.commit()
+    return inserted
+
+
+def simulate(args):
+    """Неделя работы background_worker в виртуальном времени.
+
+    Такт повторяет цикл background_worker: проход планировщика, очистка,
+    метрики и пауза REMINDER_CHECK_INTERVAL. Виртуальные часы сдвигаются ровно
+    на паузу, без реальной длительности такта, так что прогон с теми же
+    --seed и --start воспроизводим. В конце
+    проверяется, что каждое положенное напоминание ушло ровно один раз и вовремя.
+
+    С --instances N экземпляры делят аренду LeaderLease и продлевают её в начале
+    такта. С --failover-every ведущий периодически «падает» без отдачи аренды,
+    а в следующем такте, уже после перехвата, делает ещё один проход со своим
+    старым окном параллельно новому ведущему — так проверяется, что пересечение
+    не даёт повторов.
+    """
+    server, api_url = stub_api.start_stub()
+    server.state.keep_sent = True
+    workdir = tempfile.mkdtemp(prefix='walk_simulate_')
+    db_path = os.path.join(workdir, 'walk_private.db')
+    bot_module = load_bot_module(db_path, api_url)
+    start = datetime.strptime(args.start, '%Y-%m-%d %H:%M') if args.start else datetime.now().replace(second=0, microsecond=0)
+    end = start + timedelta(days=args.days)
+    clock = bot_module.VirtualClock(start)
+    bot_module.clock = clock
+    server.state.clock = lambda: clock.now().timestamp()
+
+    users, reminders, proposals = generate_week(args, start, end)
+    conn = sqlite3.connect(db_path)
+    conn.executemany("INSERT INTO users (user_id, first_name) VALUES (?, ?)", [(u, f"u{u}") for u in users])
+    conn.executemany("INSERT INTO user_settings (user_id, reminder_minutes) VALUES (?, ?)", reminders.items())
+    seeded = sum(1 for created, *_ in proposals if created <= start)
+    known = insert_proposals(conn, proposals[:seeded], 1, start)
+    # До начала бот уже работал: по прошедшим прогулкам напоминания и вопросы ушли
+    conn.execute("UPDATE proposals SET processed = 1 WHERE walk_datetime <= ?",
+                 ((start - timedelta(hours=2)).strftime('%Y-%m-%d %H:%M:%S'),))
+    conn.commit()
+    bot_module.prepare_storage()
+    print(f"▶️ {args.days} сут. виртуального времени с {start:%Y-%m-%d %H:%M}: пользователей {len(users)}, "
+          f"предложений {len(proposals)} (до начала {seeded}), такт {bot_module.REMINDER_CHECK_INTERVAL} с")
+
+    phases = {name: {'cpu': 0.0, 'db': 0.0, 'wall': 0.0} for name in ('планировщик', 'сводки', 'архив', 'очистка', 'метрики')}
+
+    def timed(name, func, *func_args):
+        cpu, db, wall = time.thread_time(), bot_module.db_metrics.total_time, time.perf_counter()
+        result = func(*func_args)
+        phase = phases[name]
+        phase['cpu'] += time.thread_time() - cpu
+        phase['db'] += bot_module.db_metrics.total_time - db
+        phase['wall'] += time.perf_counter() - wall
+        return result
+
+    def collect_metrics(now, started):
+        with bot_module.db_connect() as metrics_conn:
+            bot_module.collect_worker_metrics(metrics_conn.cursor(), now, started)
+
+    leases = [bot_module.LeaderLease('scheduler', f"sim-{i}") for i in range(args.instances)]
+    leader, zombie, crashed_at, failovers, restarts = None, None, None, [], 0
+    next_crash = start + timedelta(hours=args.failover_every) if args.failover_every else end
+
+    ticks, since, slowest, cursor = 0, None, 0.0, seeded
+    wall_start = time.perf_counter()
+    while clock.now() < end:
+        now = clock.now()
+        arrived = 0
+        while cursor + arrived < len(proposals) and proposals[cursor + arrived][0] <= now:
+            arrived += 1
+        if arrived:
+            known.update(insert_proposals(conn, proposals[cursor:cursor + arrived], cursor + 1, max(now, since or now)))
+            cursor += arrived
+        started = time.perf_counter()
+        # Ведущий продлевает аренду первым, как и в жизни: его сердцебиение идёт чаще такта
+        for lease in sorted(leases, key=lambda lease: lease is not leader):
+            lease.heartbeat()
+        current = next((lease for lease in leases if lease.is_leader()), None)
+        if current is not leader and current is not None:
+            if crashed_at:
+                failovers.append((now - crashed_at).total_seconds())
+                crashed_at = None
+            leader, since = current, current.watermark
+        if leader:
+            # Упавший ведущий ещё доделывает проход со старым окном одновременно с новым
+            # (задержка API растягивает проходы, чтобы они гарантированно перекрылись)
+            if zombie:
+                server.state.latency = 0.05
+            stale = zombie and ThreadPoolExecutor(1).submit(bot_module.run_scheduled_jobs, now, zombie)
+            since = timed('планировщик', bot_module.run_scheduled_jobs, now, since)
+            leader.save_watermark(since)
+            if stale:
+                stale.result()
+                zombie, server.state.latency = None, 0.0
+        if leader:
+            timed('сводки', bot_module.flush_digests, now)
+            timed('архив', bot_module.archive_completed_walks, now)
+            timed('очистка', bot_module.auto_delete_old_proposals_by_walk_time)
+            timed('очистка', bot_module.cleanup_old_proposals)
+            timed('метрики', collect_metrics, now, started)
+        if leader and len(leases) > 1 and now >= next_crash:
+            restarts += 1
+            zombie, crashed_at = since, now
+            leases[leases.index(leader)] = bot_module.LeaderLease('scheduler', f"sim-restart-{restarts}")
+            leader = None
+            next_crash += timedelta(hours=args.failover_every)
+        elapsed = time.perf_counter() - started
+        slowest = max(slowest, elapsed)
+        clock.advance(bot_module.REMINDER_CHECK_INTERVAL)
+        ticks += 1
+        if args.progress and ticks % 2880 == 0:
+            print(f"   … {clock.now():%Y-%m-%d %H:%M}, тактов {ticks}, {time.perf_counter() - wall_start:.0f} с")
+    wall = time.perf_counter() - wall_start
+    conn.close()
+
+    # Положенные напоминания: есть «иду», момент напоминания после появления и не позже окна
+    # последнего такта (run_scheduled_jobs смотрит на REMINDER_CHECK_INTERVAL + 1 с вперёд)
+    horizon = clock.now() + timedelta(seconds=1)
+    expected = {}
+    for pid, (proposer, walk, visible_from, going) in known.items():
+        remind_at = walk - timedelta(minutes=reminders.get(proposer, 10))
+        if going and visible_from <= remind_at < horizon:
+            expected[pid] = remind_at
+    sent = {}
+    with server.state.lock:
+        for ts, method, chat_id, text, markup in server.state.sent:
+            match = re.search(r'confirm_going_(\d+)', markup or '')
+            if method == 'sendMessage' and match:
+                sent.setdefault(int(match.group(1)), []).append(datetime.fromtimestamp(ts))
+    missed = [pid for pid in expected if pid not in sent]
+    duplicates = [pid for pid, times in sent.items() if len(times) > 1]
+    unexpected = [pid for pid in sent if pid not in expected]
+    offsets = sorted((sent[pid][0] - remind_at).total_seconds() for pid, remind_at in expected.items() if pid in sent)
+
+    print(f"📊 Тактов {ticks} за {wall:.1f} с ({wall / ticks * 1000 if ticks else 0:.1f} мс/такт, "
+          f"самый долгий {slowest * 1000:.0f} мс)")
+    for name, phase in phases.items():
+        print(f"   {name}: CPU {phase['cpu']:.2f} с, в транзакциях БД {phase['db']:.2f} с, всего {phase['wall']:.2f} с")
+    print(f"   Напоминаний: положено {len(expected)}, отправлено {sum(len(t) for t in sent.values())}, "
+          f"пропущено {len(missed)}, повторов {len(duplicates)}, лишних {len(unexpected)}")
+    if offsets:
+        print("   Отправка относительно момента напоминания, с: " + ", ".join(
+            f"p{p}={percentile(offsets, p):+.0f}" for p in (0, 50, 100)
+        ))
+    with bot_module.db_connect() as check_conn:
+        left = check_conn.execute("SELECT COUNT(*) FROM proposals").fetchone()[0]
+        archived = sum(check_conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+                       for name in sorted(bot_module.archive_partitions))
+    stats_started = time.perf_counter()
+    bot_module.render_stats()
+    print(f"   Предложений в базе после недели: {left}, в архиве {archived} "
+          f"({len(bot_module.archive_partitions)} мес.), /stats за {(time.perf_counter() - stats_started) * 1000:.1f} мс")
+    if failovers:
+        print(f"   Падений ведущего: {restarts}, перехватов {len(failovers)}, "
+              f"аренда переходила за {min(failovers):.0f}…{max(failovers):.0f} с виртуального времени "
+              f"(в боевом режиме не дольше {bot_module.LEADER_LEASE_TTL + bot_module.LEADER_HEARTBEAT} с)")
+    server.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    window = bot_module.REMINDER_CHECK_INTERVAL + 1
+    problems = []
+    if missed:
+        problems.append(f"пропущены напоминания, например #{missed[0]}")
+    if duplicates:
+        problems.append(f"повторные напоминания, например #{duplicates[0]}")
+    if unexpected:
+        problems.append(f"напоминания без повода, например #{unexpected[0]}")
+    if offsets and (offsets[0] < -window or offsets[-1] > slowest + 1):
+        problems.append(f"отправка вне окна: {offsets[0]:+.0f}…{offsets[-1]:+.0f} с")
+    if restarts and len(failovers) < restarts - (crashed_at is not None):
+        problems.append("аренда не перешла к резервному экземпляру")
+    if problems:
+        print("❌ " + "; ".join(problems))
+        sys.exit(1)
+    print("✅ Все напоминания ушли по одному разу и вовремя")
+
+
+def synth(args):
+    """Синтетическая запись: пользователи заходят, предлагают прогулки и голосуют.
+
+    Рассчитана на воспроизведение с пустой базой: голоса ссылаются на
+    предложения с id 1..N в порядке их создания.
+    """
+    rng = random.Random(args.seed)
+    start = time.time()
+    duration = args.minutes * 60
+    events = []
+    users = [10_000 + i for i in range(args.users)]
+
+    def person(uid):
+        return {'id': uid, 'is_bot': False, 'first_name': f"u{uid}"}
+
+    def message(uid, ts, text):
+        return {'message': {
+            'message_id': rng.randint(1, 10**9), 'date': int(ts), 'text': text,
+            'chat': {'id': uid, 'type': 'private', 'first_name': f"u{uid}"},
+            'from': person(uid),
+        }}
+
+    def callback(uid, ts, data):
+        return {'callback_query': {
+            'id': str(rng.randint(1, 10**12)), 'from': person(uid), 'chat_instance': 'synth', 'data': data,
+            'message': {
+                'message_id': rng.randint(1, 10**9), 'date': int(ts), 'text': 'card',
+                'chat': {'id': uid, 'type': 'private', 'first_name': f"u{uid}"},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'Stub'},
+            },
+        }}
+
+    for uid in users:
+        events.append((start + rng.uniform(0, duration * 0.1), message(uid, start, '/start')))
+
+    proposals = 0
+    for uid in rng.sample(users, min(args.proposals, len(users))):
+        ts = start + rng.uniform(duration * 0.1, duration * 0.6)
+        hour, minute = rng.randint(17, 22), rng.choice((0, 15, 30, 45))
+        for step, text in enumerate(("Прогулки", "Предложить время", f"{hour}:{minute:02d}",
+                                     rng.choice(("Парк", "Набережная", "Сквер у фонтана")), "-")):
+            events.append((ts + step * 3, message(uid, ts, text)))
+        proposals += 1
+
+    for _ in range(args.votes):
+        uid = rng.choice(users)
+        ts = start + rng.uniform(duration * 0.6, duration)
+        vote = rng.choice(('yes', 'yes', 'later', 'no'))
+        events.append((ts, callback(uid, ts, f"vote_{vote}_{rng.randint(1, max(proposals, 1))}")))
+        if vote in ('yes', 'later'):
+            events.append((ts + 2, message(uid, ts, rng.choice(("-", "С собакой", "Опоздаю на 10 минут")))))
+
+    for _ in range(args.menu):
+        uid = rng.choice(users)
+        ts = start + rng.uniform(duration * 0.1, duration)
+        events.append((ts, message(uid, ts, rng.choice(("Текущие прогулки", "/my_proposals", "Настройки", "Назад")))))
+
+    events.sort(key=lambda e: e[0])
+    with open(args.output, 'w', encoding='utf-8') as f:
+        for update_id, (ts, update) in enumerate(events, 1):
+            update['update_id'] = update_id
+            f.write(json.dumps({'ts': ts, 'update': update}, ensure_ascii=False) + "\n")
+    print(f"✅ Записано {len(events)} обновлений в {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('replay', help='воспроизвести запись обновлений')
+    p.add_argument('recording')
+    p.add_argument('--db', help='база, копия которой используется при воспроизведении')
+    p.add_argument('--speed', type=float, default=1.0, help='ускорение: 1, 10, 100…')
+    p.add_argument('--workers', type=int, default=2, help='потоков обработки (в TeleBot по умолчанию 2)')
+    p.add_argument('--api-latency', type=float, default=0.03, help='задержка ответов заглушки API, с')
+    p.add_argument('--ingest', action='store_true', help='пропускать обновления через очереди приоритетов')
+    p.set_defaults(func=replay)
+
+    p = sub.add_parser('delivery', help='задержка доставки по классам рядом с большой рассылкой')
+    p.add_argument('--users', type=int, default=1000)
+    p.add_argument('--urgent', type=int, default=20, help='напоминаний и подтверждений посреди рассылки')
+    p.add_argument('--rate', type=int, default=100, help='бюджет отправок в секунду (DELIVERY_RATE)')
+    p.add_argument('--workers', type=int, default=8)
+    p.add_argument('--api-latency', type=float, default=0.03)
+    p.set_defaults(func=delivery_bench)
+
+    p = sub.add_parser('shards', help='пропускная способность при разном числе процессов-шардов')
+    p.add_argument('recording')
+    p.add_argument('--db', help='база, копия которой используется в каждом прогоне')
+    p.add_argument('--shards', type=lambda v: [int(n) for n in v.split(',')], default=[1, 2, 4])
+    p.add_argument('--api-latency', type=float, default=0.03, help='задержка ответов заглушки API, с')
+    p.set_defaults(func=shard_bench)
+
+    p = sub.add_parser('tenants', help='изоляция городов в общем пуле потоков tenants.py')
+    p.add_argument('--flood', type=int, default=1000, help='обновлений шумного города')
+    p.add_argument('--interval', type=float, default=0.25, help='пауза между обновлениями тихого города, с')
+    p.add_argument('--workers', type=int, default=8)
+    p.add_argument('--max-share', type=float, default=0.5)
+    p.add_argument('--api-latency', type=float, default=0.3, help='задержка ответов заглушки API, с')
+    p.set_defaults(func=tenants_bench)
+
+    p = sub.add_parser('transport', help='сравнить HTTP-транспорты на заглушке API')
+    p.add_argument('--calls', type=int, default=3000)
+    p.add_argument('--concurrency', type=int, default=16, help='как API_MAX_CONCURRENCY')
+    p.add_argument('--fanout', type=int, default=200, help='вызовов в одной рассылке')
+    p.add_argument('--connect-delay', type=float, default=0.05, help='цена нового соединения (TLS), с')
+    p.add_argument('--api-latency', type=float, default=0.03)
+    p.set_defaults(func=transport_bench)
+
+    p = sub.add_parser('simulate', help='неделя планировщика и очистки в виртуальном времени')
+    p.add_argument('--proposals', type=int, default=100_000)
+    p.add_argument('--users', type=int, default=5000)
+    p.add_argument('--days', type=float, default=7)
+    p.add_argument('--vote-share', type=float, default=0.4, help='доля предложений, на которые кто-то идёт')
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--start', help='начало виртуального времени, ГГГГ-ММ-ДД ЧЧ:ММ (по умолчанию — сейчас)')
+    p.add_argument('--progress', action='store_true', help='печатать ход по виртуальным суткам')
+    p.add_argument('--instances', type=int, default=1, help='экземпляров, делящих аренду планировщика')
+    p.add_argument('--failover-every', type=float, default=0, help='ронять ведущего каждые N виртуальных часов')
+    p.set_defaults(func=simulate)
+
+    p = sub.add_parser('synth', help='сгенерировать синтетическую запись')
+    p.add_argument('output')
+    p.add_argument('--users', type=int, default=200)
+    p.add_argument('--proposals', type=int, default=20)
+    p.add_argument('--votes', type=int, default=600)
+    p.add_argument('--menu', type=int, default=300)
+    p.add_argument('--minutes', type=float, default=30)
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(func=synth)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
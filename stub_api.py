@@ -0,0 +1,176 @@
+"""Локальная заглушка Telegram Bot API для нагрузочных проверок.
+
+Отвечает на вызовы, которыми пользуется telebot3.py, и умеет подмешивать
+задержки и ошибки (5xx, 429, 403 «бот заблокирован»), чтобы проверять
+ограничитель ApiGuard без настоящего Telegram.
+
+Запуск:
+    python stub_api.py --port 8081 --latency 0.05 --error-rate 0.1
+    TELEGRAM_API_URL=http://127.0.0.1:8081/bot{0}/{1} BOT_TOKEN=1:stub python telebot3.py
+
+Счётчики вызовов: GET http://127.0.0.1:8081/stats
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+
+class StubState:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0,
+                 retry_after=1, blocked_users=(), connect_delay=0.0):
+        self.latency = latency
+        self.connect_delay = connect_delay  # имитация TCP+TLS рукопожатия на каждое новое соединение
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.blocked_users = {int(u) for u in blocked_users}
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.sent = []  # (время, метод, chat_id, текст, reply_markup) — для проверок в симуляциях
+        self.keep_sent = False
+        self.clock = time.time  # симуляция подставляет виртуальное время бота
+        self._message_ids = itertools.count(1)
+
+    def count(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def next_message_id(self):
+        with self.lock:
+            return next(self._message_ids)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'StubBotAPI/1.0'
+    # Заголовки и тело уходят разными write(): без TCP_NODELAY каждый ответ ждёт delayed ACK
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.state.count('connections')
+        if self.server.state.connect_delay:
+            time.sleep(self.server.state.connect_delay)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        state = self.server.state
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            with state.lock:
+                return self._reply(200, dict(state.counters))
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length).decode('utf-8', 'replace')
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                params.update(json.loads(body or '{}'))
+            else:
+                params.update(parse_qsl(body))
+        method = url.path.rsplit('/', 1)[-1]
+        state.count(f'calls.{method}')
+
+        if method == 'getUpdates':
+            time.sleep(min(float(params.get('timeout') or 0), 1.0))
+            return self._ok([])
+
+        delay = state.latency + random.uniform(0, state.jitter)
+        if delay:
+            time.sleep(delay)
+        roll = random.random()
+        if roll < state.throttle_rate:
+            state.count('injected.429')
+            return self._reply(429, {
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {state.retry_after}',
+                'parameters': {'retry_after': state.retry_after},
+            })
+        if roll < state.throttle_rate + state.error_rate:
+            state.count('injected.5xx')
+            return self._reply(502, {'ok': False, 'error_code': 502, 'description': 'Bad Gateway'})
+
+        chat_id = params.get('chat_id')
+        if chat_id is not None and int(chat_id) in state.blocked_users:
+            state.count('injected.403')
+            return self._reply(403, {
+                'ok': False, 'error_code': 403,
+                'description': 'Forbidden: bot was blocked by the user',
+            })
+        if state.keep_sent and method in ('sendMessage', 'editMessageText'):
+            with state.lock:
+                state.sent.append((state.clock(), method, chat_id, params.get('text', ''), params.get('reply_markup')))
+
+        if method == 'getMe':
+            return self._ok({'id': 1, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot'})
+        if method in ('sendMessage', 'editMessageText', 'sendLocation'):
+            message_id = int(params.get('message_id') or state.next_message_id())
+            return self._ok({
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(chat_id or 0), 'type': 'private'},
+                'text': params.get('text', ''),
+            })
+        return self._ok(True)
+
+    def _ok(self, result):
+        self._reply(200, {'ok': True, 'result': result})
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_stub(port=0, **options):
+    """Запускает заглушку в фоновом потоке. Возвращает (server, api_url)."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    server.state = StubState(**options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_url = f'http://127.0.0.1:{server.server_address[1]}/bot{{0}}/{{1}}'
+    return server, api_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='базовая задержка ответа, с')
+    parser.add_argument('--jitter', type=float, default=0.0, help='случайная добавка к задержке, с')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 502')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--connect-delay', type=float, default=0.0, help='задержка на новое соединение, с')
+    parser.add_argument('--blocked', default='', help='chat_id через запятую, отвечающие 403')
+    args = parser.parse_args()
+    server, api_url = start_stub(
+        args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate, retry_after=args.retry_after,
+        blocked_users=[u for u in args.blocked.split(',') if u], connect_delay=args.connect_delay,
+    )
+    print(f"✅ Заглушка Bot API: {api_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
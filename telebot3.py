@@ -2,7 +2,25 @@ import os
 import re
 import threading
 import time
-from datetime import datetime, date, timedelta
+import json
+import math
+import multiprocessing
+import hashlib
+import heapq
+import itertools
+import html
+import argparse
+import atexit
+import csv
+import gzip
+import logging
+import logging.handlers
+import queue
+import socket
+import sys
+from collections import OrderedDict, deque, namedtuple
+from datetime import datetime, timedelta
+import requests
 from telebot import TeleBot, types, apihelper
 import sqlite3
 from dotenv import load_dotenv
@@ -15,18 +33,529 @@ if not BOT_TOKEN:
 
 # 🔒 Список доверенных пользователей (оставьте пустым для публичного бота)
 ALLOWED_USER_IDS = set()
+# 🛠️ Администраторы: им доступна панель /admin
+ADMIN_USER_IDS = set()
 
 DB_PATH = 'walk_private.db'
 REMINDER_CHECK_INTERVAL = 30  # секунд
+REMINDER_MIN_MINUTES, REMINDER_MAX_MINUTES = 5, 120  # допустимое «за сколько минут напомнить»
+
+# Адрес Bot API (для локальной заглушки: http://127.0.0.1:8081/bot{0}/{1})
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL
+
+# Ограничитель вызовов API: AIMD-параллелизм и предохранитель
+API_MAX_CONCURRENCY = 16
+API_TARGET_LATENCY = 1.5  # секунд; медленнее — считаем перегрузкой
+API_FAILURE_THRESHOLD = 5  # ошибок подряд до размыкания цепи
+API_COOLDOWN = 5  # секунд до пробного запроса
+API_MAX_COOLDOWN = 60
+API_QUEUE_TIMEOUT = 10  # сколько важный вызов ждёт слота
+API_RECENT_WINDOW = 300  # секунд; окно «недавних» ошибок для /admin
+
+# Транспорт: один пул keep-alive соединений на все потоки
+API_POOL_SIZE = API_MAX_CONCURRENCY + 4  # слоты ограничителя, getUpdates и запас
+API_DEFAULT_TIMEOUT = (3.05, 25)  # (соединение, чтение), секунд
+API_TIMEOUTS = {
+    'answerCallbackQuery': (3.05, 5),  # Telegram всё равно перестаёт ждать ответа через несколько секунд
+    'answerInlineQuery': (3.05, 5),
+    'editMessageText': (3.05, 10),
+    'editMessageReplyMarkup': (3.05, 10),
+    'sendMessage': (3.05, 15),
+}
+API_HTTP2 = os.environ.get('API_HTTP2') == '1'  # httpx с HTTP/2 (pip install 'httpx[http2]')
+
+PROPOSAL_CACHE_SIZE = 512  # предложений в памяти
+
+# Повторяющиеся прогулки: шаблон превращается в предложение не раньше, чем за горизонт
+TEMPLATE_HORIZON = 24 * 3600  # секунд
+TEMPLATE_LIMIT = 5  # активных шаблонов у одного пользователя
+
+SEARCH_PAGE_SIZE = 5  # результатов поиска на странице
+SEARCH_MEMORY_SIZE = 1000  # пользователей, чей последний запрос помним для листания
+
+# Архив и статистика: прогулка считается завершённой через WALK_COMPLETE_AFTER после начала
+WALK_COMPLETE_AFTER = 2 * 3600  # секунд
+WALK_CONFIRMED_MIN = 3  # участников, с которых прогулка подтверждена
+STATS_DAYS = 30  # окно /stats
+STATS_TOP = 5  # авторов и часов в /stats
+
+# Карточки удалённых предложений переводятся в «завершено» понемногу, чтобы не занимать лимит API
+STALE_CARDS_BATCH = 50  # строк stale_cards за одну выборку
+
+# Сводки: карточки, правки и подтверждения копятся и приходят одним сообщением за день
+DIGEST_MIN_MINUTES, DIGEST_MAX_MINUTES = 15, 24 * 60  # допустимый интервал между сводками
+DIGEST_WALK_LEAD = 60 * 60  # секунд; сводку с прогулкой, до которой меньше часа, отправляем досрочно
+DIGEST_MAX_BUTTONS = 10  # кнопок «проголосовать» в сводке
+
+# Геометки: сетка по градусам для поиска «рядом со мной»
+GEO_CELL_SIZE = 0.01  # градусов; ~1.1 км по широте
+NEAR_RADIUS_KM = 3
+NEAR_RESULTS = 10
+NEAR_KM_PER_HOUR = 0.5  # при сортировке час ожидания «стоит» столько же, сколько 500 м пути
+
+# Резервные копии базы (онлайн, через sqlite3 backup API)
+BACKUP_DIR = 'backups'
+BACKUP_INTERVAL = 6 * 3600  # секунд
+BACKUP_KEEP = 7  # сколько снимков хранить
+BACKUP_PAGES_PER_STEP = 64  # страниц за шаг; между шагами база свободна для записи
+BACKUP_STEP_PAUSE = 0.02  # секунд между шагами
+
+# Выгрузка и загрузка данных (python telebot3.py export/import)
+TRANSFER_BATCH = 5000  # строк в одной выборке при выгрузке и в одной транзакции при загрузке
+
+# Несколько экземпляров на одной базе: фоновые задачи выполняет только держатель аренды
+INSTANCE_ID = os.environ.get('INSTANCE_ID') or f"{socket.gethostname()}:{os.getpid()}"
+LEADER_LEASE_TTL = 10  # секунд; столько аренда живёт без продления
+LEADER_HEARTBEAT = 3  # секунд между продлениями и попытками резерва перехватить аренду
+# Резерв с тем же токеном (LEASE_POLLING=1 на обоих): getUpdates опрашивает только держатель аренды,
+# иначе Telegram отвечает второму экземпляру 409 Conflict
+LEASE_POLLING = os.environ.get('LEASE_POLLING') == '1'
+
+# Шарды: при SHARDS > 1 обработчики работают в SHARDS процессах, обновления раздаются по user_id
+SHARDS = int(os.environ.get('SHARDS') or 1)
+SHARD_SYNC_INTERVAL = 1  # секунд; как часто простаивающий шард дочитывает чужие изменения
+SHARD_EVENTS_KEEP = 600  # секунд хранения событий шины шардов
+SHARD_MAX_RESTARTS = 3  # перезапусков упавшего шарда за минуту, после которых процесс останавливается
+SHARD_START_TIMEOUT = 60  # секунд на загрузку шарда; не успевший считается упавшим
+
+# Несколько городов в одном процессе (tenants.py): имя города попадает в каждую запись журнала
+TENANT = os.environ.get('TENANT')
+
+# Журнал: JSON-записи пишет фоновый поток, повторы одной ошибки прореживаются
+LOG_QUEUE_SIZE = 10000
+LOG_REPEAT_WINDOW = 60  # секунд
+LOG_REPEAT_LIMIT = 5  # одинаковых записей за окно, остальные только считаются
+
+# Приём обновлений: очереди по приоритетам между опросом и обработчиками
+INGEST_WORKERS = 4
+INGEST_QUEUE_LIMITS = (500, 500, 300, 50)  # ответы на кнопки, голоса, меню, тяжёлые отчёты
+INGEST_USER_LIMIT = 10  # необработанных обновлений одного пользователя
+INGEST_BUSY_NOTICE_INTERVAL = 30  # секунд между сообщениями «бот занят» одному пользователю
+INGEST_NOTICE_QUEUE = 200  # ожидающих отправки «бот занят»; сверх этого уведомления отбрасываются
+
+# Доставка: исходящие сообщения по срочности, несрочные растягиваются по бюджету отправок
+DELIVERY_WORKERS = 8
+DELIVERY_RATE = 25  # сообщений в секунду (общий лимит Telegram — около 30)
+DELIVERY_URGENT_RESERVE = 0.3  # доля секундного бюджета, которую несрочные не занимают
+DELIVERY_URGENT_WINDOW = 3600  # секунд до прогулки, с которых любая рассылка по ней срочная
+DELIVERY_SLACK = (0, 30, 300, 1800)  # секунд допустимой задержки: напоминание, подтверждение, карточка, правка
+DELIVERY_LATENCY_SAMPLES = 500  # последних отправок каждого класса для /admin
+
+# Запись входящих обновлений в JSONL для последующего воспроизведения (loadtest.py replay)
+RECORD_UPDATES_PATH = os.environ.get('RECORD_UPDATES_PATH')
 
 bot = TeleBot(BOT_TOKEN)
 
+# === ЧАСЫ ===
+
+class Clock:
+    """Текущее время для планировщика, очистки и разбора дат.
+
+    Вся логика, завязанная на «сейчас», спрашивает время у модуля clock, поэтому
+    симуляция (loadtest.py simulate) подменяет его на VirtualClock и прогоняет
+    неделю работы за минуты.
+    """
+
+    def now(self):
+        return datetime.now()
+
+    def today(self):
+        return self.now().date()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+class VirtualClock(Clock):
+    """Время, которое двигается только через advance().
+
+    sleep() ждёт, пока advance() отсчитает нужное, и само время не двигает:
+    иначе каждый фоновый поток, засыпая, сдвигал бы часы для всех остальных.
+    """
+
+    def __init__(self, start):
+        self._cond = threading.Condition()
+        self._now = start
+
+    def now(self):
+        with self._cond:
+            return self._now
+
+    def advance(self, seconds):
+        with self._cond:
+            self._now += timedelta(seconds=seconds)
+            self._cond.notify_all()
+
+    def sleep(self, seconds):
+        with self._cond:
+            until = self._now + timedelta(seconds=seconds)
+            while self._now < until:
+                self._cond.wait()
+
+clock = Clock()
+
+# === ЖУРНАЛ ===
+
+logger = logging.getLogger('walkbot')
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        payload = {
+            'ts': datetime.fromtimestamp(record.created).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3],
+            'level': record.levelname.lower(),
+            'event': record.getMessage(),
+        }
+        if shard_bus.origin != 'main':
+            payload['shard'] = shard_bus.origin
+        payload.update(getattr(record, 'fields', {}))
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+class RepeatFilter(logging.Filter):
+    """Пропускает не больше LOG_REPEAT_LIMIT одинаковых записей за окно.
+
+    Одинаковыми считаются записи с тем же событием, городом, методом API и
+    классом ошибки. Число отброшенных попадает в поле suppressed следующей пропущенной.
+    """
+
+    def __init__(self, window=LOG_REPEAT_WINDOW, limit=LOG_REPEAT_LIMIT):
+        super().__init__()
+        self.window = window
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._seen = {}
+
+    def filter(self, record):
+        fields = getattr(record, 'fields', {})
+        key = (record.msg, fields.get('tenant'), fields.get('api_method'), fields.get('error_class'))
+        now = time.monotonic()
+        with self._lock:
+            started, passed, suppressed = self._seen.get(key, (now, 0, 0))
+            if now - started > self.window:
+                started, passed = now, 0
+            if passed >= self.limit:
+                self._seen[key] = (started, passed, suppressed + 1)
+                return False
+            self._seen[key] = (started, passed + 1, 0)
+            if len(self._seen) > 1000:
+                self._seen = {k: v for k, v in self._seen.items() if now - v[0] <= self.window}
+        if suppressed:
+            record.fields = {**fields, 'suppressed': suppressed}
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Не блокирует обработчик, если фоновый писатель не успевает: запись отбрасывается."""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+_log_listener = None
+
+def setup_logging(stream=None):
+    global _log_listener
+    if _log_listener is not None:
+        return
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RepeatFilter())
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter())
+    _log_listener = logging.handlers.QueueListener(log_queue, output)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+    logger.addHandler(queue_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+def log_event(event, level=logging.INFO, **fields):
+    if TENANT:
+        fields['tenant'] = TENANT
+    logger.log(level, event, extra={'fields': fields})
+
+def error_fields(error):
+    fields = {'error_class': type(error).__name__, 'error': str(error)}
+    if isinstance(error, apihelper.ApiTelegramException):
+        fields['error_code'] = error.error_code
+    return fields
+
+# === КЛИЕНТ TELEGRAM API ===
+
+# Правки карточек можно отбросить при перегрузке: следующая правка всё равно придёт
+LOW_PRIORITY_METHODS = {'editMessageText', 'editMessageReplyMarkup'}
+# Long polling висит десятки секунд by design — не учитываем его в латентности
+UNGUARDED_METHODS = {'getUpdates'}
+
+class RequestsTransport:
+    """Общий requests.Session вместо сессии на каждый поток в apihelper.
+
+    Размер пула совпадает с пределом ограничителя, поэтому соединения не
+    выбрасываются при всплеске рассылки и переиспользуются между потоками.
+    """
+
+    name = 'requests'
+
+    def __init__(self, pool_size=API_POOL_SIZE):
+        self.session = requests.Session()
+        self.session.headers['Connection'] = 'keep-alive'
+        # pool_block: больше pool_size соединений не открываем — ApiGuard и так не пустит больше
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self._lock = threading.Lock()
+        self._requests = 0
+
+    def request(self, method, url, **kwargs):
+        with self._lock:
+            self._requests += 1
+        return self.session.request(method, url, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            result = {'requests': self._requests}
+        # Открытого счётчика соединений у urllib3 нет: читаем его пулы, если внутреннее устройство прежнее
+        pools = getattr(getattr(self.adapter.poolmanager, 'pools', None), '_container', None)
+        try:
+            result['connections'] = sum(pool.num_connections for pool in list(pools.values()))
+        except (AttributeError, TypeError):
+            pass
+        return result
+
+class HttpxTransport:
+    """HTTP/2 через httpx: все вызовы мультиплексируются в одно-два соединения."""
+
+    name = 'httpx/h2'
+
+    def __init__(self, pool_size=API_POOL_SIZE):
+        import httpx
+        self._httpx = httpx
+        self.client = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+        self._lock = threading.Lock()
+        self._counters = {'requests': 0, 'http2': 0}
+
+    def request(self, method, url, params=None, files=None, timeout=API_DEFAULT_TIMEOUT, proxies=None):
+        connect, read = timeout
+        try:
+            response = self.client.request(
+                method, url, params=params, files=files,
+                timeout=self._httpx.Timeout(read, connect=connect),
+            )
+        except self._httpx.TimeoutException as e:
+            raise requests.Timeout(str(e)) from e
+        except self._httpx.TransportError as e:
+            raise requests.ConnectionError(str(e)) from e
+        response.reason = response.reason_phrase  # apihelper ждёт интерфейс requests.Response
+        with self._lock:
+            self._counters['requests'] += 1
+            self._counters['http2'] += response.http_version == 'HTTP/2'
+        return response
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+def make_transport(pool_size=API_POOL_SIZE):
+    if API_HTTP2:
+        try:
+            return HttpxTransport(pool_size)
+        except ImportError:
+            print("⚠️ API_HTTP2=1, но httpx[http2] не установлен — используется requests")
+    return RequestsTransport(pool_size)
+
+api_transport = make_transport()
+
+class ApiOverloadedError(Exception):
+    """Вызов отклонён ограничителем: цепь разомкнута или не дождались слота."""
+
+class ApiGuard:
+    """Обёртка над HTTP-вызовами apihelper.
+
+    Число одновременных запросов регулируется по AIMD: растёт на 1/limit после
+    каждого быстрого успеха и делится пополам при ошибке 429/5xx, таймауте или
+    превышении целевой латентности. После серии ошибок цепь размыкается: правки
+    карточек отбрасываются сразу, остальные вызовы ждут в очереди. По истечении
+    паузы пропускается один пробный запрос — он либо замыкает цепь, либо
+    удваивает паузу.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, max_concurrency=API_MAX_CONCURRENCY, target_latency=API_TARGET_LATENCY,
+                 failure_threshold=API_FAILURE_THRESHOLD, cooldown=API_COOLDOWN,
+                 max_cooldown=API_MAX_COOLDOWN, queue_timeout=API_QUEUE_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self.limit = max(1.0, max_concurrency / 2)
+        self.in_flight = 0
+        self.waiting = 0
+        self.state = self.CLOSED
+        self.latency_ewma = 0.0
+        self.counters = {'calls': 0, 'ok': 0, 'errors': 0, 'shed': 0, 'rejected': 0, 'opened': 0}
+        self._cooldown = cooldown
+        self._opened_until = 0.0
+        self._consecutive_failures = 0
+        self._probe_in_flight = False
+        self._last_decrease = 0.0
+        self._recent = deque()  # [начало 10-секундной корзины, вызовов, ошибок]
+
+    def request(self, method, url, **kwargs):
+        """Совместим с apihelper.CUSTOM_REQUEST_SENDER."""
+        api_method = url.rsplit('/', 1)[-1]
+        if api_method in UNGUARDED_METHODS:
+            return self.send(method, url, **kwargs)
+        probe = self._acquire(api_method)
+        started = time.monotonic()
+        try:
+            response = self.send(method, url, **kwargs)
+        except Exception:
+            # Не только сеть: SSL, разбор ответа и прочие сбои тоже не должны замыкать цепь и поднимать лимит
+            self._release(probe, False, time.monotonic() - started)
+            raise
+        ok = response.status_code != 429 and response.status_code < 500
+        retry_after = None
+        if response.status_code == 429:
+            try:
+                retry_after = response.json().get('parameters', {}).get('retry_after')
+            except ValueError:
+                pass
+        self._release(probe, ok, time.monotonic() - started, retry_after)
+        return response
+
+    def send(self, method, url, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        # apihelper всегда передаёт timeout; свой ставим, только если там его значения по умолчанию,
+        # то есть вызывающий не задал timeout=. Для getUpdates он уже посчитан от long_polling_timeout
+        if (api_method not in UNGUARDED_METHODS
+                and kwargs.get('timeout') in (None, (apihelper.CONNECT_TIMEOUT, apihelper.READ_TIMEOUT))):
+            kwargs['timeout'] = API_TIMEOUTS.get(api_method, API_DEFAULT_TIMEOUT)
+        return api_transport.request(method, url, **kwargs)
+
+    def _acquire(self, api_method):
+        low_priority = api_method in LOW_PRIORITY_METHODS
+        deadline = time.monotonic() + self.queue_timeout
+        with self._cond:
+            self.counters['calls'] += 1
+            self.waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    if self.state == self.OPEN and now >= self._opened_until:
+                        self.state = self.HALF_OPEN
+                    if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                        self._probe_in_flight = True
+                        self.in_flight += 1
+                        return True
+                    if self.state == self.CLOSED and self.in_flight < int(self.limit):
+                        self.in_flight += 1
+                        return False
+                    if self.state != self.CLOSED and low_priority:
+                        self.counters['shed'] += 1
+                        raise ApiOverloadedError(f"{api_method}: цепь разомкнута, правка отброшена")
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self.counters['rejected'] += 1
+                        raise ApiOverloadedError(f"{api_method}: не дождались свободного слота")
+                    if self.state == self.OPEN:
+                        remaining = min(remaining, max(self._opened_until - now, 0.01))
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+
+    def _release(self, probe, ok, latency, retry_after=None):
+        now = time.monotonic()
+        with self._cond:
+            self.in_flight -= 1
+            if probe:
+                self._probe_in_flight = False
+            self.latency_ewma = latency if not self.latency_ewma else 0.8 * self.latency_ewma + 0.2 * latency
+            self._note_recent(now, ok)
+            if ok:
+                self.counters['ok'] += 1
+                self._consecutive_failures = 0
+                if self.state == self.HALF_OPEN:
+                    self.state = self.CLOSED
+                    self._cooldown = self.base_cooldown
+                    log_event('api_circuit', state=self.CLOSED)
+                if latency > self.target_latency:
+                    self._decrease(now)
+                else:
+                    self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            else:
+                self.counters['errors'] += 1
+                self._consecutive_failures += 1
+                self._decrease(now)
+                if probe or retry_after or self._consecutive_failures >= self.failure_threshold:
+                    self._open(now, retry_after, escalate=probe)
+            self._cond.notify_all()
+
+    def _decrease(self, now):
+        # Не чаще раза за целевую латентность, иначе одна волна ошибок обнулит лимит
+        if now - self._last_decrease >= self.target_latency:
+            self.limit = max(1.0, self.limit / 2)
+            self._last_decrease = now
+
+    def _open(self, now, retry_after=None, escalate=False):
+        if escalate:
+            self._cooldown = min(self.max_cooldown, self._cooldown * 2)
+        pause = retry_after or self._cooldown
+        if self.state != self.OPEN:
+            self.counters['opened'] += 1
+            log_event('api_circuit', logging.WARNING, state=self.OPEN, pause=pause, limit=round(self.limit, 2))
+        self.state = self.OPEN
+        self._opened_until = max(self._opened_until, now + pause)
+
+    def _note_recent(self, now, ok):
+        bucket = now - now % 10
+        if not self._recent or self._recent[-1][0] != bucket:
+            self._recent.append([bucket, 0, 0])
+            while self._recent[0][0] < now - API_RECENT_WINDOW:
+                self._recent.popleft()
+        self._recent[-1][1] += 1
+        self._recent[-1][2] += 0 if ok else 1
+
+    def recent(self, window=API_RECENT_WINDOW):
+        """(вызовов, ошибок) за последние window секунд."""
+        since = time.monotonic() - window
+        with self._cond:
+            buckets = [b for b in self._recent if b[0] >= since - 10]
+        return sum(b[1] for b in buckets), sum(b[2] for b in buckets)
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'state': self.state,
+                'limit': round(self.limit, 2),
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'latency_ewma': round(self.latency_ewma, 3),
+                **self.counters,
+            }
+
+api_guard = ApiGuard()
+apihelper.CUSTOM_REQUEST_SENDER = api_guard.request
+
 # === КОНСТАНТЫ ===
 MONTH_NAMES = {
     1: 'января', 2: 'февраля', 3: 'марта', 4: 'апреля',
     5: 'мая', 6: 'июня', 7: 'июля', 8: 'августа',
     9: 'сентября', 10: 'октября', 11: 'ноября', 12: 'декабря'
 }
+WEEKDAY_NAMES = ['пн', 'вт', 'ср', 'чт', 'пт', 'сб', 'вс']
+ALL_WEEKDAYS = 0b1111111
+# Статусы доставки, при которых пользователь исключается из рассылок до нового /start
+UNREACHABLE_STATUSES = ('blocked', 'not_found', 'deactivated')
 
 # === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
 
@@ -43,14 +572,77 @@ def allowed_only(func):
         return func(message)
     return wrapper
 
+class DbMetrics:
+    """Счётчики работы с БД: время блоков `with db_connect()` и ошибки блокировки."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.transactions = 0
+            self.total_time = 0.0
+            self.max_time = 0.0
+            self.window_max = 0.0
+            self.locked_errors = 0
+
+    def start_window(self):
+        """Начинает замер самой долгой транзакции (например, на время резервного копирования)."""
+        with self._lock:
+            self.window_max = 0.0
+
+    def observe(self, elapsed, error=None):
+        with self._lock:
+            self.transactions += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+            self.window_max = max(self.window_max, elapsed)
+            if isinstance(error, sqlite3.OperationalError) and "locked" in str(error):
+                self.locked_errors += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'transactions': self.transactions,
+                'total_time': round(self.total_time, 3),
+                'max_time': round(self.max_time, 4),
+                'locked_errors': self.locked_errors,
+            }
+
+db_metrics = DbMetrics()
+
+class MeteredConnection(sqlite3.Connection):
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        error = exc
+        try:
+            return super().__exit__(exc_type, exc, tb)
+        except sqlite3.Error as e:
+            error = e
+            raise
+        finally:
+            db_metrics.observe(time.perf_counter() - self._started, error)
+
+def db_connect():
+    return sqlite3.connect(DB_PATH, factory=MeteredConnection)
+
 def init_db():
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
+        # WAL: читатели (в том числе резервное копирование) не блокируют запись
+        cursor.execute("PRAGMA journal_mode=WAL")
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 first_name TEXT,
-                username TEXT
+                username TEXT,
+                delivery_status TEXT DEFAULT 'active',
+                lat REAL,
+                lon REAL
             )
         ''')
         cursor.execute('''
@@ -64,7 +656,12 @@ def init_db():
                 comment TEXT DEFAULT '',
                 editable BOOLEAN DEFAULT 1,
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                processed BOOLEAN DEFAULT 0
+                processed BOOLEAN DEFAULT 0,
+                template_id INTEGER,
+                lat REAL,
+                lon REAL,
+                geocell TEXT,
+                archived BOOLEAN DEFAULT 0
             )
         ''')
         cursor.execute('''
@@ -106,35 +703,285 @@ def init_db():
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS user_settings (
                 user_id INTEGER PRIMARY KEY,
-                reminder_minutes INTEGER DEFAULT 10
+                reminder_minutes INTEGER DEFAULT 10,
+                digest_minutes INTEGER DEFAULT 0,
+                digest_flushed_at DATETIME,
+                digest_message_id INTEGER,
+                digest_day TEXT,
+                quiet_from INTEGER,
+                quiet_to INTEGER
+            )
+        ''')
+        # События для сводки: kind — 'new' (новая карточка), 'update' (правка
+        # карточки, которая уже есть у пользователя) или 'confirmed'.
+        # Отправленные за день события остаются с flushed = 1: сводка дня собирается из них
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS digest_events (
+                user_id INTEGER NOT NULL,
+                proposal_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                created DATETIME NOT NULL,
+                walk_datetime DATETIME NOT NULL,
+                flushed BOOLEAN DEFAULT 0,
+                PRIMARY KEY (user_id, proposal_id, kind)
+            )
+        ''')
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_digest_pending ON digest_events (user_id, walk_datetime) WHERE flushed = 0"
+        )
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS subscriptions (
+                user_id INTEGER PRIMARY KEY,
+                weekdays INTEGER DEFAULT 127,
+                hour_from INTEGER DEFAULT 0,
+                hour_to INTEGER DEFAULT 23,
+                places TEXT DEFAULT '',
+                authors TEXT DEFAULT '',
+                radius_km REAL DEFAULT 0
+            )
+        ''')
+        # Полнотекстовый индекс: место, комментарий автора и комментарии участников.
+        # rowid = proposals.id; синхронизируется триггерами ниже
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS proposal_search USING fts5(
+                location, comment, participant_comments,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        ''')
+        cursor.executescript('''
+            CREATE TRIGGER IF NOT EXISTS proposals_search_insert AFTER INSERT ON proposals BEGIN
+                INSERT INTO proposal_search (rowid, location, comment, participant_comments)
+                VALUES (new.id, new.location, new.comment, '');
+            END;
+            CREATE TRIGGER IF NOT EXISTS proposals_search_update AFTER UPDATE OF location, comment ON proposals BEGIN
+                UPDATE proposal_search SET location = new.location, comment = new.comment WHERE rowid = new.id;
+            END;
+            CREATE TRIGGER IF NOT EXISTS proposals_search_delete AFTER DELETE ON proposals BEGIN
+                DELETE FROM proposal_search WHERE rowid = old.id;
+            END;
+            CREATE TRIGGER IF NOT EXISTS comments_search_insert AFTER INSERT ON comments BEGIN
+                UPDATE proposal_search SET participant_comments = (
+                    SELECT group_concat(comment, ' ') FROM comments WHERE proposal_id = new.proposal_id
+                ) WHERE rowid = new.proposal_id;
+            END;
+            CREATE TRIGGER IF NOT EXISTS comments_search_update AFTER UPDATE ON comments BEGIN
+                UPDATE proposal_search SET participant_comments = (
+                    SELECT group_concat(comment, ' ') FROM comments WHERE proposal_id = new.proposal_id
+                ) WHERE rowid = new.proposal_id;
+            END;
+            CREATE TRIGGER IF NOT EXISTS comments_search_delete AFTER DELETE ON comments BEGIN
+                UPDATE proposal_search SET participant_comments = COALESCE((
+                    SELECT group_concat(comment, ' ') FROM comments WHERE proposal_id = old.proposal_id
+                ), '') WHERE rowid = old.proposal_id;
+            END;
+        ''')
+        # materialized_until — до какого момента шаблон уже развёрнут в proposals
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS walk_templates (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                proposer_id INTEGER NOT NULL,
+                proposer_name TEXT NOT NULL,
+                time_str TEXT NOT NULL,
+                weekdays INTEGER NOT NULL,
+                location TEXT DEFAULT '',
+                comment TEXT DEFAULT '',
+                active BOOLEAN DEFAULT 1,
+                materialized_until DATETIME
+            )
+        ''')
+        # Сводные таблицы статистики: пополняются при архивации прогулки, /stats читает только их.
+        # walks — прогулки, на которые кто-то пошёл; participants — сумма голосов «иду»
+        cursor.executescript('''
+            CREATE TABLE IF NOT EXISTS stats_daily (
+                day TEXT PRIMARY KEY,
+                proposals INTEGER NOT NULL DEFAULT 0,
+                walks INTEGER NOT NULL DEFAULT 0,
+                confirmed INTEGER NOT NULL DEFAULT 0,
+                participants INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS stats_proposers (
+                proposer_id INTEGER PRIMARY KEY,
+                proposer_name TEXT NOT NULL,
+                proposals INTEGER NOT NULL DEFAULT 0,
+                walks INTEGER NOT NULL DEFAULT 0,
+                participants INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_stats_proposers_participants ON stats_proposers (participants);
+            CREATE TABLE IF NOT EXISTS stats_hours (
+                weekday INTEGER NOT NULL,
+                hour INTEGER NOT NULL,
+                walks INTEGER NOT NULL DEFAULT 0,
+                participants INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (weekday, hour)
+            );
+        ''')
+        # Шина шардов: чьи записи в памяти других процессов устарели (см. ShardBus)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS shard_events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                created REAL NOT NULL,
+                origin TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                key INTEGER NOT NULL
+            )
+        ''')
+        # Аренда фоновых задач: expires — unix-время, term растёт при каждой смене держателя,
+        # watermark — конец окна напоминаний последнего прохода
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires REAL NOT NULL,
+                term INTEGER NOT NULL DEFAULT 1,
+                watermark DATETIME
+            )
+        ''')
+        # Разосланные карточки удалённых предложений, ждущие финальной правки (см. CardFinalizer)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stale_cards (
+                user_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                PRIMARY KEY (user_id, message_id)
             )
         ''')
 
 def cleanup_old_counts():
-    today = date.today().isoformat()
-    with sqlite3.connect(DB_PATH) as conn:
+    today = clock.today().isoformat()
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM daily_proposal_counts WHERE date < ?", (today,))
         conn.commit()
 
 def add_user(user_id, first_name, username):
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "INSERT OR IGNORE INTO users (user_id, first_name, username) VALUES (?, ?, ?)",
             (user_id, first_name, username)
         )
+        created = cursor.rowcount
+    subscription_index.add_user(user_id)
+    if created:
+        shard_bus.publish('user', user_id)
+    if user_id in unreachable_users:
+        set_delivery_status(user_id, 'active')
 
 def get_all_users():
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT user_id, first_name, username FROM users")
         return cursor.fetchall()
 
+# === ДОСТАВКА ===
+
+# Пользователи, которым доставка невозможна (заблокировали бота, удалили аккаунт и т.п.)
+unreachable_users = set()
+
+def load_unreachable_users():
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT user_id FROM users WHERE delivery_status IN (?, ?, ?)",
+            UNREACHABLE_STATUSES
+        )
+        ids = {row[0] for row in cursor.fetchall()}
+    unreachable_users.clear()
+    unreachable_users.update(ids)
+
+def set_delivery_status(user_id, status):
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE users SET delivery_status = ? WHERE user_id = ?", (status, user_id))
+    if status in UNREACHABLE_STATUSES:
+        unreachable_users.add(user_id)
+    else:
+        unreachable_users.discard(user_id)
+    shard_bus.publish('user', user_id)
+
+def classify_delivery_error(error):
+    """Возвращает 'blocked', 'not_found', 'deactivated', 'not_modified' или 'transient'."""
+    if not isinstance(error, apihelper.ApiTelegramException):
+        return 'transient'
+    description = (error.description or "").lower()
+    if "message is not modified" in description:
+        return 'not_modified'
+    if error.error_code == 403:
+        if "deactivated" in description:
+            return 'deactivated'
+        return 'blocked'
+    if error.error_code == 400 and "chat not found" in description:
+        return 'not_found'
+    return 'transient'
+
+def record_delivery_failure(user_id, error, stats=None, **context):
+    """Классифицирует ошибку отправки; недоступного пользователя исключает из рассылок.
+
+    Внутри рассылки ошибка только учитывается в stats — в журнал попадёт одна
+    итоговая запись report_broadcast(). Одиночная ошибка пишется сразу.
+    """
+    status = classify_delivery_error(error)
+    if status in UNREACHABLE_STATUSES:
+        set_delivery_status(user_id, status)
+    if status == 'not_modified':
+        return status
+    if stats is not None:
+        stats['failed'] += 1
+        stats['errors'][status] = stats['errors'].get(status, 0) + 1
+        stats.setdefault('sample', {'user_id': user_id, **error_fields(error)})
+    else:
+        log_event('delivery_failed', logging.WARNING, user_id=user_id, status=status, **context, **error_fields(error))
+    return status
+
+def new_broadcast_stats(kind, proposal_id, api_method):
+    return {
+        'kind': kind, 'proposal_id': proposal_id, 'api_method': api_method,
+        'sent': 0, 'edited': 0, 'skipped': 0, 'failed': 0, 'errors': {},
+    }
+
+def report_broadcast(stats):
+    log_event('broadcast', logging.WARNING if stats['failed'] else logging.INFO, **stats)
+
+# Рассылки карточек: счётчики для /admin и пауза. На паузе рассылки копятся
+# в deferred_broadcasts и уходят после возобновления (карточка — всегда свежая).
+broadcasts_paused = threading.Event()
+deferred_broadcasts = set()
+broadcast_counters = {'active': 0, 'pending': 0}
+_broadcast_lock = threading.Lock()
+
+def track_broadcast(active=0, pending=0):
+    with _broadcast_lock:
+        broadcast_counters['active'] += active
+        broadcast_counters['pending'] += pending
+
+def defer_broadcast(proposal_id):
+    with _broadcast_lock:
+        deferred_broadcasts.add(proposal_id)
+
+def pause_broadcasts(publish=True):
+    broadcasts_paused.set()
+    log_event('broadcasts_paused')
+    if publish:
+        shard_bus.publish('pause', 1)
+
+def resume_broadcasts(publish=True):
+    broadcasts_paused.clear()
+    if publish:
+        shard_bus.publish('pause', 0)
+    with _broadcast_lock:
+        proposal_ids = sorted(deferred_broadcasts)
+        deferred_broadcasts.clear()
+    log_event('broadcasts_resumed', deferred=len(proposal_ids))
+
+    def deliver():
+        for proposal_id in proposal_ids:
+            update_all_messages_with_details(proposal_id)
+    threading.Thread(target=deliver, daemon=True).start()
+
 def can_propose(user_id):
     cleanup_old_counts()
-    today = date.today().isoformat()
-    with sqlite3.connect(DB_PATH) as conn:
+    today = clock.today().isoformat()
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "SELECT count FROM daily_proposal_counts WHERE user_id = ? AND date = ?",
@@ -146,8 +993,8 @@ def can_propose(user_id):
 
 def increment_proposal_count(user_id):
     cleanup_old_counts()
-    today = date.today().isoformat()
-    with sqlite3.connect(DB_PATH) as conn:
+    today = clock.today().isoformat()
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO daily_proposal_counts (user_id, date, count) VALUES (?, ?, 1) "
@@ -156,7 +1003,7 @@ def increment_proposal_count(user_id):
         )
 
 def parse_proposal_datetime(input_str):
-    now = datetime.now()
+    now = clock.now()
     input_clean = input_str.strip()
     if re.match(r'^\d{4}-\d{2}-\d{2}\s+\d{1,2}:\d{2}$', input_clean):
         try:
@@ -175,7 +1022,7 @@ def parse_proposal_datetime(input_str):
     return None
 
 def get_all_message_ids_for_proposal(proposal_id):
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "SELECT user_id, message_id FROM user_proposal_messages WHERE proposal_id = ?",
@@ -184,7 +1031,7 @@ def get_all_message_ids_for_proposal(proposal_id):
         return cursor.fetchall()
 
 def save_message_id(user_id, proposal_id, message_id):
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "INSERT OR REPLACE INTO user_proposal_messages (user_id, proposal_id, message_id) VALUES (?, ?, ?)",
@@ -192,7 +1039,7 @@ def save_message_id(user_id, proposal_id, message_id):
         )
 
 def get_message_id(user_id, proposal_id):
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "SELECT message_id FROM user_proposal_messages WHERE user_id = ? AND proposal_id = ?",
@@ -202,60 +1049,237 @@ def get_message_id(user_id, proposal_id):
         return row[0] if row else None
 
 def save_comment(proposal_id, user_id, user_name, comment):
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("""
             INSERT OR REPLACE INTO comments (proposal_id, user_id, user_name, comment)
             VALUES (?, ?, ?, ?)
         """, (proposal_id, user_id, user_name, comment))
+    card_renderer.apply_comment(proposal_id, user_name, comment)
+    shard_bus.publish('proposal', proposal_id)
 
 def get_comments(proposal_id):
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("""
             SELECT user_name, comment FROM comments WHERE proposal_id = ?
         """, (proposal_id,))
         return {user_name: comment for user_name, comment in cursor.fetchall()}
 
-def add_proposal(proposer_id, proposer_name, time_str, walk_datetime, location="", comment=""):
+ProposalRecord = namedtuple(
+    'ProposalRecord',
+    'proposer_id proposer_name time_str walk_datetime location comment walk_dt lat lon',
+    defaults=(None, None)
+)
+
+class ProposalCache:
+    """LRU-кэш записей предложений с уже разобранной датой прогулки.
+
+    Любое изменение или удаление предложения обязано вызвать invalidate(),
+    иначе карточки будут собираться по устаревшим данным.
+    """
+
+    def __init__(self, capacity=PROPOSAL_CACHE_SIZE):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._generation = 0  # растёт при каждом invalidate()/clear()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, proposal_id):
+        with self._lock:
+            record = self._items.get(proposal_id)
+            if record is not None:
+                self._items.move_to_end(proposal_id)
+                self.hits += 1
+                return record
+            self.misses += 1
+            generation = self._generation
+        with db_connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT proposer_id, proposer_name, time_str, walk_datetime, location, comment, lat, lon
+                FROM proposals WHERE id = ?
+            """, (proposal_id,))
+            row = cursor.fetchone()
+        if not row:
+            return None
+        record = ProposalRecord(*row[:6], datetime.strptime(row[3], '%Y-%m-%d %H:%M:%S'), *row[6:])
+        self.put(proposal_id, record, generation)
+        return record
+
+    @property
+    def generation(self):
+        """Снимается до записи в базу и передаётся в put(), как это делает get()."""
+        with self._lock:
+            return self._generation
+
+    def put(self, proposal_id, record, generation=None):
+        """generation — значение счётчика до чтения из базы: если с тех пор был invalidate(), запись могла устареть."""
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._items[proposal_id] = record
+            self._items.move_to_end(proposal_id)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+
+    def invalidate(self, *proposal_ids):
+        with self._lock:
+            self._generation += 1
+            for proposal_id in proposal_ids:
+                self._items.pop(proposal_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._items.clear()
+
+    def snapshot(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            }
+
+proposal_cache = ProposalCache()
+
+class LiveProposals:
+    """Номера существующих предложений.
+
+    По ним нажатие кнопки на карточке удалённого предложения отклоняется сразу,
+    без записи в базу и без рассылки. Номера выдаёт AUTOINCREMENT и не
+    переиспользует, поэтому номер не больше последнего на момент load() и не из
+    множества — точно удалён. Более новые номера мог создать другой процесс или
+    экземпляр на той же базе: их без проверки по базе отклоняем, только если
+    знаем об удалении (своём, по событию шины или по прошлой проверке).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = set()
+        self._closed = set()
+        self._loaded_max = 0
+        self.rejected = 0
+
+    def load(self):
+        with db_connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM proposals")
+            ids = {row[0] for row in cursor.fetchall()}
+            cursor.execute("SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'proposals'), 0)")
+            max_id = cursor.fetchone()[0]
+        with self._lock:
+            self._ids = ids
+            self._closed = set()
+            self._loaded_max = max(max_id, max(ids, default=0))
+
+    def add(self, proposal_id):
+        with self._lock:
+            self._ids.add(proposal_id)
+
+    def discard(self, *proposal_ids):
+        with self._lock:
+            self._ids.difference_update(proposal_ids)
+            self._closed.update(pid for pid in proposal_ids if pid > self._loaded_max)
+
+    def __contains__(self, proposal_id):
+        with self._lock:
+            if proposal_id in self._ids:
+                return True
+            if proposal_id <= self._loaded_max or proposal_id in self._closed:
+                self.rejected += 1
+                return False
+        if get_proposal(proposal_id) is None:
+            # Номер не переиспользуется: удалённое не вернётся, в базу за ним больше не ходим
+            self.discard(proposal_id)
+            with self._lock:
+                self.rejected += 1
+            return False
+        self.add(proposal_id)
+        return True
+
+    def __len__(self):
+        return len(self._ids)
+
+live_proposals = LiveProposals()
+
+def add_proposal(proposer_id, proposer_name, time_str, walk_datetime, location="", comment="", coords=None):
     walk_dt_str = walk_datetime.strftime('%Y-%m-%d %H:%M:%S')
-    with sqlite3.connect(DB_PATH) as conn:
+    lat, lon = coords or (None, None)
+    generation = proposal_cache.generation
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             """INSERT INTO proposals 
-               (proposer_id, proposer_name, time_str, walk_datetime, location, comment, editable) 
-               VALUES (?, ?, ?, ?, ?, ?, 1)""",
-            (proposer_id, proposer_name, time_str, walk_dt_str, location, comment)
+               (proposer_id, proposer_name, time_str, walk_datetime, location, comment, editable, lat, lon, geocell, timestamp) 
+               VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?, ?, ?)""",
+            (proposer_id, proposer_name, time_str, walk_dt_str, location, comment,
+             lat, lon, geocell(lat, lon) if coords else None, clock.now().strftime('%Y-%m-%d %H:%M:%S'))
         )
-        return cursor.lastrowid
+        proposal_id = cursor.lastrowid
+    live_proposals.add(proposal_id)
+    # Карточку нового предложения сразу разошлют всем — кладём запись в кэш заранее
+    proposal_cache.put(proposal_id, ProposalRecord(
+        proposer_id, proposer_name, time_str, walk_dt_str, location, comment,
+        datetime.strptime(walk_dt_str, '%Y-%m-%d %H:%M:%S'), lat, lon
+    ), generation)
+    return proposal_id
+
+def get_proposal(proposal_id):
+    return proposal_cache.get(proposal_id)
 
 def get_proposal_author(proposal_id):
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT proposer_id, proposer_name, time_str, walk_datetime, location, comment 
-            FROM proposals WHERE id = ?
-        """, (proposal_id,))
-        return cursor.fetchone()
+    record = proposal_cache.get(proposal_id)
+    return tuple(record[:6]) if record else None
+
+def forget_proposals(*proposal_ids):
+    """Сбрасывает всё, что держится в памяти по удалённым или изменённым предложениям."""
+    proposal_cache.invalidate(*proposal_ids)
+    card_renderer.forget(*proposal_ids)
+    shard_bus.publish('proposal', *proposal_ids)
+
+def close_proposals(*proposal_ids):
+    """Предложения удалены: кнопки их карточек больше не принимаются.
+
+    Вызывается после фиксации транзакции с delete_proposals() — оповещение
+    других процессов пишется отдельным соединением.
+    """
+    live_proposals.discard(*proposal_ids)
+    proposal_cache.invalidate(*proposal_ids)
+    card_renderer.forget(*proposal_ids)
+    shard_bus.publish('closed', *proposal_ids)
 
 def add_vote(proposal_id, voter_id, voter_name, vote_type='yes'):
+    """Записывает голос; False — предложения уже нет, ничего не записано."""
     if vote_type not in ('yes', 'later', 'no'):
         vote_type = 'yes'
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         try:
+            # Внешние ключи не проверяются — без EXISTS голос за удалённое предложение остался бы сиротой
             cursor.execute(
-                "INSERT INTO votes (proposal_id, voter_id, voter_name, vote_type) VALUES (?, ?, ?, ?)",
-                (proposal_id, voter_id, voter_name, vote_type)
+                "INSERT INTO votes (proposal_id, voter_id, voter_name, vote_type) "
+                "SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM proposals WHERE id = ?)",
+                (proposal_id, voter_id, voter_name, vote_type, proposal_id)
             )
+            if not cursor.rowcount:
+                return False
         except sqlite3.IntegrityError:
             cursor.execute(
                 "UPDATE votes SET vote_type = ?, voter_name = ? WHERE proposal_id = ? AND voter_id = ?",
                 (vote_type, voter_name, proposal_id, voter_id)
             )
+    card_renderer.apply_vote(proposal_id, voter_id, voter_name, vote_type)
+    shard_bus.publish('proposal', proposal_id)
+    return True
 
 def get_votes(proposal_id):
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "SELECT voter_name, vote_type FROM votes WHERE proposal_id = ?",
@@ -268,44 +1292,62 @@ def get_votes(proposal_id):
             result[vtype].append(name)
     return result
 
+def delete_proposals(cursor, where, params=(), finalize=True):
+    """Удаляет предложения по условию вместе с голосами, комментариями и ссылками на сообщения.
+
+    PRAGMA foreign_keys не включена, поэтому ON DELETE CASCADE из схемы не срабатывает.
+    Ещё не перенесённые в архив предложения в той же транзакции уходят в архив.
+    При finalize разосланные карточки в той же транзакции ставятся в очередь
+    CardFinalizer; отмена автором правит карточки сама и передаёт False.
+    Возвращает номера удалённых предложений — после фиксации их передают в close_proposals().
+    """
+    cursor.execute(f"SELECT id FROM proposals WHERE {where}", params)
+    proposal_ids = [row[0] for row in cursor.fetchall()]
+    if not proposal_ids:
+        return []
+    archive_proposals(cursor, where, params)
+    if finalize:
+        card_finalizer.queue(cursor, where, params)
+    for table in ('votes', 'comments', 'user_proposal_messages'):
+        cursor.execute(f"DELETE FROM {table} WHERE proposal_id IN (SELECT id FROM proposals WHERE {where})", params)
+    cursor.execute(f"DELETE FROM proposals WHERE {where}", params)
+    return proposal_ids
+
 def auto_delete_old_proposals_by_walk_time():
-    six_hours_ago = datetime.now() - timedelta(hours=6)
-    with sqlite3.connect(DB_PATH) as conn:
+    six_hours_ago = clock.now() - timedelta(hours=6)
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("""
             SELECT id FROM proposals
             WHERE walk_datetime < ? AND processed = 0
         """, (six_hours_ago.strftime('%Y-%m-%d %H:%M:%S'),))
         candidate_ids = [row[0] for row in cursor.fetchall()]
-        deleted_count = 0
+        deleted = []
         for pid in candidate_ids:
             cursor.execute("SELECT COUNT(*) FROM votes WHERE proposal_id = ? AND vote_type = 'yes'", (pid,))
             yes_votes = cursor.fetchone()[0]
             if yes_votes == 0:
-                cursor.execute("DELETE FROM proposals WHERE id = ?", (pid,))
-                deleted_count += 1
-        if deleted_count > 0:
-            print(f"🗑️ Удалено {deleted_count} безответных предложений")
+                deleted += delete_proposals(cursor, "id = ?", (pid,))
+    if deleted:
+        close_proposals(*deleted)
+        log_event('retention', reason='no_votes', deleted=len(deleted))
 
 def cleanup_old_proposals():
-    now = datetime.now()
-    with sqlite3.connect(DB_PATH) as conn:
+    now = clock.now()
+    day_ago = (now - timedelta(hours=24)).strftime('%Y-%m-%d %H:%M:%S')
+    seven_days_ago = (now - timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
+    with db_connect() as conn:
         cursor = conn.cursor()
-        cursor.execute("""
-            DELETE FROM proposals 
-            WHERE walk_datetime < ? AND walk_datetime > datetime('now', '-7 days')
-        """, ((now - timedelta(hours=24)).strftime('%Y-%m-%d %H:%M:%S'),))
-        deleted_24h = cursor.rowcount
-        seven_days_ago = now - timedelta(days=7)
-        cursor.execute("DELETE FROM proposals WHERE timestamp < ?", (seven_days_ago.strftime('%Y-%m-%d %H:%M:%S'),))
-        deleted_7d = cursor.rowcount - deleted_24h
-        if deleted_24h:
-            print(f"🧹 Удалено {deleted_24h} предложений (прошло 24ч после прогулки)")
-        if deleted_7d:
-            print(f"🧹 Удалено {deleted_7d} очень старых предложений")
+        deleted_24h = delete_proposals(cursor, "walk_datetime < ? AND walk_datetime > ?", (day_ago, seven_days_ago))
+        deleted_7d = delete_proposals(cursor, "timestamp < ?", (seven_days_ago,))
+    close_proposals(*deleted_24h, *deleted_7d)
+    if deleted_24h:
+        log_event('retention', reason='walk_passed_24h', deleted=len(deleted_24h))
+    if deleted_7d:
+        log_event('retention', reason='older_than_7d', deleted=len(deleted_7d))
 
 def set_reminder_minutes(user_id, minutes):
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO user_settings (user_id, reminder_minutes) VALUES (?, ?) "
@@ -314,14 +1356,14 @@ def set_reminder_minutes(user_id, minutes):
         )
 
 def get_reminder_minutes(user_id):
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT reminder_minutes FROM user_settings WHERE user_id = ?", (user_id,))
         row = cursor.fetchone()
         return row[0] if row else 10
 
 def format_walk_date(walk_dt: datetime) -> str:
-    now = datetime.now()
+    now = clock.now()
     day = walk_dt.day
     month = MONTH_NAMES.get(walk_dt.month, str(walk_dt.month))
     if walk_dt.date() == now.date():
@@ -331,12 +1373,261 @@ def format_walk_date(walk_dt: datetime) -> str:
     else:
         return f"{day} {month}"
 
+# === ФИЛЬТРЫ ПОДПИСКИ ===
+
+def get_subscription(user_id):
+    """Правило подписки: (weekdays, hour_from, hour_to, places, authors, radius_km) или None — получать всё."""
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT weekdays, hour_from, hour_to, places, authors, radius_km FROM subscriptions WHERE user_id = ?",
+            (user_id,)
+        )
+        return cursor.fetchone()
+
+def set_subscription(user_id, rule):
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        if rule is None:
+            cursor.execute("DELETE FROM subscriptions WHERE user_id = ?", (user_id,))
+        else:
+            cursor.execute(
+                "INSERT OR REPLACE INTO subscriptions (user_id, weekdays, hour_from, hour_to, places, authors, radius_km) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, *rule)
+            )
+    subscription_index.set_rule(user_id, rule)
+    shard_bus.publish('user', user_id)
+
+def find_user_ids_by_names(names):
+    """Ищет пользователей по @username или имени. Возвращает (ids, не_найденные)."""
+    # lower() в SQLite не понимает кириллицу, поэтому сравниваем в Python
+    found, missing = set(), []
+    users = get_all_users()
+    for name in names:
+        if name.startswith('@'):
+            key = name[1:].casefold()
+            ids = [uid for uid, _, username in users if username and username.casefold() == key]
+        else:
+            key = name.casefold()
+            ids = [uid for uid, first_name, _ in users if first_name and first_name.casefold() == key]
+        if ids:
+            found.update(ids)
+        else:
+            missing.append(name)
+    return found, missing
+
+def hours_in_range(hour_from, hour_to):
+    if hour_from <= hour_to:
+        return range(hour_from, hour_to + 1)
+    return list(range(hour_from, 24)) + list(range(0, hour_to + 1))
+
+def parse_weekdays(value):
+    value = value.strip().lower()
+    if value in ("все", "любые"):
+        return ALL_WEEKDAYS
+    if value == "будни":
+        return 0b0011111
+    if value == "выходные":
+        return 0b1100000
+    mask = 0
+    for part in value.replace(' ', '').split(','):
+        if '-' in part:
+            start, end = part.split('-', 1)
+            if start not in WEEKDAY_NAMES or end not in WEEKDAY_NAMES:
+                return None
+            i, j = WEEKDAY_NAMES.index(start), WEEKDAY_NAMES.index(end)
+            days = range(i, j + 1) if i <= j else list(range(i, 7)) + list(range(0, j + 1))
+            for d in days:
+                mask |= 1 << d
+        elif part in WEEKDAY_NAMES:
+            mask |= 1 << WEEKDAY_NAMES.index(part)
+        else:
+            return None
+    return mask or None
+
+def parse_subscription_rule(text):
+    """Разбирает строку вида «дни: пн-пт; часы: 18-22; место: парк; авторы: @ivan; радиус: 3».
+    Возвращает (rule, ошибка); rule=None означает «получать все прогулки»."""
+    text = text.strip()
+    if text in ("-", "все", "сброс"):
+        return None, None
+    weekdays, hour_from, hour_to, places, authors, radius_km = ALL_WEEKDAYS, 0, 23, "", "", 0
+    for chunk in text.split(';'):
+        if not chunk.strip():
+            continue
+        if ':' not in chunk:
+            return None, f"Не понял часть «{chunk.strip()}»"
+        key, value = (s.strip() for s in chunk.split(':', 1))
+        key = key.lower()
+        if key == "дни":
+            weekdays = parse_weekdays(value)
+            if weekdays is None:
+                return None, "Дни: пн, вт, ср, чт, пт, сб, вс, диапазон (пн-пт), «будни» или «выходные»"
+        elif key == "часы":
+            m = re.match(r'^(\d{1,2})\s*-\s*(\d{1,2})$', value)
+            if not m or int(m.group(1)) > 23 or int(m.group(2)) > 23:
+                return None, "Часы: диапазон вида 18-22 (0–23)"
+            hour_from, hour_to = int(m.group(1)), int(m.group(2))
+        elif key == "место":
+            places = ",".join(p.strip().lower() for p in value.split(',') if p.strip())
+        elif key == "авторы":
+            names = [n.strip() for n in value.split(',') if n.strip()]
+            ids, missing = find_user_ids_by_names(names)
+            if missing:
+                return None, f"Не нашёл пользователей: {', '.join(missing)}"
+            authors = ",".join(str(i) for i in sorted(ids))
+        elif key == "радиус":
+            m = re.match(r'^(\d+(?:[.,]\d+)?)\s*(?:км)?$', value)
+            if not m:
+                return None, "Радиус: число километров, например 3"
+            radius_km = float(m.group(1).replace(',', '.'))
+        else:
+            return None, f"Неизвестное поле «{key}»"
+    return (weekdays, hour_from, hour_to, places, authors, radius_km), None
+
+def describe_weekdays(weekdays):
+    if weekdays == ALL_WEEKDAYS:
+        return "каждый день"
+    return ", ".join(n for i, n in enumerate(WEEKDAY_NAMES) if weekdays & (1 << i))
+
+def describe_subscription(rule):
+    if rule is None:
+        return "все прогулки"
+    weekdays, hour_from, hour_to, places, authors, radius_km = rule
+    parts = []
+    if weekdays != ALL_WEEKDAYS:
+        parts.append("дни: " + describe_weekdays(weekdays))
+    if (hour_from, hour_to) != (0, 23):
+        parts.append(f"часы: {hour_from}-{hour_to}")
+    if places:
+        parts.append(f"место: {places.replace(',', ', ')}")
+    if authors:
+        parts.append(f"авторов: {len(authors.split(','))}")
+    if radius_km:
+        parts.append(f"радиус: {radius_km:g} км")
+    return "; ".join(parts) or "все прогулки"
+
+class SubscriptionIndex:
+    """Индекс получателей рассылки.
+
+    Пользователи без фильтров лежат в общем множестве, остальные — в корзинах
+    по (день недели, час). Фильтры по месту, авторам и радиусу проверяются только
+    для кандидатов из корзины, поэтому рассылка не перебирает всех пользователей.
+    Радиус считается от последней геопозиции пользователя и применяется только
+    к прогулкам с геометкой.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._everyone = set()
+        self._slots = [[set() for _ in range(24)] for _ in range(7)]
+        self._places = {}
+        self._authors = {}
+        self._rules = {}
+        self._homes = {}
+        self._radius = {}
+
+    def rebuild(self):
+        with db_connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT u.user_id, u.lat, u.lon, s.weekdays, s.hour_from, s.hour_to, s.places, s.authors, s.radius_km
+                FROM users u
+                LEFT JOIN subscriptions s ON u.user_id = s.user_id
+            """)
+            rows = cursor.fetchall()
+        with self._lock:
+            self._everyone = set()
+            self._slots = [[set() for _ in range(24)] for _ in range(7)]
+            self._places = {}
+            self._authors = {}
+            self._rules = {}
+            self._homes = {}
+            self._radius = {}
+            for user_id, lat, lon, *rule in rows:
+                if lat is not None:
+                    self._homes[user_id] = (lat, lon)
+                self._add_locked(user_id, tuple(rule) if rule[0] is not None else None)
+
+    def set_home(self, user_id, lat, lon):
+        with self._lock:
+            self._homes[user_id] = (lat, lon)
+
+    def has_home(self, user_id):
+        with self._lock:
+            return user_id in self._homes
+
+    def add_user(self, user_id):
+        with self._lock:
+            if user_id not in self._rules:
+                self._add_locked(user_id, None)
+
+    def set_rule(self, user_id, rule):
+        with self._lock:
+            self._remove_locked(user_id)
+            self._add_locked(user_id, rule)
+
+    def _add_locked(self, user_id, rule):
+        self._rules[user_id] = rule
+        if rule is None:
+            self._everyone.add(user_id)
+            return
+        weekdays, hour_from, hour_to, places, authors, radius_km = rule
+        hours = hours_in_range(hour_from, hour_to)
+        for wd in range(7):
+            if weekdays & (1 << wd):
+                for hour in hours:
+                    self._slots[wd][hour].add(user_id)
+        if radius_km:
+            self._radius[user_id] = radius_km
+        if places:
+            self._places[user_id] = [p for p in places.split(',') if p]
+        if authors:
+            self._authors[user_id] = {int(a) for a in authors.split(',') if a}
+
+    def _remove_locked(self, user_id):
+        rule = self._rules.pop(user_id, None)
+        self._everyone.discard(user_id)
+        self._places.pop(user_id, None)
+        self._authors.pop(user_id, None)
+        self._radius.pop(user_id, None)
+        if rule is None:
+            return
+        weekdays, hour_from, hour_to = rule[:3]
+        hours = hours_in_range(hour_from, hour_to)
+        for wd in range(7):
+            if weekdays & (1 << wd):
+                for hour in hours:
+                    self._slots[wd][hour].discard(user_id)
+
+    def match(self, walk_dt, location, proposer_id, coords=None):
+        location_lower = (location or "").lower()
+        result = set()
+        with self._lock:
+            result.update(self._everyone)
+            for user_id in self._slots[walk_dt.weekday()][walk_dt.hour]:
+                places = self._places.get(user_id)
+                if places and not any(p in location_lower for p in places):
+                    continue
+                authors = self._authors.get(user_id)
+                if authors and proposer_id not in authors:
+                    continue
+                radius_km = self._radius.get(user_id)
+                home = self._homes.get(user_id)
+                if radius_km and coords and home and distance_km(*home, *coords) > radius_km:
+                    continue
+                result.add(user_id)
+        return result
+
+subscription_index = SubscriptionIndex()
+
 # === ФУНКЦИЯ: ТЕКУЩИЕ ПРОГУЛКИ ===
 
 def get_current_proposals():
     """Возвращает все предложения, время которых ещё не прошло."""
-    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    with sqlite3.connect(DB_PATH) as conn:
+    now = clock.now().strftime('%Y-%m-%d %H:%M:%S')
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("""
             SELECT id, proposer_name, time_str, walk_datetime, location, comment
@@ -346,96 +1637,1141 @@ def get_current_proposals():
         """, (now,))
         return cursor.fetchall()
 
-# === КЛАВИАТУРЫ ===
+# === ПОВТОРЯЮЩИЕСЯ ПРОГУЛКИ ===
 
-def main_menu():
-    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-    markup.add("Прогулки", "Настройки")
-    markup.add("Помощь")
-    return markup
+def get_templates(proposer_id):
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, time_str, weekdays, location, comment
+            FROM walk_templates
+            WHERE proposer_id = ? AND active = 1
+            ORDER BY id
+        """, (proposer_id,))
+        return cursor.fetchall()
+
+def save_template(proposer_id, proposer_name, time_str, weekdays, location, template_id=None):
+    """Создаёт шаблон или меняет свой. Возвращает id шаблона или None, если менять нечего.
+
+    Правка касается только ещё не развёрнутых дней: созданные предложения
+    остаются как есть и меняются через /edit.
+    """
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        if template_id is None:
+            cursor.execute(
+                """INSERT INTO walk_templates (proposer_id, proposer_name, time_str, weekdays, location)
+                   VALUES (?, ?, ?, ?, ?)""",
+                (proposer_id, proposer_name, time_str, weekdays, location)
+            )
+            return cursor.lastrowid
+        cursor.execute(
+            """UPDATE walk_templates SET proposer_name = ?, time_str = ?, weekdays = ?, location = ?
+               WHERE id = ? AND proposer_id = ? AND active = 1""",
+            (proposer_name, time_str, weekdays, location, template_id, proposer_id)
+        )
+        return template_id if cursor.rowcount else None
+
+def deactivate_template(template_id, proposer_id):
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE walk_templates SET active = 0 WHERE id = ? AND proposer_id = ?",
+            (template_id, proposer_id)
+        )
+        return cursor.rowcount > 0
+
+def template_occurrences(time_str, weekdays, after, until):
+    """Моменты прогулок по шаблону в промежутке (after, until]."""
+    hour, minute = map(int, time_str.split(':'))
+    day = after.date()
+    while True:
+        walk_dt = datetime(day.year, day.month, day.day, hour, minute)
+        if walk_dt > until:
+            return
+        if walk_dt > after and weekdays & (1 << walk_dt.weekday()):
+            yield walk_dt
+        day += timedelta(days=1)
+
+def materialize_templates(now=None, template_id=None):
+    """Разворачивает шаблоны в предложения на TEMPLATE_HORIZON вперёд и рассылает карточки.
+
+    Каждый шаблон помнит, до какого момента уже развёрнут, поэтому отменённый
+    или удалённый экземпляр не создаётся заново.
+    """
+    now = now or clock.now()
+    horizon = now + timedelta(seconds=TEMPLATE_HORIZON)
+    horizon_str = horizon.strftime('%Y-%m-%d %H:%M:%S')
+    created = []
+    generation = proposal_cache.generation
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        query = """
+            SELECT id, proposer_id, proposer_name, time_str, weekdays, location, comment, materialized_until
+            FROM walk_templates
+            WHERE active = 1 AND (materialized_until IS NULL OR materialized_until < ?)
+        """
+        params = [horizon_str]
+        if template_id is not None:
+            query += " AND id = ?"
+            params.append(template_id)
+        cursor.execute(query, params)
+        for tid, proposer_id, proposer_name, time_str, weekdays, location, comment, until_str in cursor.fetchall():
+            after = max(now, datetime.strptime(until_str, '%Y-%m-%d %H:%M:%S')) if until_str else now
+            if proposer_id not in unreachable_users:
+                for walk_dt in template_occurrences(time_str, weekdays, after, horizon):
+                    walk_dt_str = walk_dt.strftime('%Y-%m-%d %H:%M:%S')
+                    cursor.execute(
+                        """INSERT OR IGNORE INTO proposals
+                           (proposer_id, proposer_name, time_str, walk_datetime, location, comment, editable, template_id,
+                            timestamp)
+                           VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?)""",
+                        (proposer_id, proposer_name, time_str, walk_dt_str, location, comment, tid,
+                         now.strftime('%Y-%m-%d %H:%M:%S'))
+                    )
+                    if cursor.rowcount:
+                        created.append((cursor.lastrowid, ProposalRecord(
+                            proposer_id, proposer_name, time_str, walk_dt_str, location, comment, walk_dt
+                        )))
+            cursor.execute("UPDATE walk_templates SET materialized_until = ? WHERE id = ?", (horizon_str, tid))
+    for proposal_id, record in created:
+        live_proposals.add(proposal_id)
+        proposal_cache.put(proposal_id, record, generation)
+        update_all_messages_with_details(proposal_id)
+    if created:
+        log_event('templates_materialized', proposals=len(created))
+    return [proposal_id for proposal_id, _ in created]
+
+# === ПОИСК ===
+
+# Маркеры совпадений в snippet(): заменяются на <b></b> после экранирования HTML
+_MATCH_START, _MATCH_END = '\x02', '\x03'
+
+def build_match_query(text):
+    """Строка пользователя → запрос FTS5: все слова, каждое как префикс."""
+    terms = re.findall(r'\w+', text.lower())[:8]
+    return " ".join(f'"{term}"*' for term in terms)
+
+def search_proposals(text, offset=0, limit=SEARCH_PAGE_SIZE):
+    """Возвращает (результаты, есть ли следующая страница).
+
+    Сначала идут предстоящие прогулки, внутри — по релевантности bm25;
+    совпадение в месте весит больше, чем в комментариях.
+    """
+    match = build_match_query(text)
+    if not match:
+        return [], False
+    now = clock.now().strftime('%Y-%m-%d %H:%M:%S')
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT p.id, p.proposer_name, p.time_str, p.walk_datetime, p.location,
+                   snippet(proposal_search, -1, ?, ?, '…', 12)
+            FROM proposal_search
+            JOIN proposals p ON p.id = proposal_search.rowid
+            WHERE proposal_search MATCH ?
+            ORDER BY p.walk_datetime <= ?, bm25(proposal_search, 4.0, 2.0, 1.0)
+            LIMIT ? OFFSET ?
+        """, (_MATCH_START, _MATCH_END, match, now, limit + 1, offset))
+        rows = cursor.fetchall()
+    return rows[:limit], len(rows) > limit
+
+def highlight_snippet(snippet):
+    return html.escape(snippet).replace(_MATCH_START, "<b>").replace(_MATCH_END, "</b>")
+
+# Последний запрос пользователя — для кнопок листания; давно искавшие вытесняются
+last_searches = OrderedDict()
+last_searches_lock = threading.Lock()
+
+def remember_search(user_id, text):
+    with last_searches_lock:
+        last_searches[user_id] = text
+        last_searches.move_to_end(user_id)
+        while len(last_searches) > SEARCH_MEMORY_SIZE:
+            last_searches.popitem(last=False)
+
+def render_search_page(user_id, offset):
+    with last_searches_lock:
+        text = last_searches.get(user_id)
+        if text:
+            last_searches.move_to_end(user_id)
+    if not text:
+        return "🔎 Запрос устарел, повторите поиск: /search слова", None
+    rows, has_more = search_proposals(text, offset)
+    if not rows:
+        return (f"🔎 По запросу «{html.escape(text)}» ничего не нашлось." if not offset
+                else "🔎 Больше результатов нет."), None
+    now = clock.now()
+    lines = [f"🔎 <b>{html.escape(text)}</b> — результаты {offset + 1}–{offset + len(rows)}:"]
+    markup = types.InlineKeyboardMarkup()
+    for pid, proposer_name, time_str, walk_dt_str, location, snippet in rows:
+        walk_dt = datetime.strptime(walk_dt_str, '%Y-%m-%d %H:%M:%S')
+        past = " (прошла)" if walk_dt <= now else ""
+        lines.append(
+            f"\n📅 {time_str}, {format_walk_date(walk_dt)}{past} — {html.escape(location or '—')}\n"
+            f"👤 {html.escape(proposer_name)}: {highlight_snippet(snippet)}"
+        )
+        if not past:
+            markup.add(types.InlineKeyboardButton(f"🗳️ {time_str}, {location}"[:60], callback_data=f"resend_proposal_{pid}"))
+    navigation = []
+    if offset:
+        navigation.append(types.InlineKeyboardButton("⬅️", callback_data=f"search_page_{max(0, offset - SEARCH_PAGE_SIZE)}"))
+    if has_more:
+        navigation.append(types.InlineKeyboardButton("➡️", callback_data=f"search_page_{offset + SEARCH_PAGE_SIZE}"))
+    if navigation:
+        markup.row(*navigation)
+    return "\n".join(lines), markup
+
+# === ГЕОМЕТКИ ===
+
+def geocell(lat, lon):
+    return f"{math.floor(lat / GEO_CELL_SIZE)}:{math.floor(lon / GEO_CELL_SIZE)}"
+
+def distance_km(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi, dlambda = phi2 - phi1, math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * 6371.0 * math.asin(math.sqrt(a))
+
+def neighbor_cells(lat, lon, radius_km):
+    """Ячейки сетки, которые может задеть круг радиуса radius_km вокруг точки."""
+    dlat = radius_km / 111.32
+    dlon = radius_km / (111.32 * max(math.cos(math.radians(lat)), 0.01))
+    rows = range(math.floor((lat - dlat) / GEO_CELL_SIZE), math.floor((lat + dlat) / GEO_CELL_SIZE) + 1)
+    cols = range(math.floor((lon - dlon) / GEO_CELL_SIZE), math.floor((lon + dlon) / GEO_CELL_SIZE) + 1)
+    return [f"{row}:{col}" for row in rows for col in cols]
+
+def find_walks_near(lat, lon, radius_km=NEAR_RADIUS_KM, limit=NEAR_RESULTS):
+    """Предстоящие прогулки с геометкой в радиусе: (расстояние, id, время, дата, место, автор).
+
+    Индекс (geocell, walk_datetime) отсекает всё, кроме соседних ячеек и будущих
+    прогулок, поэтому архив на скорость не влияет. Сортировка — по расстоянию
+    с поправкой на время ожидания (NEAR_KM_PER_HOUR).
+    """
+    now = clock.now()
+    cells = neighbor_cells(lat, lon, radius_km)
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT id, time_str, walk_datetime, location, proposer_name, lat, lon
+            FROM proposals
+            WHERE geocell IN ({','.join('?' * len(cells))}) AND walk_datetime > ?
+        """, (*cells, now.strftime('%Y-%m-%d %H:%M:%S')))
+        rows = cursor.fetchall()
+    found = []
+    for pid, time_str, walk_dt_str, location, proposer_name, p_lat, p_lon in rows:
+        distance = distance_km(lat, lon, p_lat, p_lon)
+        if distance > radius_km:
+            continue
+        walk_dt = datetime.strptime(walk_dt_str, '%Y-%m-%d %H:%M:%S')
+        hours = (walk_dt - now).total_seconds() / 3600
+        found.append((distance + NEAR_KM_PER_HOUR * hours, distance, pid, time_str, walk_dt, location, proposer_name))
+    found.sort()
+    return [item[1:] for item in found[:limit]]
+
+def location_from_message(message):
+    """(текст места, (lat, lon)) из геопозиции или точки на карте; None, если это не геопозиция."""
+    if message.venue:
+        title = message.venue.title or message.venue.address or "Точка на карте"
+        return title, (message.venue.location.latitude, message.venue.location.longitude)
+    if message.location:
+        return "Точка на карте", (message.location.latitude, message.location.longitude)
+    return None
+
+def save_user_location(user_id, lat, lon):
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE users SET lat = ?, lon = ? WHERE user_id = ?", (lat, lon, user_id))
+    subscription_index.set_home(user_id, lat, lon)
+    shard_bus.publish('user', user_id)
+
+# === КЛАВИАТУРЫ ===
+
+# Подписи кнопок меню: нажатие посреди диалога отменяет ожидание ввода, а не попадает в ответ
+MENU_LABELS = frozenset({
+    "Прогулки", "Настройки", "Помощь", "Назад",
+    "Предложить время", "Мои предложения", "Текущие прогулки", "Рядом со мной", "Поиск",
+    "Напоминания", "Фильтры", "Сводка", "Очистить старые",
+})
+
+def is_menu_command(text):
+    return text.startswith('/') or text in MENU_LABELS
+
+def main_menu():
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    markup.add("Прогулки", "Настройки")
+    markup.add("Помощь")
+    return markup
 
 def walks_menu():
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=1)
     markup.add("Предложить время")
     markup.add("Мои предложения")
     markup.add("Текущие прогулки")
+    markup.add(types.KeyboardButton("Рядом со мной", request_location=True))
+    markup.add("Поиск")
     markup.add("Назад")
     return markup
 
 def settings_menu():
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=1)
     markup.add("Напоминания")
+    markup.add("Фильтры")
+    markup.add("Сводка")
     markup.add("Очистить старые")
     markup.add("Назад")
     return markup
 
-def update_all_messages_with_details(proposal_id, proposer_name, time_str, location="", base_comment=""):
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT walk_datetime FROM proposals WHERE id = ?", (proposal_id,))
-        row = cursor.fetchone()
-        if not row:
-            return
-        walk_dt_str = row[0]
-    walk_datetime = datetime.strptime(walk_dt_str, '%Y-%m-%d %H:%M:%S')
-    date_str = format_walk_date(walk_datetime)
-    full_time_display = f"{time_str}, {date_str}"
-    votes = get_votes(proposal_id)
-    user_comments = get_comments(proposal_id)
-
-    def format_name_with_comment(name):
-        comment = user_comments.get(name, "")
-        return f"{name} — {comment}" if comment else name
-
-    yes_list = "\n".join([f"• {format_name_with_comment(name)}" for name in votes['yes']]) or "Пока никто"
-    later_list = "\n".join([f"• {format_name_with_comment(name)}" for name in votes['later']]) or "Никто не отметил"
-    no_list = "\n".join([f"• {name}" for name in votes['no']]) or "Все ещё в раздумьях"
-
-    text = f"📅 <b>Прогулка: {full_time_display}</b>\n"
+# === КАРТОЧКИ ===
+
+VOTE_BUTTONS = (
+    ("✅ Выйду гулять", 'yes'),
+    ("🕗 Выйду позже", 'later'),
+    ("❌ Не пойду", 'no'),
+)
+
+class CardModel:
+    """Голоса и комментарии одного предложения плюс собранные из них фрагменты текста."""
+
+    __slots__ = ('votes', 'comments', 'lists', 'header_key', 'header', 'card_text')
+
+    def __init__(self, votes, comments):
+        self.votes = votes  # voter_id -> [имя, тип голоса], в порядке первого голоса
+        self.comments = comments  # имя -> комментарий
+        self.lists = None
+        self.header_key = None
+        self.header = None
+        self.card_text = None
+
+    def changed(self):
+        self.lists = None
+        self.card_text = None
+
+    def get_lists(self):
+        if self.lists is None:
+            names = {'yes': [], 'later': [], 'no': []}
+            for name, vote_type in self.votes.values():
+                names[vote_type].append(name)
+
+            def with_comment(name):
+                comment = self.comments.get(name, "")
+                return f"{name} — {comment}" if comment else name
+
+            self.lists = {
+                'names': names,
+                'yes': [with_comment(name) for name in names['yes']],
+                'later': [with_comment(name) for name in names['later']],
+                'no': list(names['no']),
+            }
+        return self.lists
+
+class CardRenderer:
+    """Единая сборка карточек предложения.
+
+    Держит в памяти голоса и комментарии активных предложений; add_vote и
+    save_comment передают сюда изменения, поэтому повторная отрисовка после
+    голоса не обращается к базе. Собранный текст и клавиатура переиспользуются
+    для всех получателей, пока не придёт следующее изменение.
+    """
+
+    def __init__(self, capacity=PROPOSAL_CACHE_SIZE):
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._models = OrderedDict()
+        self._markups = {}
+        self._generation = 0
+
+    def _load(self, proposal_id):
+        with self._lock:
+            model = self._models.get(proposal_id)
+            if model is not None:
+                self._models.move_to_end(proposal_id)
+                return model
+            generation = self._generation
+        with db_connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT voter_id, voter_name, vote_type FROM votes WHERE proposal_id = ? ORDER BY rowid",
+                (proposal_id,)
+            )
+            votes = OrderedDict(
+                (voter_id, [name, vote_type]) for voter_id, name, vote_type in cursor.fetchall()
+                if vote_type in ('yes', 'later', 'no')
+            )
+            cursor.execute("SELECT user_name, comment FROM comments WHERE proposal_id = ?", (proposal_id,))
+            comments = {user_name: comment for user_name, comment in cursor.fetchall()}
+        model = CardModel(votes, comments)
+        with self._lock:
+            # Пока читали базу, могли прийти изменения — такую модель не кэшируем
+            if generation == self._generation and proposal_id not in self._models:
+                self._models[proposal_id] = model
+                while len(self._models) > self.capacity:
+                    evicted, _ = self._models.popitem(last=False)
+                    self._markups.pop(evicted, None)
+        return model
+
+    def apply_vote(self, proposal_id, voter_id, voter_name, vote_type):
+        with self._lock:
+            self._generation += 1
+            model = self._models.get(proposal_id)
+            if model is None:
+                return
+            if voter_id in model.votes:
+                model.votes[voter_id][:] = [voter_name, vote_type]
+            else:
+                model.votes[voter_id] = [voter_name, vote_type]
+            model.changed()
+
+    def apply_comment(self, proposal_id, user_name, comment):
+        with self._lock:
+            self._generation += 1
+            model = self._models.get(proposal_id)
+            if model is None:
+                return
+            model.comments[user_name] = comment
+            model.changed()
+
+    def forget(self, *proposal_ids):
+        with self._lock:
+            self._generation += 1
+            for proposal_id in proposal_ids:
+                self._models.pop(proposal_id, None)
+                self._markups.pop(proposal_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._models.clear()
+            self._markups.clear()
+
+    def vote_names(self, proposal_id):
+        """{'yes': [...], 'later': [...], 'no': [...]} — как get_votes(), но из памяти."""
+        model = self._load(proposal_id)
+        with self._lock:
+            return {k: list(v) for k, v in model.get_lists()['names'].items()}
+
+    def voter_ids(self, proposal_id, vote_type):
+        model = self._load(proposal_id)
+        with self._lock:
+            return [voter_id for voter_id, (_, vtype) in model.votes.items() if vtype == vote_type]
+
+    def markup(self, proposal_id):
+        markup = self._markups.get(proposal_id)
+        if markup is None:
+            markup = types.InlineKeyboardMarkup()
+            (yes_text, yes), (later_text, later), (no_text, no) = VOTE_BUTTONS
+            markup.add(
+                types.InlineKeyboardButton(yes_text, callback_data=f"vote_{yes}_{proposal_id}"),
+                types.InlineKeyboardButton(later_text, callback_data=f"vote_{later}_{proposal_id}")
+            )
+            markup.add(types.InlineKeyboardButton(no_text, callback_data=f"vote_{no}_{proposal_id}"))
+            self._markups[proposal_id] = markup
+        return markup
+
+    def render_card(self, proposal_id):
+        """Текст карточки с голосованием и её клавиатура; None, если предложения нет."""
+        record = get_proposal(proposal_id)
+        if not record:
+            return None
+        model = self._load(proposal_id)
+        date_str = format_walk_date(record.walk_dt)
+        with self._lock:
+            header_key = (record, date_str)
+            if model.header_key != header_key:
+                header = f"📅 <b>Прогулка: {record.time_str}, {date_str}</b>\n"
+                if record.location:
+                    header += f"📍 <b>Место:</b> {record.location}\n"
+                if record.lat is not None:
+                    header += f"🗺️ <a href=\"https://maps.google.com/?q={record.lat:.6f},{record.lon:.6f}\">На карте</a>\n"
+                if record.comment:
+                    header += f"💬 <b>От автора:</b> {record.comment}\n"
+                header += f"\nОт: {record.proposer_name}\n"
+                model.header_key, model.header, model.card_text = header_key, header, None
+            if model.card_text is None:
+                lists = model.get_lists()
+                yes_list = "\n".join(f"• {name}" for name in lists['yes']) or "Пока никто"
+                later_list = "\n".join(f"• {name}" for name in lists['later']) or "Никто не отметил"
+                no_list = "\n".join(f"• {name}" for name in lists['no']) or "Все ещё в раздумьях"
+                model.card_text = (
+                    model.header
+                    + f"✅ <b>Выйду гулять:</b>\n{yes_list}\n"
+                    + f"🕗 <b>Выйду позже:</b>\n{later_list}\n"
+                    + f"❌ <b>Не пойду:</b>\n{no_list}"
+                )
+            text = model.card_text
+        return text, self.markup(proposal_id)
+
+    def render_owner_summary(self, proposal_id, time_str, walk_dt, location, comment):
+        """Сводка для автора в «Мои предложения»: списки с числом участников."""
+        model = self._load(proposal_id)
+        with self._lock:
+            lists = model.get_lists()
+            yes_list, later_list, no_list = lists['yes'], lists['later'], lists['no']
+            text = f"📅 <b>{time_str}, {format_walk_date(walk_dt)}</b>\n"
+            if location:
+                text += f"📍 <b>Место:</b> {location}\n"
+            if comment:
+                text += f"💬 <b>От вас:</b> {comment}\n"
+            text += "\n"
+            text += f"✅ <b>Идут сейчас:</b> ({len(yes_list)})\n"
+            text += "\n".join(f"• {name}" for name in yes_list) if yes_list else "Пока никто"
+            text += "\n"
+            text += f"🕗 <b>Выйдут позже:</b> ({len(later_list)})\n"
+            text += "\n".join(f"• {name}" for name in later_list) if later_list else "Никто не отметил"
+            text += "\n"
+            text += f"❌ <b>Не пойдут:</b> ({len(no_list)})\n"
+            text += "\n".join(f"• {name}" for name in no_list) if no_list else "Все ещё в раздумьях"
+        return text
+
+card_renderer = CardRenderer()
+
+def update_all_messages_with_details(proposal_id):
+    record = get_proposal(proposal_id)
+    if not record:
+        return
+
+    # Карточку получают подписчики по фильтрам, автор и все, у кого она уже есть
+    known_messages = dict(get_all_message_ids_for_proposal(proposal_id))
+    coords = (record.lat, record.lon) if record.lat is not None else None
+    recipients = subscription_index.match(record.walk_dt, record.location, record.proposer_id, coords)
+    recipients.add(record.proposer_id)
+    recipients.update(known_messages)
+    if broadcasts_paused.is_set():
+        defer_broadcast(proposal_id)
+        return
+    stats = new_broadcast_stats('card', proposal_id, 'sendMessage/editMessageText')
+    skipped = recipients & unreachable_users
+    stats['skipped'] = len(skipped)
+    targets = recipients - skipped
+    # Автор видит свою карточку сразу, остальные в режиме сводки — в ближайшей сводке
+    digest_targets = {user_id for user_id in targets if user_id in digest_users and user_id != record.proposer_id}
+    if digest_targets:
+        queue_digest_events(proposal_id, record.walk_dt, [
+            (user_id, 'update' if user_id in known_messages else 'new') for user_id in digest_targets
+        ])
+        stats['digested'] = len(digest_targets)
+        targets -= digest_targets
+    # Текст карточки соберётся в момент отправки каждому — очередь доставки решает, когда
+    delivery_scheduler.fanout(stats, [
+        DeliveryJob(DELIVERY_EDIT if user_id in known_messages else DELIVERY_CARD, user_id, proposal_id,
+                    message_id=known_messages.get(user_id), walk_dt=record.walk_dt,
+                    quiet=user_id != record.proposer_id)
+        for user_id in targets
+    ])
+
+# === ЗАВЕРШЁННЫЕ КАРТОЧКИ ===
+
+def final_card_text(time_str, walk_dt, location, going):
+    text = f"🏁 <b>Прогулка {time_str}, {walk_dt.day} {MONTH_NAMES.get(walk_dt.month, walk_dt.month)} — завершено</b>\n"
     if location:
-        text += f"📍 <b>Место:</b> {location}\n"
-    if base_comment:
-        text += f"💬 <b>От автора:</b> {base_comment}\n"
-    text += f"\nОт: {proposer_name}\n"
-    text += f"✅ <b>Выйду гулять:</b>\n{yes_list}\n"
-    text += f"🕗 <b>Выйду позже:</b>\n{later_list}\n"
-    text += f"❌ <b>Не пойду:</b>\n{no_list}"
+        text += f"📍 {location}\n"
+    text += f"✅ Ходили: {going}" if going else "Никто не отметился"
+    return text
 
-    markup = types.InlineKeyboardMarkup()
-    markup.add(
-        types.InlineKeyboardButton("✅ Выйду гулять", callback_data=f"vote_yes_{proposal_id}"),
-        types.InlineKeyboardButton("🕗 Выйду позже", callback_data=f"vote_later_{proposal_id}")
-    )
-    markup.add(
-        types.InlineKeyboardButton("❌ Не пойду", callback_data=f"vote_no_{proposal_id}")
-    )
+class CardFinalizer:
+    """Переводит разосланные карточки удалённых предложений в состояние «завершено».
 
-    users = get_all_users()
-    for user_id, first_name, username in users:
-        try:
-            msg_id = get_message_id(user_id, proposal_id)
-            if msg_id:
+    delete_proposals() в своей транзакции перекладывает ссылки на карточки в
+    stale_cards вместе с финальным текстом. Поток ведущего экземпляра снимает
+    с них кнопки пачками; каждая правка ждёт очереди в delivery_scheduler как
+    DELIVERY_EDIT, так что уборка расходует только бюджет сверх резерва и не
+    отнимает лимит API у рассылок и напоминаний.
+    """
+
+    def __init__(self, batch=STALE_CARDS_BATCH):
+        self.batch = batch
+        self.pending = 0  # строк в очереди при последней выборке
+        self.counters = {'edited': 0, 'failed': 0}
+
+    def queue(self, cursor, where, params=()):
+        cursor.execute(f"""
+            SELECT id, time_str, walk_datetime, location,
+                   (SELECT COUNT(*) FROM votes WHERE proposal_id = proposals.id AND vote_type = 'yes')
+            FROM proposals
+            WHERE ({where})
+              AND EXISTS (SELECT 1 FROM user_proposal_messages WHERE proposal_id = proposals.id)
+        """, params)
+        texts = [
+            (final_card_text(time_str, datetime.strptime(walk_dt_str, '%Y-%m-%d %H:%M:%S'), location, going), pid)
+            for pid, time_str, walk_dt_str, location, going in cursor.fetchall()
+        ]
+        cursor.executemany("""
+            INSERT OR IGNORE INTO stale_cards (user_id, message_id, text)
+            SELECT user_id, message_id, ? FROM user_proposal_messages WHERE proposal_id = ?
+        """, texts)
+
+    def run_batch(self):
+        """Одна пачка правок; возвращает число строк, снятых с очереди."""
+        with db_connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM stale_cards")
+            self.pending = cursor.fetchone()[0]
+            cursor.execute(
+                "SELECT rowid, user_id, message_id, text FROM stale_cards ORDER BY rowid LIMIT ?", (self.batch,)
+            )
+            rows = cursor.fetchall()
+        if not rows:
+            return 0
+        stats = new_broadcast_stats('finalize', None, 'editMessageText')
+        done = []
+        for rowid, user_id, message_id, text in rows:
+            if broadcasts_paused.is_set():
+                break
+            if user_id in unreachable_users:
+                stats['skipped'] += 1
+                done.append(rowid)
+                continue
+            try:
+                delivery_scheduler.call(DELIVERY_EDIT, lambda: bot.edit_message_text(
+                    text, chat_id=user_id, message_id=message_id, parse_mode='HTML'
+                ))
+                stats['edited'] += 1
+            except Exception as e:
+                record_delivery_failure(user_id, e, stats)
+                # 400 (сообщение удалено или слишком старое) не исправится; перегрузку и сеть — повторим позже
+                retry = not (isinstance(e, apihelper.ApiTelegramException) and e.error_code in (400, 403))
+                if retry:
+                    break
+            done.append(rowid)
+        if done:
+            with db_connect() as conn:
+                conn.executemany("DELETE FROM stale_cards WHERE rowid = ?", [(rowid,) for rowid in done])
+            self.pending -= len(done)
+        self.counters['edited'] += stats['edited']
+        self.counters['failed'] += stats['failed']
+        report_broadcast(stats)
+        return len(done)
+
+    def run(self):
+        while True:
+            processed = 0
+            if leader_lease.is_leader() and not broadcasts_paused.is_set():
                 try:
-                    bot.edit_message_text(
-                        chat_id=user_id,
-                        message_id=msg_id,
-                        text=text,
-                        reply_markup=markup,
-                        parse_mode='HTML'
-                    )
-                except apihelper.ApiTelegramException as e:
-                    if "message is not modified" in str(e):
-                        pass
+                    processed = self.run_batch()
+                except Exception as e:
+                    log_event('finalizer_error', logging.ERROR, **error_fields(e))
+            if not processed:
+                clock.sleep(REMINDER_CHECK_INTERVAL)
+
+card_finalizer = CardFinalizer()
+
+# === ОЧЕРЕДЬ ДОСТАВКИ ===
+
+DELIVERY_REMINDER, DELIVERY_CONFIRMATION, DELIVERY_CARD, DELIVERY_EDIT = range(4)
+DELIVERY_NAMES = ('напоминания', 'подтверждения', 'новые карточки', 'правки')
+
+# Тихие часы: user_id → (с какого часа, до какого часа); новые карточки в это время ждут утра
+quiet_hours = {}
+
+def load_quiet_hours():
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id, quiet_from, quiet_to FROM user_settings WHERE quiet_from IS NOT NULL")
+        hours = {user_id: (start, end) for user_id, start, end in cursor.fetchall()}
+    quiet_hours.clear()
+    quiet_hours.update(hours)
+
+def set_quiet_hours(user_id, hours):
+    """hours — (с, до) в часах 0–23 или None, чтобы отключить."""
+    start, end = hours or (None, None)
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO user_settings (user_id, quiet_from, quiet_to) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET quiet_from = ?, quiet_to = ?",
+            (user_id, start, end, start, end)
+        )
+    if hours:
+        quiet_hours[user_id] = hours
+    else:
+        quiet_hours.pop(user_id, None)
+    shard_bus.publish('user', user_id)
+
+def quiet_until(user_id, now):
+    """Конец тихих часов пользователя, если они идут сейчас; иначе None."""
+    hours = quiet_hours.get(user_id)
+    if not hours:
+        return None
+    start, end = hours
+    inside = start <= now.hour < end if start < end else (now.hour >= start or now.hour < end)
+    if not inside:
+        return None
+    until = now.replace(hour=end, minute=0, second=0, microsecond=0)
+    if until <= now:
+        until += timedelta(days=1)
+    return until
+
+class DeliveryJob:
+    """Одно исходящее сообщение: карточка предложения, готовый текст или вызов API целиком."""
+
+    __slots__ = ('priority', 'user_id', 'proposal_id', 'message_id', 'text', 'markup', 'fn', 'fanout',
+                 'enqueued', 'deadline', 'urgent', 'not_before', 'silent', 'taken', 'again', 'done')
+
+    def __init__(self, priority, user_id=None, proposal_id=None, message_id=None, text=None, markup=None,
+                 fn=None, fanout=None, walk_dt=None, quiet=True):
+        self.priority = priority
+        self.user_id = user_id
+        self.proposal_id = proposal_id
+        self.message_id = message_id
+        self.text = text
+        self.markup = markup
+        self.fn = fn
+        self.fanout = fanout
+        self.enqueued = time.monotonic()
+        self.deadline = self.enqueued + DELIVERY_SLACK[priority]
+        self.urgent = priority <= DELIVERY_CONFIRMATION
+        self.not_before = None
+        self.silent = False
+        self.taken = False
+        self.again = False
+        self.done = None
+        if walk_dt is not None:
+            until_walk = (walk_dt - clock.now()).total_seconds()
+            self.deadline = min(self.deadline, self.enqueued + max(0.0, until_walk))
+            self.urgent = self.urgent or until_walk < DELIVERY_URGENT_WINDOW
+            if priority == DELIVERY_CARD and quiet and user_id is not None:
+                until = quiet_until(user_id, clock.now())
+                if until:
+                    wait = (until - clock.now()).total_seconds()
+                    if wait < until_walk:
+                        self.not_before = self.enqueued + wait
+                        self.deadline = self.not_before + DELIVERY_SLACK[priority]
                     else:
-                        print(f"Ошибка при редактировании для {user_id}: {e}")
+                        # Прогулка раньше конца тихих часов — карточка приходит сейчас, но без звука
+                        self.silent = True
+
+    @property
+    def card_key(self):
+        if self.proposal_id is not None and self.text is None and self.fn is None:
+            return (self.user_id, self.proposal_id)
+        return None
+
+class DeliveryScheduler:
+    """Очередь исходящих сообщений по срочности.
+
+    Порядок — по сроку доставки: момент постановки плюс допустимая задержка
+    класса (DELIVERY_SLACK), но не позже начала прогулки. Напоминания,
+    подтверждения и всё о прогулке в ближайший DELIVERY_URGENT_WINDOW идут
+    раньше прочего. Отправки ограничены ведром токенов на DELIVERY_RATE в
+    секунду; несрочным достаётся только бюджет сверх резерва, так что большая
+    рассылка растягивается во времени, а напоминание не ждёт её конца.
+
+    Карточка собирается в момент отправки, поэтому повторная рассылка той же
+    карточки тому же человеку, пока первая ещё в очереди, не ставится. Новые
+    карточки в тихие часы получателя откладываются до их конца. До start()
+    задания выполняются сразу в вызывающем потоке.
+    """
+
+    def __init__(self, workers=DELIVERY_WORKERS, rate=DELIVERY_RATE, reserve=DELIVERY_URGENT_RESERVE):
+        self.workers = workers
+        self.rate = rate
+        self.reserve = reserve * rate
+        self.started = False
+        self._cond = threading.Condition()
+        self._heap = []
+        self._delayed = []
+        self._seq = itertools.count()
+        self._cards = {}  # (user_id, proposal_id) → задание в очереди или в работе
+        self._tokens = float(rate)
+        self._refilled = time.monotonic()
+        self.latency = [deque(maxlen=DELIVERY_LATENCY_SAMPLES) for _ in DELIVERY_NAMES]
+        self.counters = {'done': 0, 'coalesced': 0, 'quiet': 0}
+        # Внешний пул потоков (tenants.py): вызывается, когда появилась работа для poll()
+        self.on_ready = None
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"delivery-{i}", daemon=True).start()
+        self.started = True
+
+    def submit(self, job):
+        """Ставит задание в очередь; False — такая карточка уже ждёт отправки."""
+        if not self.started:
+            self._run(job)
+            self._finish(job)
+            return True
+        with self._cond:
+            key = job.card_key
+            if key:
+                queued = self._cards.get(key)
+                if queued is not None:
+                    # Уже взятую в работу карточку после отправки поправим ещё раз — текст мог устареть
+                    queued.again = queued.again or queued.taken
+                    self.counters['coalesced'] += 1
+                    return False
+                self._cards[key] = job
+            if job.not_before:
+                self.counters['quiet'] += 1
+                heapq.heappush(self._delayed, (job.not_before, next(self._seq), job))
             else:
+                heapq.heappush(self._heap, (not job.urgent, job.deadline, next(self._seq), job))
+            self._cond.notify()
+        if self.on_ready:
+            self.on_ready()
+        return True
+
+    def call(self, priority, fn, walk_dt=None):
+        """Дожидается очереди с приоритетом priority и выполняет вызов API в своём потоке.
+
+        Поток доставки только отдаёт очередь и не ждёт ответа API, поэтому
+        планировщик, ждущий здесь, не занимает рабочий поток.
+        """
+        if not self.started:
+            return fn()
+        job = DeliveryJob(priority, fn=fn, walk_dt=walk_dt)
+        job.done = threading.Event()
+        self.submit(job)
+        job.done.wait()
+        return fn()
+
+    def poll(self):
+        """(задание, None) или (None, сколько секунд ждать до следующего; None — пока не поставят)."""
+        with self._cond:
+            return self._poll_locked()
+
+    def _poll_locked(self):
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, job = heapq.heappop(self._delayed)
+            heapq.heappush(self._heap, (not job.urgent, job.deadline, next(self._seq), job))
+        self._tokens = min(float(self.rate), self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        timeout = self._delayed[0][0] - now if self._delayed else None
+        if self._heap:
+            not_urgent, _, _, job = self._heap[0]
+            need = 1 + self.reserve if not_urgent else 1
+            if self._tokens >= need:
+                heapq.heappop(self._heap)
+                self._tokens -= 1
+                job.taken = True
+                return job, None
+            wait = (need - self._tokens) / self.rate
+            timeout = wait if timeout is None else min(timeout, wait)
+        return None, timeout
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job, timeout = self._poll_locked()
+                while job is None:
+                    self._cond.wait(timeout)
+                    job, timeout = self._poll_locked()
+            self.execute(job)
+
+    def execute(self, job):
+        try:
+            self._run(job)
+        except Exception as e:
+            log_event('delivery_error', logging.ERROR, **error_fields(e))
+        with self._cond:
+            if job.card_key:
+                self._cards.pop(job.card_key, None)
+            again = job.again
+        if again:
+            # Повтор засчитывается в ту же рассылку и завершит её сам
+            retry = DeliveryJob(DELIVERY_EDIT, job.user_id, job.proposal_id, fanout=job.fanout)
+            if self.submit(retry):
+                return
+        self._finish(job)
+
+    def _run(self, job):
+        try:
+            if job.fn is not None:
+                # Вызов выполнит сам call(): здесь ему только подошла очередь
+                return
+            stats = job.fanout['stats']
+            if job.user_id in unreachable_users:
+                stats['skipped'] += 1
+            elif job.text is not None:
                 try:
-                    sent = bot.send_message(user_id, text, reply_markup=markup, parse_mode='HTML')
-                    save_message_id(user_id, proposal_id, sent.message_id)
+                    bot.send_message(job.user_id, job.text, reply_markup=job.markup, parse_mode='HTML')
+                    stats['sent'] += 1
                 except Exception as e:
-                    print(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+                    record_delivery_failure(job.user_id, e, stats)
+            elif broadcasts_paused.is_set():
+                # Доставленным повтор придёт правкой, остальным — новой карточкой
+                defer_broadcast(job.proposal_id)
+                stats['deferred'] = True
+            else:
+                self._send_card(job, stats)
+        finally:
+            with self._cond:
+                self.counters['done'] += 1
+                self.latency[job.priority].append(time.monotonic() - job.enqueued)
+            if job.done is not None:
+                job.done.set()
+
+    def _finish(self, job):
+        """Засчитывает задание в его рассылку; последнее пишет итог в журнал."""
+        if job.fanout is None:
+            return
+        with self._cond:
+            job.fanout['left'] -= 1
+            finished = job.fanout['left'] == 0
+        track_broadcast(pending=-1)
+        if finished:
+            track_broadcast(active=-1)
+            report_broadcast(job.fanout['stats'])
+
+    def _send_card(self, job, stats):
+        rendered = card_renderer.render_card(job.proposal_id)
+        if not rendered:
+            return
+        text, markup = rendered
+        # Новая карточка могла уйти, пока задание ждало: тогда правим её, а не шлём вторую
+        msg_id = job.message_id or get_message_id(job.user_id, job.proposal_id)
+        try:
+            if msg_id:
+                bot.edit_message_text(
+                    chat_id=job.user_id,
+                    message_id=msg_id,
+                    text=text,
+                    reply_markup=markup,
+                    parse_mode='HTML'
+                )
+                stats['edited'] += 1
+            else:
+                sent = bot.send_message(job.user_id, text, reply_markup=markup, parse_mode='HTML',
+                                        disable_notification=job.silent or None)
+                save_message_id(job.user_id, job.proposal_id, sent.message_id)
+                stats['sent'] += 1
+        except Exception as e:
+            record_delivery_failure(job.user_id, e, stats)
+
+    def fanout(self, stats, jobs):
+        """Ставит задания одной рассылки; отчёт report_broadcast() — когда выполнится последнее."""
+        fanout = {'stats': stats, 'left': 0}
+        for job in jobs:
+            job.fanout = fanout
+            fanout['left'] += 1
+        if not fanout['left']:
+            report_broadcast(stats)
+            return
+        track_broadcast(active=1, pending=fanout['left'])
+        for job in jobs:
+            if not self.submit(job):
+                self._finish(job)
+
+    def snapshot(self):
+        with self._cond:
+            samples = [sorted(latency) for latency in self.latency]
+            queued, delayed = len(self._heap), len(self._delayed)
+            counters = dict(self.counters)
+
+        def pct(values, q):
+            return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+        return {
+            'queued': queued,
+            'delayed': delayed,
+            'p50_ms': [round(pct(v, 0.5) * 1000) for v in samples],
+            'p95_ms': [round(pct(v, 0.95) * 1000) for v in samples],
+            **counters,
+        }
+
+delivery_scheduler = DeliveryScheduler()
+
+# === СВОДКИ ===
+
+# Пользователи в режиме сводки: user_id → интервал между сводками в минутах
+digest_users = {}
+
+def load_digest_users():
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id, digest_minutes FROM user_settings WHERE digest_minutes > 0")
+        modes = dict(cursor.fetchall())
+    digest_users.clear()
+    digest_users.update(modes)
+
+def set_digest_minutes(user_id, minutes):
+    """0 — получать всё сразу. Накопленное к этому моменту придёт ближайшим проходом фонового потока."""
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO user_settings (user_id, digest_minutes) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET digest_minutes = ?",
+            (user_id, minutes, minutes)
+        )
+    if minutes:
+        digest_users[user_id] = minutes
+    else:
+        digest_users.pop(user_id, None)
+    shard_bus.publish('user', user_id)
+
+def queue_digest_events(proposal_id, walk_dt, events):
+    """Откладывает события [(user_id, kind)] до сводки.
+
+    Повтор того же события не копится, а лишь снова помечает строку к отправке;
+    created остаётся временем первого события, по нему в сводке отмечаются новинки.
+    """
+    now_str = clock.now().strftime('%Y-%m-%d %H:%M:%S')
+    walk_dt_str = walk_dt.strftime('%Y-%m-%d %H:%M:%S')
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("""
+            INSERT INTO digest_events (user_id, proposal_id, kind, created, walk_datetime) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, proposal_id, kind) DO UPDATE
+            SET flushed = 0, walk_datetime = excluded.walk_datetime
+        """, [(user_id, proposal_id, kind, now_str, walk_dt_str) for user_id, kind in events])
+
+def render_digest(items, fresh):
+    """Текст сводки дня и кнопки. items — {proposal_id: виды событий}, fresh — что появилось с прошлой сводки."""
+    walks = []
+    for pid, kinds in items.items():
+        record = get_proposal(pid)
+        if record:
+            walks.append((record.walk_dt, pid, record, kinds))
+    if not walks:
+        return None, None
+    walks.sort(key=lambda walk: (walk[0], walk[1]))
+    now = clock.now()
+    lines = [f"🗞️ <b>Сводка на {now.day} {MONTH_NAMES[now.month]}</b> (обновлена в {now.strftime('%H:%M')})"]
+    markup = types.InlineKeyboardMarkup()
+    for walk_dt, pid, record, kinds in walks:
+        going = len(card_renderer.vote_names(pid)['yes'])
+        mark = "🆕 " if pid in fresh else ""
+        status = " — ✅ подтверждена" if 'confirmed' in kinds else ""
+        past = " (прошла)" if walk_dt <= now else ""
+        lines.append(
+            f"{mark}📅 {record.time_str}, {format_walk_date(walk_dt)}{past} — 📍 {html.escape(record.location or '—')}"
+            f" (👤 {html.escape(record.proposer_name)}), идут: {going}{status}"
+        )
+        if not past and len(markup.keyboard) < DIGEST_MAX_BUTTONS:
+            markup.add(types.InlineKeyboardButton(
+                f"🗳️ {record.time_str}, {record.location}"[:60], callback_data=f"resend_proposal_{pid}"
+            ))
+    text = "\n".join(lines)
+    if len(text) > 4000:
+        text = text[:4000] + "\n… (обрезано)"
+    return text, markup
+
+def flush_digest(user_id, now, flushed_at):
+    """Правит накопившиеся карточки и отправляет или дополняет сводку дня.
+
+    flushed_at — время прошлой сводки, как его видел вызывающий: сводку собирает
+    тот проход, которому удалось его сменить, поэтому дважды она не уйдёт.
+    """
+    today = now.strftime('%Y-%m-%d')
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE user_settings SET digest_flushed_at = ? WHERE user_id = ? AND digest_flushed_at IS ?",
+            (now.strftime('%Y-%m-%d %H:%M:%S'), user_id, flushed_at)
+        )
+        if not cursor.rowcount:
+            return
+        cursor.execute("SELECT digest_message_id, digest_day FROM user_settings WHERE user_id = ?", (user_id,))
+        message_id, digest_day = cursor.fetchone()
+        if digest_day != today:
+            # Новый день — новое сообщение; вчерашнее остаётся в чате как есть
+            cursor.execute("DELETE FROM digest_events WHERE user_id = ? AND flushed = 1", (user_id,))
+            message_id = None
+        cursor.execute("SELECT proposal_id, kind, flushed, created FROM digest_events WHERE user_id = ?", (user_id,))
+        events = cursor.fetchall()
+        cursor.execute("UPDATE digest_events SET flushed = 1 WHERE user_id = ? AND flushed = 0", (user_id,))
+
+    items, fresh, updates, changed = {}, set(), set(), set()
+    for pid, kind, flushed, created in events:
+        if kind == 'update':
+            if not flushed:
+                updates.add(pid)
+            continue
+        items.setdefault(pid, set()).add(kind)
+        if not flushed:
+            changed.add(pid)
+            if not flushed_at or created > flushed_at:
+                fresh.add(pid)
+
+    def retry_later(pids, updates=False):
+        # События уже помечены отправленными: без сброса они придут, только если появится что-то новое
+        with db_connect() as conn:
+            conn.execute(
+                f"UPDATE digest_events SET flushed = 0 WHERE user_id = ? AND kind {'=' if updates else '!='} 'update' "
+                f"AND proposal_id IN ({','.join('?' * len(pids))})",
+                (user_id, *pids)
+            )
+
+    # Сколько бы голосов ни пришло за интервал, каждая карточка правится один раз
+    failed = []
+    for pid in updates:
+        msg_id = get_message_id(user_id, pid)
+        rendered = card_renderer.render_card(pid) if msg_id else None
+        if not rendered:
+            continue
+        text, markup = rendered
+        try:
+            bot.edit_message_text(chat_id=user_id, message_id=msg_id, text=text, reply_markup=markup, parse_mode='HTML')
+        except Exception as e:
+            status = record_delivery_failure(user_id, e, proposal_id=pid, api_method='editMessageText', kind='digest')
+            if status in UNREACHABLE_STATUSES:
+                return
+            if status == 'transient':
+                failed.append(pid)
+    if failed:
+        retry_later(failed, updates=True)
+    if not changed:
+        return
+    text, markup = render_digest(items, fresh)
+    if not text:
+        return
+
+    if message_id:
+        try:
+            bot.edit_message_text(chat_id=user_id, message_id=message_id, text=text, reply_markup=markup, parse_mode='HTML')
+            return
+        except Exception as e:
+            status = classify_delivery_error(e)
+            if status == 'not_modified':
+                return
+            # 400 — сообщение удалено или слишком старое для правки: пришлём новое
+            if not (isinstance(e, apihelper.ApiTelegramException) and e.error_code == 400):
+                if record_delivery_failure(user_id, e, api_method='editMessageText', kind='digest') == 'transient':
+                    retry_later(changed)
+                return
+    try:
+        sent = bot.send_message(user_id, text, reply_markup=markup, parse_mode='HTML')
+    except Exception as e:
+        if record_delivery_failure(user_id, e, api_method='sendMessage', kind='digest') == 'transient':
+            retry_later(changed)
+        return
+    with db_connect() as conn:
+        conn.execute(
+            "UPDATE user_settings SET digest_message_id = ?, digest_day = ? WHERE user_id = ?",
+            (sent.message_id, today, user_id)
+        )
+
+def flush_digests(now):
+    """Отправляет созревшие сводки: прошёл интервал пользователя или скоро одна из прогулок в сводке.
+
+    Пользователи, отключившие режим сводки, получают накопленное сразу.
+    """
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT e.user_id, MIN(e.walk_datetime), s.digest_flushed_at
+            FROM digest_events e
+            LEFT JOIN user_settings s ON s.user_id = e.user_id
+            WHERE e.flushed = 0
+            GROUP BY e.user_id
+        """)
+        pending = cursor.fetchall()
+    soon = (now + timedelta(seconds=DIGEST_WALK_LEAD)).strftime('%Y-%m-%d %H:%M:%S')
+    flushed = 0
+    for user_id, first_walk, flushed_at in pending:
+        minutes = digest_users.get(user_id)
+        if minutes and flushed_at and first_walk > soon:
+            if now < datetime.strptime(flushed_at, '%Y-%m-%d %H:%M:%S') + timedelta(minutes=minutes):
+                continue
+        if user_id in unreachable_users:
+            continue
+        try:
+            flush_digest(user_id, now, flushed_at)
+            flushed += 1
         except Exception as e:
-            print(f"Не удалось обработать сообщение для {user_id}: {e}")
+            log_event('digest_failed', logging.ERROR, user_id=user_id, **error_fields(e))
+    if flushed:
+        log_event('digests_flushed', users=flushed, pending=len(pending))
 
 # === ВВОД ДАННЫХ ===
 
@@ -445,17 +2781,7 @@ def process_time_input_from_button(message):
         bot.send_message(message.chat.id, "❌ Я принимаю только текст. Пожалуйста, введите время в формате ЧЧ:ММ.")
         return
 
-    if message.text.startswith('/') or message.text in [
-        "Предложить время",
-        "Мои предложения",
-        "Текущие прогулки",
-        "Назад",
-        "Напоминания",
-        "Очистить старые",
-        "Помощь",
-        "Прогулки",
-        "Настройки"
-    ]:
+    if is_menu_command(message.text):
         bot.send_message(message.chat.id, "❌ Ожидание времени отменено.", reply_markup=main_menu())
         return
 
@@ -475,49 +2801,47 @@ def process_time_input_from_button(message):
         bot.send_message(message.chat.id, "❌ Не удалось распознать время.")
         return
 
-    if walk_time <= datetime.now():
+    if walk_time <= clock.now():
         bot.send_message(message.chat.id, "❌ Время уже прошло. Предложите прогулку в будущем.")
         return
 
     user_name = message.from_user.first_name or message.from_user.username or "Аноним"
-    bot.send_message(message.chat.id, "📍 Укажите место встречи:")
+    bot.send_message(message.chat.id, "📍 Укажите место встречи или отправьте геопозицию (📎 → Геопозиция):")
     bot.register_next_step_handler(
         message, ask_for_location,
         time_str=time_str, walk_time=walk_time, user_name=user_name, user_id=user_id
     )
 
 def ask_for_location(message, time_str, walk_time, user_name, user_id):
-    if not message.text:
-        bot.send_message(message.chat.id, "❌ Я понимаю только текст. Пожалуйста, введите текстовое сообщение.")
-        return
-    if message.text in [
-        "Предложить время", "Мои предложения", "Текущие прогулки", "Назад",
-        "Напоминания", "Очистить старые", "Помощь", "Прогулки", "Настройки"
-    ] or message.text.startswith('/'):
-        bot.send_message(message.chat.id, "❌ Ожидание отменено.", reply_markup=main_menu())
-        return
-    location = message.text.strip()
+    geo = location_from_message(message)
+    if geo is None:
+        if not message.text:
+            bot.send_message(message.chat.id, "❌ Пришлите название места текстом или геопозицию.")
+            return
+        if is_menu_command(message.text):
+            bot.send_message(message.chat.id, "❌ Ожидание отменено.", reply_markup=main_menu())
+            return
+        geo = (message.text.strip(), None)
+    location, coords = geo
     bot.send_message(message.chat.id, "🗨️ Напишите комментарий (или '-' для пропуска):")
     bot.register_next_step_handler(
         message, ask_for_comment,
-        time_str=time_str, walk_time=walk_time, user_name=user_name, user_id=user_id, location=location
+        time_str=time_str, walk_time=walk_time, user_name=user_name, user_id=user_id, location=location,
+        coords=coords
     )
 
-def ask_for_comment(message, time_str, walk_time, user_name, user_id, location):
+def ask_for_comment(message, time_str, walk_time, user_name, user_id, location, coords=None):
     if not message.text:
         bot.send_message(message.chat.id, "❌ Я понимаю только текст. Пожалуйста, введите текстовое сообщение.")
         return
 
-    if message.text in [
-        "Предложить время", "Мои предложения", "Текущие прогулки", "Назад",
-        "Напоминания", "Очистить старые", "Помощь", "Прогулки", "Настройки"
-    ] or message.text.startswith('/'):
+    if is_menu_command(message.text):
         bot.send_message(message.chat.id, "❌ Ожидание отменено.", reply_markup=main_menu())
         return
     comment = message.text.strip()
     if comment in [".", "-", ""]:
         comment = ""
-    proposal_id = add_proposal(user_id, user_name, time_str, walk_time, location, comment)
+    proposal_id = add_proposal(user_id, user_name, time_str, walk_time, location, comment, coords)
     increment_proposal_count(user_id)
     date_part = walk_time.strftime('%d.%m в %H:%M')
     bot.send_message(
@@ -528,40 +2852,38 @@ def ask_for_comment(message, time_str, walk_time, user_name, user_id, location):
         f"Отправлено всем!",
         reply_markup=main_menu()
     )
-    update_all_messages_with_details(proposal_id, user_name, time_str, location, comment)
+    update_all_messages_with_details(proposal_id)
 
 def ask_for_location_after_propose(message, time_str, walk_time, user_name, user_id):
-    if not message.text:
-        bot.send_message(message.chat.id, "❌ Я понимаю только текст. Пожалуйста, введите текстовое сообщение.")
-        return
-    if message.text in [
-        "Предложить время", "Мои предложения", "Текущие прогулки", "Назад",
-        "Напоминания", "Очистить старые", "Помощь", "Прогулки", "Настройки"
-    ] or message.text.startswith('/'):
-        bot.send_message(message.chat.id, "❌ Ожидание отменено.", reply_markup=main_menu())
-        return
-    location = message.text.strip()
+    geo = location_from_message(message)
+    if geo is None:
+        if not message.text:
+            bot.send_message(message.chat.id, "❌ Пришлите название места текстом или геопозицию.")
+            return
+        if is_menu_command(message.text):
+            bot.send_message(message.chat.id, "❌ Ожидание отменено.", reply_markup=main_menu())
+            return
+        geo = (message.text.strip(), None)
+    location, coords = geo
     bot.send_message(message.chat.id, "🗨️ Напишите комментарий (или '-' для пропуска):")
     bot.register_next_step_handler(
         message, ask_for_comment_after_propose,
-        time_str=time_str, walk_time=walk_time, user_name=user_name, user_id=user_id, location=location
+        time_str=time_str, walk_time=walk_time, user_name=user_name, user_id=user_id, location=location,
+        coords=coords
     )
 
-def ask_for_comment_after_propose(message, time_str, walk_time, user_name, user_id, location):
+def ask_for_comment_after_propose(message, time_str, walk_time, user_name, user_id, location, coords=None):
     if not message.text:
         bot.send_message(message.chat.id, "❌ Я понимаю только текст. Пожалуйста, введите текстовое сообщение.")
         return
     
-    if message.text in [
-        "Предложить время", "Мои предложения", "Текущие прогулки", "Назад",
-        "Напоминания", "Очистить старые", "Помощь", "Прогулки", "Настройки"
-    ] or message.text.startswith('/'):
+    if is_menu_command(message.text):
         bot.send_message(message.chat.id, "❌ Ожидание отменено.", reply_markup=main_menu())
         return
     comment = message.text.strip()
     if comment in [".", "-", ""]:
         comment = ""
-    proposal_id = add_proposal(user_id, user_name, time_str, walk_time, location, comment)
+    proposal_id = add_proposal(user_id, user_name, time_str, walk_time, location, comment, coords)
     increment_proposal_count(user_id)
     bot.reply_to(
         message,
@@ -570,28 +2892,25 @@ def ask_for_comment_after_propose(message, time_str, walk_time, user_name, user_
         f"💬 Комментарий: {comment or '—'}\n"
         f"Отправлено всем!"
     )
-    update_all_messages_with_details(proposal_id, user_name, time_str, location, comment)
+    update_all_messages_with_details(proposal_id)
 
 def process_comment_input(message, proposal_id, user_id, user_name):
     if not message.text:
         bot.send_message(message.chat.id, "❌ Я понимаю только текст. Пожалуйста, введите текстовое сообщение.")
         return
 
-    if message.text in [
-        "Предложить время", "Мои предложения", "Текущие прогулки", "Назад",
-        "Напоминания", "Очистить старые", "Помощь", "Прогулки", "Настройки"
-    ] or message.text.startswith('/'):
+    if is_menu_command(message.text):
         bot.send_message(message.chat.id, "❌ Ввод комментария отменён.", reply_markup=main_menu())
         return
+    if proposal_id not in live_proposals:
+        bot.send_message(message.chat.id, "🏁 Прогулка уже завершена, комментарий не сохранён.", reply_markup=main_menu())
+        return
     comment = message.text.strip()
     if comment == "-" or len(comment) <= 1:
         comment = ""
     if comment:
         save_comment(proposal_id, user_id, user_name, comment)
-    author_info = get_proposal_author(proposal_id)
-    if author_info:
-        _, proposer_name, time_str, _, location, base_comment = author_info
-        update_all_messages_with_details(proposal_id, proposer_name, time_str, location, base_comment)
+    update_all_messages_with_details(proposal_id)
 
 # === ОБРАБОТЧИКИ МЕНЮ ===
 
@@ -646,11 +2965,50 @@ def show_current_walks(message):
         markup.add(types.InlineKeyboardButton("🗳️ Проголосовать", callback_data=f"resend_proposal_{pid}"))
         bot.send_message(message.chat.id, msg_text, reply_markup=markup)
 
+@bot.message_handler(content_types=['location', 'venue'])
+@allowed_only
+def handle_walks_near_me(message):
+    lat, lon = location_from_message(message)[1]
+    save_user_location(message.from_user.id, lat, lon)
+    walks = find_walks_near(lat, lon)
+    if not walks:
+        bot.reply_to(
+            message,
+            f"🕗 В радиусе {NEAR_RADIUS_KM} км прогулок с геометкой пока нет.\n"
+            "Точку встречи можно отправить геопозицией, когда предлагаете прогулку.",
+            reply_markup=walks_menu()
+        )
+        return
+    lines = [f"🧭 Прогулки рядом (до {NEAR_RADIUS_KM} км):"]
+    markup = types.InlineKeyboardMarkup()
+    for distance, pid, time_str, walk_dt, location, proposer_name in walks:
+        lines.append(f"📅 {time_str}, {format_walk_date(walk_dt)} — 📍 {location}, {distance:.1f} км (👤 {proposer_name})")
+        markup.add(types.InlineKeyboardButton(
+            f"🗳️ {time_str}, {location}"[:60], callback_data=f"resend_proposal_{pid}"
+        ))
+    bot.reply_to(message, "\n".join(lines), reply_markup=markup)
+
+@bot.message_handler(func=lambda m: m.text == "Поиск")
+@allowed_only
+def handle_search_button(message):
+    bot.reply_to(message, "🔎 Что ищем? Место или слово из комментария:")
+    bot.register_next_step_handler(message, process_search_input)
+
 @bot.message_handler(func=lambda m: m.text == "Напоминания")
 @allowed_only
 def handle_reminder_button(message):
     set_reminder(message)
 
+@bot.message_handler(func=lambda m: m.text == "Фильтры")
+@allowed_only
+def handle_filters_button(message):
+    set_filters(message)
+
+@bot.message_handler(func=lambda m: m.text == "Сводка")
+@allowed_only
+def handle_digest_button(message):
+    set_digest(message)
+
 @bot.message_handler(func=lambda m: m.text == "Очистить старые")
 @allowed_only
 def handle_cleanup_old(message):
@@ -694,6 +3052,13 @@ def help_cmd(message):
         "• <b>/my_proposals</b> — ваши предложения\n"
         "• <b>/edit</b> — изменить последнее\n"
         "• <b>/reminder</b> — настроить напоминания\n"
+        "• <b>/filters</b> — какие прогулки присылать\n"
+        "• <b>/digest</b> — присылать новости сводкой\n"
+        "• <b>/quiet</b> — тихие часы: новые прогулки ночью придут утром\n"
+        "• <b>/search слова</b> — найти прогулку по месту и комментариям\n"
+        "• <b>/repeat будни 18:30 Парк</b> — повторяющаяся прогулка\n"
+        "• <b>/templates</b> — ваши повторяющиеся прогулки\n"
+        "• <b>/stats</b> — статистика прогулок\n"
         "• <b>/help</b> — эта справка\n\n"
         "💡 Используйте кнопки внизу."
     )
@@ -705,7 +3070,7 @@ def set_reminder(message):
     bot.send_message(
         message.chat.id,
         "🔔 <b>Настройка напоминаний</b>\n"
-        "Отправьте число от <b>5 до 120</b> — за сколько минут до прогулки\n"
+        f"Отправьте число от <b>{REMINDER_MIN_MINUTES} до {REMINDER_MAX_MINUTES}</b> — за сколько минут до прогулки\n"
         "бот напомнит вам лично.\n\n"
         "Например: <code>30</code> → за 30 минут.",
         parse_mode='HTML'
@@ -716,63 +3081,237 @@ def process_reminder_input(message):
     if not message.text:
         bot.send_message(message.chat.id, "❌ Я понимаю только текст. Пожалуйста, введите текстовое сообщение.")
         return
+    if is_menu_command(message.text):
+        bot.send_message(message.chat.id, "❌ Настройка напоминаний отменена.", reply_markup=main_menu())
+        return
     try:
         mins = int(message.text.strip())
-        if 5 <= mins <= 120:
+        if REMINDER_MIN_MINUTES <= mins <= REMINDER_MAX_MINUTES:
             set_reminder_minutes(message.from_user.id, mins)
             bot.reply_to(message, f"✅ Напоминание будет приходить за {mins} минут до прогулки.")
         else:
-            bot.reply_to(message, "❌ Укажите число от 5 до 120.")
+            bot.reply_to(message, f"❌ Укажите число от {REMINDER_MIN_MINUTES} до {REMINDER_MAX_MINUTES}.")
     except ValueError:
         bot.reply_to(message, "❌ Введите число (например, 30).")
 
-@bot.message_handler(commands=['my_proposals'])
+@bot.message_handler(commands=['filters'])
 @allowed_only
-def my_proposals(message):
-    user_id = message.from_user.id
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT p.id, p.time_str, p.walk_datetime, p.location, p.comment
-            FROM proposals p
-            WHERE p.proposer_id = ?
-            ORDER BY p.walk_datetime DESC
-        """, (user_id,))
-        proposals = cursor.fetchall()
-    if not proposals:
-        bot.reply_to(message, "🕗 У вас пока нет активных предложений.")
-        return
-    full_response = "📁 Ваши предложения:\n"
-    now = datetime.now()
-    for pid, time_str, walk_dt_str, location, comment in proposals:
-        walk_dt = datetime.strptime(walk_dt_str, '%Y-%m-%d %H:%M:%S')
-        date_str = format_walk_date(walk_dt)
-        full_time_display = f"{time_str}, {date_str}"
-        votes = get_votes(pid)
-        user_comments = get_comments(pid)
-
-        def format_name_with_comment(name):
-            comment = user_comments.get(name, "")
-            return f"{name} — {comment}" if comment else name
+def set_filters(message):
+    current = get_subscription(message.from_user.id)
+    bot.send_message(
+        message.chat.id,
+        "🎯 <b>Фильтры прогулок</b>\n"
+        f"Сейчас: {describe_subscription(current)}\n\n"
+        "Отправьте правила одной строкой, любую часть можно опустить:\n"
+        "<code>дни: пн-пт; часы: 18-22; место: парк; авторы: @ivan, Маша; радиус: 3</code>\n"
+        "Дни можно указать словами «будни» или «выходные».\n"
+        "Радиус в км считается от геопозиции, отправленной кнопкой «Рядом со мной».\n"
+        "Отправьте «-», чтобы получать все прогулки.",
+        parse_mode='HTML'
+    )
+    bot.register_next_step_handler(message, process_filters_input)
 
-        yes_list = [format_name_with_comment(name) for name in votes['yes']]
-        later_list = [format_name_with_comment(name) for name in votes['later']]
-        no_list = votes['no']
+def process_filters_input(message):
+    if not message.text:
+        bot.send_message(message.chat.id, "❌ Я понимаю только текст. Пожалуйста, введите текстовое сообщение.")
+        return
+    if is_menu_command(message.text):
+        bot.send_message(message.chat.id, "❌ Настройка фильтров отменена.", reply_markup=main_menu())
+        return
+    rule, error = parse_subscription_rule(message.text)
+    if error:
+        bot.reply_to(message, f"❌ {error}. Попробуйте снова:")
+        bot.register_next_step_handler(message, process_filters_input)
+        return
+    set_subscription(message.from_user.id, rule)
+    reply = f"✅ Буду присылать: {describe_subscription(rule)}."
+    if rule and rule[5] and not subscription_index.has_home(message.from_user.id):
+        reply += "\n📍 Отправьте геопозицию кнопкой «Рядом со мной» в меню прогулок — без неё радиус не учитывается."
+    bot.reply_to(message, reply)
 
-        proposal_text = f"📅 <b>{full_time_display}</b>\n"
-        if location:
-            proposal_text += f"📍 <b>Место:</b> {location}\n"
-        if comment:
-            proposal_text += f"💬 <b>От вас:</b> {comment}\n"
-        proposal_text += "\n"
-        proposal_text += f"✅ <b>Идут сейчас:</b> ({len(yes_list)})\n"
-        proposal_text += "\n".join([f"• {name}" for name in yes_list]) if yes_list else "Пока никто"
-        proposal_text += "\n"
-        proposal_text += f"🕗 <b>Выйдут позже:</b> ({len(later_list)})\n"
-        proposal_text += "\n".join([f"• {name}" for name in later_list]) if later_list else "Никто не отметил"
-        proposal_text += "\n"
-        proposal_text += f"❌ <b>Не пойдут:</b> ({len(no_list)})\n"
-        proposal_text += "\n".join([f"• {name}" for name in no_list]) if no_list else "Все ещё в раздумьях"
+@bot.message_handler(commands=['digest'])
+@allowed_only
+def set_digest(message):
+    minutes = digest_users.get(message.from_user.id)
+    current = f"сводка раз в {minutes} мин." if minutes else "всё приходит сразу"
+    bot.send_message(
+        message.chat.id,
+        "🗞️ <b>Режим сводки</b>\n"
+        f"Сейчас: {current}\n\n"
+        "Новые прогулки и подтверждения будут собираться в одно сообщение за день,\n"
+        "которое бот дополняет не чаще заданного интервала и обязательно — за час до прогулки.\n"
+        "Личные напоминания приходят как обычно.\n\n"
+        f"Отправьте интервал в минутах от <b>{DIGEST_MIN_MINUTES} до {DIGEST_MAX_MINUTES}</b> "
+        "или <code>0</code>, чтобы получать всё сразу.",
+        parse_mode='HTML'
+    )
+    bot.register_next_step_handler(message, process_digest_input)
+
+def process_digest_input(message):
+    if not message.text:
+        bot.send_message(message.chat.id, "❌ Я понимаю только текст. Пожалуйста, введите текстовое сообщение.")
+        return
+    if is_menu_command(message.text):
+        bot.send_message(message.chat.id, "❌ Настройка сводки отменена.", reply_markup=main_menu())
+        return
+    try:
+        mins = int(message.text.strip())
+    except ValueError:
+        bot.reply_to(message, "❌ Введите число (например, 60).")
+        return
+    if mins == 0:
+        set_digest_minutes(message.from_user.id, 0)
+        bot.reply_to(message, "✅ Сводка отключена — всё будет приходить сразу.")
+    elif DIGEST_MIN_MINUTES <= mins <= DIGEST_MAX_MINUTES:
+        set_digest_minutes(message.from_user.id, mins)
+        bot.reply_to(message, f"✅ Сводка будет обновляться не чаще раза в {mins} минут.")
+    else:
+        bot.reply_to(message, f"❌ Укажите 0 или число от {DIGEST_MIN_MINUTES} до {DIGEST_MAX_MINUTES}.")
+
+@bot.message_handler(commands=['quiet'])
+@allowed_only
+def set_quiet(message):
+    hours = quiet_hours.get(message.from_user.id)
+    current = f"с {hours[0]}:00 до {hours[1]}:00" if hours else "выключены"
+    bot.send_message(
+        message.chat.id,
+        "🌙 <b>Тихие часы</b>\n"
+        f"Сейчас: {current}\n\n"
+        "В это время новые карточки прогулок откладываются до утра; правки, напоминания\n"
+        "и подтверждения приходят как обычно. Прогулку, которая начнётся раньше конца\n"
+        "тихих часов, бот пришлёт сразу, но без звука.\n\n"
+        "Отправьте часы в виде <code>23-8</code> или <code>-</code>, чтобы выключить.",
+        parse_mode='HTML'
+    )
+    bot.register_next_step_handler(message, process_quiet_input)
+
+def process_quiet_input(message):
+    if not message.text:
+        bot.send_message(message.chat.id, "❌ Я понимаю только текст. Пожалуйста, введите текстовое сообщение.")
+        return
+    if is_menu_command(message.text):
+        bot.send_message(message.chat.id, "❌ Настройка тихих часов отменена.", reply_markup=main_menu())
+        return
+    text = message.text.strip()
+    if text == "-":
+        set_quiet_hours(message.from_user.id, None)
+        bot.reply_to(message, "✅ Тихие часы выключены.")
+        return
+    match = re.match(r'^(\d{1,2})\s*-\s*(\d{1,2})$', text)
+    start, end = (int(match.group(1)), int(match.group(2))) if match else (None, None)
+    if start is None or not (0 <= start <= 23 and 0 <= end <= 23) or start == end:
+        bot.reply_to(message, "❌ Укажите два разных часа от 0 до 23, например 23-8.")
+        return
+    set_quiet_hours(message.from_user.id, (start, end))
+    bot.reply_to(message, f"✅ Тихие часы: с {start}:00 до {end}:00.")
+
+@bot.message_handler(commands=['search'])
+@allowed_only
+def search_cmd(message):
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        handle_search_button(message)
+        return
+    send_search_results(message, args[1])
+
+def process_search_input(message):
+    if not message.text:
+        bot.send_message(message.chat.id, "❌ Я понимаю только текст. Пожалуйста, введите текстовое сообщение.")
+        return
+    if is_menu_command(message.text):
+        bot.send_message(message.chat.id, "❌ Поиск отменён.", reply_markup=walks_menu())
+        return
+    send_search_results(message, message.text)
+
+def send_search_results(message, text):
+    remember_search(message.from_user.id, text.strip()[:100])
+    page_text, markup = render_search_page(message.from_user.id, 0)
+    bot.reply_to(message, page_text, parse_mode='HTML', reply_markup=markup)
+
+@bot.message_handler(commands=['repeat'])
+@allowed_only
+def repeat_proposal(message):
+    usage = (
+        "🔁 Форматы:\n"
+        "• <b>/repeat будни 18:30 Парк</b> — новая повторяющаяся прогулка\n"
+        "• <b>/repeat 3 пн,ср 19:00 Сквер</b> — изменить шаблон №3\n"
+        "Дни: пн, вт, ср, чт, пт, сб, вс, диапазон (пн-пт), «будни», «выходные» или «все»."
+    )
+    args = message.text.split()[1:]
+    template_id = int(args.pop(0)) if args and args[0].isdigit() else None
+    if len(args) < 3:
+        bot.reply_to(message, usage, parse_mode='HTML')
+        return
+    weekdays = parse_weekdays(args[0])
+    time_str = args[1]
+    location = " ".join(args[2:])
+    if weekdays is None or not re.match(r'^([01]?[0-9]|2[0-3]):[0-5][0-9]$', time_str):
+        bot.reply_to(message, usage, parse_mode='HTML')
+        return
+    time_str = f"{int(time_str.split(':')[0]):02d}:{time_str.split(':')[1]}"
+    user_id = message.from_user.id
+    user_name = message.from_user.first_name or message.from_user.username or "Аноним"
+    if template_id is None and len(get_templates(user_id)) >= TEMPLATE_LIMIT:
+        bot.reply_to(message, f"❌ Не больше {TEMPLATE_LIMIT} повторяющихся прогулок. Удалите лишние в /templates.")
+        return
+    saved_id = save_template(user_id, user_name, time_str, weekdays, location, template_id)
+    if saved_id is None:
+        bot.reply_to(message, "❌ Шаблон не найден.")
+        return
+    if template_id is None:
+        bot.reply_to(
+            message,
+            f"✅ Повторяющаяся прогулка №{saved_id}: {describe_weekdays(weekdays)} в {time_str}\n"
+            f"📍 Место: {location}\n"
+            f"Карточки будут рассылаться за сутки до каждой прогулки."
+        )
+    else:
+        bot.reply_to(
+            message,
+            f"✅ Шаблон №{saved_id} изменён: {describe_weekdays(weekdays)} в {time_str}, {location}.\n"
+            f"Уже разосланные прогулки не меняются — их можно поправить через /edit."
+        )
+    materialize_templates(template_id=saved_id)
+
+@bot.message_handler(commands=['templates'])
+@allowed_only
+def list_templates(message):
+    templates = get_templates(message.from_user.id)
+    if not templates:
+        bot.reply_to(message, "🔁 Повторяющихся прогулок нет. Создать: /repeat будни 18:30 Парк")
+        return
+    markup = types.InlineKeyboardMarkup()
+    lines = ["🔁 Ваши повторяющиеся прогулки:"]
+    for tid, time_str, weekdays, location, _ in templates:
+        lines.append(f"№{tid}: {describe_weekdays(weekdays)} в {time_str}, 📍 {location}")
+        markup.add(types.InlineKeyboardButton(f"🗑️ Удалить №{tid}", callback_data=f"template_delete_{tid}"))
+    bot.reply_to(message, "\n".join(lines), reply_markup=markup)
+
+@bot.message_handler(commands=['stats'])
+@allowed_only
+def stats_cmd(message):
+    bot.reply_to(message, render_stats(), parse_mode='HTML')
+
+@bot.message_handler(commands=['my_proposals'])
+@allowed_only
+def my_proposals(message):
+    user_id = message.from_user.id
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT p.id, p.time_str, p.walk_datetime, p.location, p.comment
+            FROM proposals p
+            WHERE p.proposer_id = ?
+            ORDER BY p.walk_datetime DESC
+        """, (user_id,))
+        proposals = cursor.fetchall()
+    if not proposals:
+        bot.reply_to(message, "🕗 У вас пока нет активных предложений.")
+        return
+    full_response = "📁 Ваши предложения:\n"
+    for pid, time_str, walk_dt_str, location, comment in proposals:
+        walk_dt = datetime.strptime(walk_dt_str, '%Y-%m-%d %H:%M:%S')
+        proposal_text = card_renderer.render_owner_summary(pid, time_str, walk_dt, location, comment)
         full_response += proposal_text + "\n" + ("—" * 30) + "\n"
 
     if len(full_response) > 4000:
@@ -802,14 +3341,14 @@ def propose(message):
     if walk_time is None:
         bot.reply_to(message, "❌ Не удалось распознать время.")
         return
-    if walk_time <= datetime.now():
+    if walk_time <= clock.now():
         bot.reply_to(message, "❌ Время уже прошло.")
         return
     user_name = message.from_user.first_name or message.from_user.username or "Аноним"
-    bot.reply_to(message, "📍 Укажите место встречи:")
+    bot.reply_to(message, "📍 Укажите место встречи или отправьте геопозицию (📎 → Геопозиция):")
     bot.register_next_step_handler(
         message,
-        lambda msg: ask_for_location_after_propose(msg, time_str, walk_time, user_name, user_id),
+        ask_for_location_after_propose,
         time_str=time_str, walk_time=walk_time, user_name=user_name, user_id=user_id
     )
 
@@ -817,7 +3356,7 @@ def propose(message):
 @allowed_only
 def edit_proposal(message):
     user_id = message.from_user.id
-    with sqlite3.connect(DB_PATH) as conn:
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("""
             SELECT p.id, p.time_str, p.location, p.comment
@@ -830,7 +3369,7 @@ def edit_proposal(message):
             HAVING COUNT(v.proposal_id) = 0
             ORDER BY p.timestamp DESC
             LIMIT 1
-        """, (user_id, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        """, (user_id, clock.now().strftime('%Y-%m-%d %H:%M:%S')))
         prop = cursor.fetchone()
     if not prop:
         bot.reply_to(message, "Нет предложений для редактирования (либо уже есть голоса).")
@@ -846,13 +3385,16 @@ def edit_proposal(message):
     )
 
 def process_edit_time(message, proposal_id, old_location, old_comment):
+    if message.text and is_menu_command(message.text):
+        bot.send_message(message.chat.id, "❌ Редактирование отменено.", reply_markup=main_menu())
+        return
     time_str = message.text.strip()
     if not re.match(r'^([01]?[0-9]|2[0-3]):[0-5][0-9]$', time_str):
         bot.reply_to(message, "Неверный формат времени. Попробуйте снова:")
         bot.register_next_step_handler(message, process_edit_time, proposal_id, old_location, old_comment)
         return
     walk_time = parse_proposal_datetime(time_str)
-    if not walk_time or walk_time <= datetime.now():
+    if not walk_time or walk_time <= clock.now():
         bot.reply_to(message, "Укажите время в будущем.")
         return
     bot.send_message(message.chat.id, f"Новое место (было: {old_location or '—'}):")
@@ -866,7 +3408,11 @@ def process_edit_time(message, proposal_id, old_location, old_comment):
     )
 
 def process_edit_location(message, proposal_id, new_time, new_time_str, old_comment):
-    location = message.text.strip()
+    if message.text and is_menu_command(message.text):
+        bot.send_message(message.chat.id, "❌ Редактирование отменено.", reply_markup=main_menu())
+        return
+    # Новое место текстом снимает старую геометку
+    location, coords = location_from_message(message) or (message.text.strip(), None)
     bot.send_message(message.chat.id, f"Новый комментарий (был: {old_comment or '—'}):")
     bot.register_next_step_handler(
         message,
@@ -874,28 +3420,39 @@ def process_edit_location(message, proposal_id, new_time, new_time_str, old_comm
         proposal_id=proposal_id,
         new_time=new_time,
         new_time_str=new_time_str,
-        new_location=location
+        new_location=location,
+        new_coords=coords
     )
 
-def process_edit_comment(message, proposal_id, new_time, new_time_str, new_location):
+def process_edit_comment(message, proposal_id, new_time, new_time_str, new_location, new_coords=None):
+    if message.text and is_menu_command(message.text):
+        bot.send_message(message.chat.id, "❌ Редактирование отменено.", reply_markup=main_menu())
+        return
     comment = message.text.strip()
     if comment in [".", "-", ""]:
         comment = ""
-    with sqlite3.connect(DB_PATH) as conn:
+    lat, lon = new_coords or (None, None)
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("""
             UPDATE proposals 
-            SET time_str = ?, walk_datetime = ?, location = ?, comment = ?
+            SET time_str = ?, walk_datetime = ?, location = ?, comment = ?, lat = ?, lon = ?, geocell = ?
             WHERE id = ?
-        """, (new_time_str, new_time.strftime('%Y-%m-%d %H:%M:%S'), new_location, comment, proposal_id))
+        """, (new_time_str, new_time.strftime('%Y-%m-%d %H:%M:%S'), new_location, comment,
+              lat, lon, geocell(lat, lon) if new_coords else None, proposal_id))
+    forget_proposals(proposal_id)
     bot.send_message(message.chat.id, "✅ Предложение обновлено!", reply_markup=main_menu())
-    author_info = get_proposal_author(proposal_id)
-    if author_info:
-        _, proposer_name, _, _, loc, comm = author_info
-        update_all_messages_with_details(proposal_id, proposer_name, new_time_str, loc, comm)
+    update_all_messages_with_details(proposal_id)
 
 # === CALLBACK-ОБРАБОТЧИКИ ===
 
+def answer_if_closed(call, proposal_id):
+    """Нажатие на карточке удалённого предложения: ответ без записи в базу и рассылки."""
+    if proposal_id in live_proposals:
+        return False
+    bot.answer_callback_query(call.id, "🏁 Эта прогулка уже завершена.")
+    return True
+
 @bot.callback_query_handler(func=lambda call: call.data.startswith("vote_"))
 def handle_vote(call):
     if not check_allowed(call.from_user.id):
@@ -905,20 +3462,25 @@ def handle_vote(call):
     if len(parts) < 3:
         return
     vote_type, proposal_id = parts[1], int(parts[2])
+    if answer_if_closed(call, proposal_id):
+        return
     if vote_type not in ('yes', 'later', 'no'):
         vote_type = 'yes'
     voter_id = call.from_user.id
     voter_name = call.from_user.first_name or call.from_user.username or "Аноним"
-    add_vote(proposal_id, voter_id, voter_name, vote_type)
+    if not add_vote(proposal_id, voter_id, voter_name, vote_type):
+        # Удалено другим экземпляром, пока мы не знали
+        live_proposals.discard(proposal_id)
+        bot.answer_callback_query(call.id, "🏁 Эта прогулка уже завершена.")
+        return
 
     if vote_type == 'yes':
-        votes = get_votes(proposal_id)
+        votes = card_renderer.vote_names(proposal_id)
         current_count = len(votes['yes'])
-        if current_count >= 3:
-            author_info = get_proposal_author(proposal_id)
-            if author_info:
-                _, proposer_name, time_str, walk_dt_str, location, base_comment = author_info
-                walk_dt = datetime.strptime(walk_dt_str, '%Y-%m-%d %H:%M:%S')
+        if current_count >= WALK_CONFIRMED_MIN:
+            record = get_proposal(proposal_id)
+            if record:
+                _, proposer_name, time_str, _, location, base_comment, walk_dt = record[:7]
                 date_word = format_walk_date(walk_dt)
                 confirm_msg = (
                     f"✅ <b>Прогулка подтверждена!</b>\n"
@@ -927,14 +3489,17 @@ def handle_vote(call):
                 if location:
                     confirm_msg += f"📍 {location}\n"
                 confirm_msg += f"\n👥 Участники:\n" + "\n".join(f"• {name}" for name in votes['yes'])
-                with sqlite3.connect(DB_PATH) as conn:
-                    c = conn.cursor()
-                    c.execute("SELECT voter_id FROM votes WHERE proposal_id = ? AND vote_type = 'yes'", (proposal_id,))
-                    for (voter_id_to_notify,) in c.fetchall():
-                        try:
-                            bot.send_message(voter_id_to_notify, confirm_msg, parse_mode='HTML')
-                        except Exception as e:
-                            print(f"Ошибка отправки {voter_id_to_notify}: {e}")
+                voter_ids = card_renderer.voter_ids(proposal_id, 'yes')
+                stats = new_broadcast_stats('confirmation', proposal_id, 'sendMessage')
+                # Проголосовавший сейчас в чате — ему сразу, остальным в режиме сводки — в сводку
+                digest_voters = {uid for uid in voter_ids if uid in digest_users and uid != voter_id}
+                if digest_voters:
+                    queue_digest_events(proposal_id, walk_dt, [(uid, 'confirmed') for uid in digest_voters])
+                    stats['digested'] = len(digest_voters)
+                delivery_scheduler.fanout(stats, [
+                    DeliveryJob(DELIVERY_CONFIRMATION, uid, proposal_id, text=confirm_msg, walk_dt=walk_dt)
+                    for uid in voter_ids if uid not in digest_voters
+                ])
 
     if vote_type in ('yes', 'later'):
         bot.send_message(
@@ -950,10 +3515,7 @@ def handle_vote(call):
             user_name=voter_name
         )
     else:
-        author_info = get_proposal_author(proposal_id)
-        if author_info:
-            _, proposer_name, time_str, _, location, comment = author_info
-            update_all_messages_with_details(proposal_id, proposer_name, time_str, location, comment)
+        update_all_messages_with_details(proposal_id)
 
     msg = {
         'yes': "Отлично! Ты в списке «Выйду гулять» 👍",
@@ -968,60 +3530,21 @@ def handle_resend_proposal(call):
         bot.answer_callback_query(call.id, "🔒 Доступ запрещён.", show_alert=True)
         return
     proposal_id = int(call.data.split("_")[2])
-    author_info = get_proposal_author(proposal_id)
-    if not author_info:
+    if answer_if_closed(call, proposal_id):
+        return
+    rendered = card_renderer.render_card(proposal_id)
+    if not rendered:
         bot.answer_callback_query(call.id, "❌ Предложение не найдено.")
         return
     user_id = call.from_user.id
-    _, proposer_name, time_str, _, location, base_comment = author_info
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT walk_datetime FROM proposals WHERE id = ?", (proposal_id,))
-        row = cursor.fetchone()
-        if not row:
-            bot.answer_callback_query(call.id, "❌ Предложение удалено.")
-            return
-        walk_dt_str = row[0]
-
-    walk_datetime = datetime.strptime(walk_dt_str, '%Y-%m-%d %H:%M:%S')
-    date_str = format_walk_date(walk_datetime)
-    full_time_display = f"{time_str}, {date_str}"
-    votes = get_votes(proposal_id)
-    user_comments = get_comments(proposal_id)
-
-    def format_name_with_comment(name):
-        comment = user_comments.get(name, "")
-        return f"{name} — {comment}" if comment else name
-
-    yes_list = "\n".join([f"• {format_name_with_comment(name)}" for name in votes['yes']]) or "Пока никто"
-    later_list = "\n".join([f"• {format_name_with_comment(name)}" for name in votes['later']]) or "Никто не отметил"
-    no_list = "\n".join([f"• {name}" for name in votes['no']]) or "Все ещё в раздумьях"
-
-    text = f"📅 <b>Прогулка: {full_time_display}</b>\n"
-    if location:
-        text += f"📍 <b>Место:</b> {location}\n"
-    if base_comment:
-        text += f"💬 <b>От автора:</b> {base_comment}\n"
-    text += f"\nОт: {proposer_name}\n"
-    text += f"✅ <b>Выйду гулять:</b>\n{yes_list}\n"
-    text += f"🕗 <b>Выйду позже:</b>\n{later_list}\n"
-    text += f"❌ <b>Не пойду:</b>\n{no_list}"
-
-    markup = types.InlineKeyboardMarkup()
-    markup.add(
-        types.InlineKeyboardButton("✅ Выйду гулять", callback_data=f"vote_yes_{proposal_id}"),
-        types.InlineKeyboardButton("🕗 Выйду позже", callback_data=f"vote_later_{proposal_id}")
-    )
-    markup.add(
-        types.InlineKeyboardButton("❌ Не пойду", callback_data=f"vote_no_{proposal_id}")
-    )
+    text, markup = rendered
 
     try:
         sent = bot.send_message(user_id, text, reply_markup=markup, parse_mode='HTML')
         save_message_id(user_id, proposal_id, sent.message_id)
         bot.answer_callback_query(call.id, "✅ Сообщение с голосованием отправлено вам в личку!")
     except Exception as e:
-        print(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+        record_delivery_failure(user_id, e, proposal_id=proposal_id, api_method='sendMessage')
         bot.answer_callback_query(call.id, "❌ Не удалось отправить сообщение. Возможно, вы заблокировали бота.")
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("confirm_going_"))
@@ -1037,8 +3560,14 @@ def handle_cancel_last_minute(call):
         bot.answer_callback_query(call.id, "🔒 Доступ запрещён.", show_alert=True)
         return
     proposal_id = int(call.data.split("_")[3])
+    if answer_if_closed(call, proposal_id):
+        return
     message_records = get_all_message_ids_for_proposal(proposal_id)
+    stats = new_broadcast_stats('cancel', proposal_id, 'editMessageText')
     for user_id, msg_id in message_records:
+        if user_id in unreachable_users:
+            stats['skipped'] += 1
+            continue
         try:
             bot.edit_message_text(
                 chat_id=user_id,
@@ -1046,12 +3575,14 @@ def handle_cancel_last_minute(call):
                 text="❌ Прогулка отменена автором в последнюю минуту.",
                 parse_mode='HTML'
             )
+            stats['edited'] += 1
         except Exception as e:
-            print(f"Не удалось обновить сообщение у {user_id}: {e}")
-    with sqlite3.connect(DB_PATH) as conn:
+            record_delivery_failure(user_id, e, stats)
+    report_broadcast(stats)
+    with db_connect() as conn:
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM proposals WHERE id = ?", (proposal_id,))
-        cursor.execute("DELETE FROM user_proposal_messages WHERE proposal_id = ?", (proposal_id,))
+        delete_proposals(cursor, "id = ?", (proposal_id,), finalize=False)
+    close_proposals(proposal_id)
     bot.answer_callback_query(call.id, "Прогулка отменена.", show_alert=True)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("remind_later_"))
@@ -1060,8 +3591,10 @@ def handle_remind_later(call):
         bot.answer_callback_query(call.id, "🔒 Доступ запрещён.", show_alert=True)
         return
     proposal_id = int(call.data.split("_")[2])
-    new_time = datetime.now() - timedelta(hours=5)
-    with sqlite3.connect(DB_PATH) as conn:
+    if answer_if_closed(call, proposal_id):
+        return
+    new_time = clock.now() - timedelta(hours=5)
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "UPDATE proposals SET timestamp = ?, processed = 0 WHERE id = ?",
@@ -1075,8 +3608,14 @@ def handle_cancel_proposal(call):
         bot.answer_callback_query(call.id, "🔒 Доступ запрещён.", show_alert=True)
         return
     proposal_id = int(call.data.split("_")[2])
+    if answer_if_closed(call, proposal_id):
+        return
     message_records = get_all_message_ids_for_proposal(proposal_id)
+    stats = new_broadcast_stats('cancel', proposal_id, 'editMessageText')
     for user_id, msg_id in message_records:
+        if user_id in unreachable_users:
+            stats['skipped'] += 1
+            continue
         try:
             bot.edit_message_text(
                 chat_id=user_id,
@@ -1085,86 +3624,1617 @@ def handle_cancel_proposal(call):
                 reply_markup=None,
                 parse_mode='HTML'
             )
+            stats['edited'] += 1
         except Exception as e:
-            print(f"⚠️ Не удалось обновить сообщение у {user_id}: {e}")
-    with sqlite3.connect(DB_PATH) as conn:
+            record_delivery_failure(user_id, e, stats)
+    report_broadcast(stats)
+    with db_connect() as conn:
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM proposals WHERE id = ?", (proposal_id,))
-        cursor.execute("DELETE FROM user_proposal_messages WHERE proposal_id = ?", (proposal_id,))
+        delete_proposals(cursor, "id = ?", (proposal_id,), finalize=False)
+    close_proposals(proposal_id)
     bot.answer_callback_query(call.id, "Предложение отменено.", show_alert=True)
 
+@bot.callback_query_handler(func=lambda call: call.data.startswith("template_delete_"))
+def handle_template_delete(call):
+    if not check_allowed(call.from_user.id):
+        bot.answer_callback_query(call.id, "🔒 Доступ запрещён.", show_alert=True)
+        return
+    template_id = int(call.data.split("_")[2])
+    if deactivate_template(template_id, call.from_user.id):
+        bot.answer_callback_query(call.id, f"Шаблон №{template_id} удалён. Уже разосланные прогулки остаются.", show_alert=True)
+    else:
+        bot.answer_callback_query(call.id, "Шаблон не найден.")
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("search_page_"))
+def handle_search_page(call):
+    if not check_allowed(call.from_user.id):
+        bot.answer_callback_query(call.id, "🔒 Доступ запрещён.", show_alert=True)
+        return
+    offset = int(call.data.split("_")[2])
+    page_text, markup = render_search_page(call.from_user.id, offset)
+    try:
+        bot.edit_message_text(
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            text=page_text,
+            reply_markup=markup,
+            parse_mode='HTML'
+        )
+    except apihelper.ApiTelegramException as e:
+        record_delivery_failure(call.from_user.id, e, api_method='editMessageText', kind='search')
+    bot.answer_callback_query(call.id)
+
+@bot.inline_handler(func=lambda query: True)
+def handle_inline_search(query):
+    """Inline-режим (включается в @BotFather): @бот парк — карточки найденных прогулок."""
+    if not check_allowed(query.from_user.id):
+        bot.answer_inline_query(query.id, [], cache_time=60, is_personal=True)
+        return
+    offset = int(query.offset or 0)
+    rows, has_more = search_proposals(query.query, offset) if query.query.strip() else ([], False)
+    results = []
+    for pid, proposer_name, time_str, walk_dt_str, location, snippet in rows:
+        walk_dt = datetime.strptime(walk_dt_str, '%Y-%m-%d %H:%M:%S')
+        rendered = card_renderer.render_card(pid)
+        if not rendered:
+            continue
+        results.append(types.InlineQueryResultArticle(
+            id=str(pid),
+            title=f"{time_str}, {format_walk_date(walk_dt)} — {location or '—'}",
+            description=snippet.replace(_MATCH_START, "").replace(_MATCH_END, ""),
+            input_message_content=types.InputTextMessageContent(rendered[0], parse_mode='HTML'),
+        ))
+    bot.answer_inline_query(
+        query.id, results, cache_time=10, is_personal=True,
+        next_offset=str(offset + SEARCH_PAGE_SIZE) if has_more else ""
+    )
+
+# === ПАНЕЛЬ АДМИНИСТРАТОРА ===
+
+def is_admin(user_id):
+    return user_id in ADMIN_USER_IDS
+
+def admin_only(func):
+    def wrapper(message):
+        if not is_admin(message.from_user.id):
+            bot.reply_to(message, "🔒 Команда доступна только администраторам.")
+            return
+        return func(message)
+    return wrapper
+
+def format_size(size):
+    for unit in ('Б', 'КБ', 'МБ'):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == 'Б' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+# tenants.py: функция, возвращающая счётчики этого города в общем пуле потоков
+tenant_stats = None
+
+def render_admin_dashboard():
+    """Текст панели /admin. Только счётчики из памяти: ни запросов к БД, ни вызовов API."""
+    api = api_guard.snapshot()
+    recent_calls, recent_errors = api_guard.recent()
+    db = db_metrics.snapshot()
+    cache = proposal_cache.snapshot()
+    log_queue = _log_listener.queue.qsize() if _log_listener else 0
+    dialogs = sum(len(h) for h in list(bot.next_step_backend.handlers.values()))
+    lines = [f"🛠️ <b>Состояние бота</b> на {clock.now().strftime('%H:%M:%S')}", ""]
+
+    paused = " — ⏸️ на паузе" if broadcasts_paused.is_set() else ""
+    lines.append(
+        f"📤 Рассылки карточек: идёт {broadcast_counters['active']}, "
+        f"адресатов в очереди {broadcast_counters['pending']}, отложено {len(deferred_broadcasts)}{paused}"
+    )
+    lines.append(
+        f"🌐 API: цепь {api['state']}, в полёте {api['in_flight']}/{int(api['limit'])}, "
+        f"ждут слота {api['waiting']}, задержка ~{api['latency_ewma'] * 1000:.0f} мс"
+    )
+    rate = recent_errors / recent_calls if recent_calls else 0.0
+    lines.append(
+        f"   за {API_RECENT_WINDOW // 60} мин: вызовов {recent_calls}, ошибок {recent_errors} ({rate:.1%}); "
+        f"отброшено правок {api['shed']}, отклонено {api['rejected']}"
+    )
+    ingest = update_dispatcher.snapshot()
+    lines.append("📥 Входящие: " + " · ".join(
+        f"{name} {depth} (~{wait:.0f} мс)" for name, depth, wait in zip(PRIORITY_NAMES, ingest['depth'], ingest['wait_ms'])
+    ) + f"; отброшено {sum(ingest['shed'])}")
+    transport = api_transport.stats()
+    if 'connections' in transport:
+        reuse = 1 - transport['connections'] / transport['requests'] if transport['requests'] else 0.0
+        lines.append(
+            f"🔌 Соединения ({api_transport.name}): открыто {transport['connections']} "
+            f"на {transport['requests']} запросов, повторное использование {reuse:.0%}"
+        )
+    elif 'http2' in transport:
+        lines.append(f"🔌 Соединения ({api_transport.name}): запросов {transport['requests']}, по HTTP/2 {transport['http2']}")
+    else:
+        lines.append(f"🔌 Соединения ({api_transport.name}): запросов {transport['requests']}")
+    lines.append(f"🧾 Журнал: в очереди {log_queue}, потеряно {DroppingQueueHandler.dropped}")
+    lines.append(f"💬 Диалогов в процессе: {dialogs}")
+    lines.append(f"🗞️ В режиме сводки: {len(digest_users)}")
+    delivery = delivery_scheduler.snapshot()
+    lines.append(
+        f"📬 Доставка: в очереди {delivery['queued']}, ждут конца тихих часов {delivery['delayed']}, "
+        f"склеено повторов {delivery['coalesced']}"
+    )
+    lines.append("   p50/p95, мс: " + " · ".join(
+        f"{name} {p50}/{p95}" for name, p50, p95 in zip(DELIVERY_NAMES, delivery['p50_ms'], delivery['p95_ms'])
+    ))
+    lines.append(
+        f"🏁 Завершённые карточки: в очереди {card_finalizer.pending}, снято кнопок {card_finalizer.counters['edited']}, "
+        f"ошибок {card_finalizer.counters['failed']}; нажатий на удалённые {live_proposals.rejected}"
+    )
+    if tenant_stats is not None:
+        tenant = tenant_stats()
+        lines.append(
+            f"🏙️ Город {TENANT}: обработчики {tenant['busy']}/{tenant['cap']}, доставка {tenant['sending']}/{tenant['cap']} "
+            f"потоков из общих {tenant['workers']}; выполнено {tenant['processed']}, потоко-секунд {tenant['busy_seconds']:.0f}"
+        )
+    if leader_lease.is_leader():
+        lines.append(f"👑 Планировщик: этот экземпляр {INSTANCE_ID} (срок аренды №{leader_lease.term})")
+    else:
+        lines.append(f"💤 Планировщик: резерв, ведущий {leader_lease.leader or 'неизвестен'}")
+
+    if worker_metrics:
+        ago = (clock.now() - worker_metrics['last_tick']).total_seconds()
+        lines.append(
+            f"⚙️ Фоновый поток: цикл в {worker_metrics['last_tick'].strftime('%H:%M:%S')} "
+            f"({worker_metrics['duration'] * 1000:.0f} мс), {ago:.0f} с назад"
+        )
+        lines.append(
+            f"🗄️ БД: {format_size(worker_metrics['db_size'])}, WAL {format_size(worker_metrics['wal_size'])}; "
+            f"транзакций {db['transactions']}, самая долгая {db['max_time'] * 1000:.0f} мс, "
+            f"блокировок {db['locked_errors']}"
+        )
+        states = worker_metrics['proposal_states']
+        lines.append("🚶 Предложения: " + " · ".join(
+            f"{title} {states[state]}" for state, title in PROPOSAL_STATES.items()
+        ))
+    else:
+        lines.append("⚙️ Фоновый поток ещё не завершил ни одного цикла")
+    lines.append(f"🧠 Кэш предложений: {cache['size']} шт., попаданий {cache['hit_rate']:.0%}")
+    if backup_metrics:
+        lines.append(f"💾 Резервная копия: {backup_metrics['finished_at']}, {format_size(backup_metrics['size'])}")
+    return "\n".join(lines)
+
+def admin_markup():
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("🔄 Обновить", callback_data="admin_refresh"))
+    markup.add(types.InlineKeyboardButton("🧹 Запустить очистку", callback_data="admin_retention"))
+    if broadcasts_paused.is_set():
+        markup.add(types.InlineKeyboardButton("▶️ Возобновить рассылки", callback_data="admin_resume"))
+    else:
+        markup.add(types.InlineKeyboardButton("⏸️ Приостановить рассылки", callback_data="admin_pause"))
+    return markup
+
+def run_retention():
+    try:
+        auto_delete_old_proposals_by_walk_time()
+        cleanup_old_proposals()
+    except Exception as e:
+        log_event('retention_failed', logging.ERROR, **error_fields(e))
+
+@bot.message_handler(commands=['admin'])
+@admin_only
+def admin_dashboard(message):
+    bot.send_message(message.chat.id, render_admin_dashboard(), parse_mode='HTML', reply_markup=admin_markup())
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("admin_"))
+def handle_admin_action(call):
+    if not is_admin(call.from_user.id):
+        bot.answer_callback_query(call.id, "🔒 Доступ запрещён.", show_alert=True)
+        return
+    action = call.data[len("admin_"):]
+    notice = None
+    if action == "retention":
+        threading.Thread(target=run_retention, daemon=True).start()
+        notice = "🧹 Очистка запущена."
+    elif action == "pause":
+        pause_broadcasts()
+        notice = "⏸️ Рассылки карточек приостановлены."
+    elif action == "resume":
+        resume_broadcasts()
+        notice = "▶️ Рассылки возобновлены."
+    log_event('admin_action', user_id=call.from_user.id, action=action)
+    try:
+        bot.edit_message_text(
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            text=render_admin_dashboard(),
+            reply_markup=admin_markup(),
+            parse_mode='HTML'
+        )
+    except apihelper.ApiTelegramException as e:
+        record_delivery_failure(call.from_user.id, e, api_method='editMessageText', kind='admin')
+    bot.answer_callback_query(call.id, notice)
+
 # === ФОНОВЫЙ ПОТОК ===
 
+# Последний цикл фонового потока; /admin читает только этот словарь
+worker_metrics = {}
+
+PROPOSAL_STATES = {
+    'upcoming': 'ждут',
+    'reminded': 'напомнено',
+    'past': 'прошли, ждут отклика',
+    'closed': 'закрыты',
+}
+
+def collect_worker_metrics(cursor, now, started):
+    # Четыре подсчёта по диапазонам индексов вместо GROUP BY по всей таблице каждый такт
+    cursor.execute("""
+        SELECT (SELECT COUNT(*) FROM proposals WHERE processed = 0 AND walk_datetime > ?1),
+               (SELECT COUNT(*) FROM proposals WHERE processed = 0),
+               (SELECT COUNT(*) FROM proposals WHERE walk_datetime > ?1),
+               (SELECT COUNT(*) FROM proposals)
+    """, (now.strftime('%Y-%m-%d %H:%M:%S'),))
+    upcoming, unprocessed, future, total = cursor.fetchone()
+    states = {
+        'upcoming': upcoming,
+        'reminded': future - upcoming,
+        'past': unprocessed - upcoming,
+        'closed': total - unprocessed - (future - upcoming),
+    }
+    sizes = {}
+    for key, path in (('db_size', DB_PATH), ('wal_size', DB_PATH + '-wal')):
+        try:
+            sizes[key] = os.path.getsize(path)
+        except OSError:
+            sizes[key] = 0
+    worker_metrics.update({
+        'last_tick': now,
+        'duration': time.perf_counter() - started,
+        'proposal_states': states,
+        **sizes,
+    })
+
+# === АРХИВ И СТАТИСТИКА ===
+
+# Архив разбит на таблицы по месяцу прогулки: walk_archive_2026_10 и т.д.
+# Старый месяц можно выгрузить или удалить целиком, не трогая остальные
+archive_partitions = set()
+
+def archive_table(cursor, walk_dt):
+    """Имя таблицы архива для месяца прогулки; создаёт её при первом обращении."""
+    name = f"walk_archive_{walk_dt:%Y_%m}"
+    if name not in archive_partitions:
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {name} (
+                id INTEGER PRIMARY KEY,
+                proposer_id INTEGER NOT NULL,
+                proposer_name TEXT NOT NULL,
+                walk_datetime DATETIME NOT NULL,
+                location TEXT,
+                comment TEXT,
+                lat REAL,
+                lon REAL,
+                template_id INTEGER,
+                cancelled INTEGER NOT NULL,
+                going INTEGER NOT NULL,
+                later INTEGER NOT NULL,
+                declined INTEGER NOT NULL,
+                comments INTEGER NOT NULL,
+                participants TEXT NOT NULL
+            )
+        """)
+        archive_partitions.add(name)
+    return name
+
+def archive_proposals(cursor, where, params=(), now=None):
+    """Переносит в архив ещё не перенесённые предложения по условию и дополняет сводные таблицы.
+
+    Строка помечается archived = 1 в той же транзакции, что и запись в архив,
+    поэтому предложение учитывается ровно один раз. Прогулка, не дошедшая до
+    завершения (отменена автором или удалена очисткой раньше), попадает в архив
+    с cancelled = 1 и в статистике считается предложением без прогулки.
+    """
+    completed_before = ((now or clock.now()) - timedelta(seconds=WALK_COMPLETE_AFTER)).strftime('%Y-%m-%d %H:%M:%S')
+    cursor.execute(f"""
+        SELECT id, proposer_id, proposer_name, walk_datetime, location, comment, lat, lon, template_id
+        FROM proposals
+        WHERE archived = 0 AND ({where})
+    """, params)
+    archived = 0
+    for pid, proposer_id, proposer_name, walk_dt_str, location, comment, lat, lon, template_id in cursor.fetchall():
+        cursor.execute("UPDATE proposals SET archived = 1 WHERE id = ? AND archived = 0", (pid,))
+        if not cursor.rowcount:
+            continue
+        cursor.execute("SELECT voter_id, voter_name, vote_type FROM votes WHERE proposal_id = ?", (pid,))
+        votes = cursor.fetchall()
+        cursor.execute("SELECT COUNT(*) FROM comments WHERE proposal_id = ?", (pid,))
+        comments = cursor.fetchone()[0]
+        going = [[voter_id, name] for voter_id, name, vote_type in votes if vote_type == 'yes']
+        later = sum(1 for *_, vote_type in votes if vote_type == 'later')
+        cancelled = walk_dt_str > completed_before
+        walk_dt = datetime.strptime(walk_dt_str, '%Y-%m-%d %H:%M:%S')
+        cursor.execute(
+            f"INSERT OR IGNORE INTO {archive_table(cursor, walk_dt)} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (pid, proposer_id, proposer_name, walk_dt_str, location, comment, lat, lon, template_id, int(cancelled),
+             len(going), later, len(votes) - len(going) - later, comments,
+             json.dumps(going, ensure_ascii=False))
+        )
+        record_walk_stats(cursor, proposer_id, proposer_name, walk_dt, 0 if cancelled else len(going))
+        archived += 1
+    return archived
+
+def archive_completed_walks(now):
+    """Переносит завершённые прогулки в архив.
+
+    Живая строка остаётся до обычной очистки; то, что удаляется раньше
+    завершения, архивирует сама delete_proposals().
+    """
+    completed_before = (now - timedelta(seconds=WALK_COMPLETE_AFTER)).strftime('%Y-%m-%d %H:%M:%S')
+    with db_connect() as conn:
+        archived = archive_proposals(conn.cursor(), "walk_datetime <= ?", (completed_before,), now)
+    if archived:
+        log_event('walks_archived', walks=archived)
+    return archived
+
+def record_walk_stats(cursor, proposer_id, proposer_name, walk_dt, going):
+    walked = 1 if going else 0
+    confirmed = 1 if going >= WALK_CONFIRMED_MIN else 0
+    cursor.execute("""
+        INSERT INTO stats_daily (day, proposals, walks, confirmed, participants) VALUES (?, 1, ?, ?, ?)
+        ON CONFLICT(day) DO UPDATE SET proposals = proposals + 1, walks = walks + excluded.walks,
+            confirmed = confirmed + excluded.confirmed, participants = participants + excluded.participants
+    """, (walk_dt.strftime('%Y-%m-%d'), walked, confirmed, going))
+    cursor.execute("""
+        INSERT INTO stats_proposers (proposer_id, proposer_name, proposals, walks, participants) VALUES (?, ?, 1, ?, ?)
+        ON CONFLICT(proposer_id) DO UPDATE SET proposer_name = excluded.proposer_name, proposals = proposals + 1,
+            walks = walks + excluded.walks, participants = participants + excluded.participants
+    """, (proposer_id, proposer_name, walked, going))
+    if walked:
+        cursor.execute("""
+            INSERT INTO stats_hours (weekday, hour, walks, participants) VALUES (?, ?, 1, ?)
+            ON CONFLICT(weekday, hour) DO UPDATE SET walks = walks + 1, participants = participants + excluded.participants
+        """, (walk_dt.weekday(), walk_dt.hour, going))
+
+def render_stats():
+    """Текст /stats. Читает только сводные таблицы: число строк не зависит от объёма истории."""
+    today = clock.today()
+    first_day = (today - timedelta(days=STATS_DAYS - 1)).isoformat()
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT day, proposals, walks, confirmed, participants FROM stats_daily WHERE day >= ? ORDER BY day",
+            (first_day,)
+        )
+        days = cursor.fetchall()
+        cursor.execute("SELECT SUM(walks), SUM(participants) FROM stats_hours")
+        total_walks, total_participants = cursor.fetchone()
+        cursor.execute(
+            "SELECT weekday, hour, walks FROM stats_hours ORDER BY walks DESC, participants DESC LIMIT ?", (STATS_TOP,)
+        )
+        hours = cursor.fetchall()
+        cursor.execute("""
+            SELECT proposer_name, walks, participants FROM stats_proposers
+            WHERE participants > 0 ORDER BY participants DESC LIMIT ?
+        """, (STATS_TOP,))
+        proposers = cursor.fetchall()
+    if not total_walks and not days:
+        return "📈 Статистики пока нет: она появится, когда пройдут первые прогулки."
+
+    proposals = sum(row[1] for row in days)
+    walks = sum(row[2] for row in days)
+    confirmed = sum(row[3] for row in days)
+    participants = sum(row[4] for row in days)
+    lines = [
+        "📈 <b>Статистика прогулок</b>",
+        f"За всё время: прогулок {total_walks or 0}, участий {total_participants or 0}",
+        "",
+        f"<b>За {STATS_DAYS} дней:</b> предложений {proposals}, состоялось {walks}, подтверждено {confirmed}",
+    ]
+    if walks:
+        lines.append(f"В среднем {participants / walks:.1f} участника на прогулку")
+    per_day = {row[0]: row[2] for row in days}
+    week = [today - timedelta(days=i) for i in range(6, -1, -1)]
+    lines.append("По дням: " + " · ".join(f"{day:%d.%m} — {per_day.get(day.isoformat(), 0)}" for day in week))
+    if hours:
+        lines.append("")
+        lines.append("🕖 <b>Самые людные часы:</b> " + ", ".join(
+            f"{WEEKDAY_NAMES[weekday]} {hour:02d}:00 ({count})" for weekday, hour, count in hours
+        ))
+    if proposers:
+        lines.append("")
+        lines.append("👤 <b>Больше всего участников собирают:</b>")
+        lines.extend(
+            f"• {html.escape(name)} — {people} за {count} прогулок (в среднем {people / count:.1f})"
+            for name, count, people in proposers
+        )
+    return "\n".join(lines)
+
+# === ВЕДУЩИЙ ЭКЗЕМПЛЯР ===
+
+class LeaderLease:
+    """Аренда строки в таблице leases: фоновые задачи выполняет только её держатель.
+
+    Держатель продлевает аренду каждые LEADER_HEARTBEAT секунд. Резервный экземпляр
+    с тем же периодом пытается её взять и получает, как только срок истёк. Захват —
+    один условный UPSERT, поэтому двух держателей одновременно быть не может.
+    Держатель, не успевший продлить аренду, сам считает себя резервным уже по
+    своим часам, не дожидаясь чужого захвата.
+    """
+
+    def __init__(self, name, holder, ttl=LEADER_LEASE_TTL):
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+        self.term = 0
+        self.leader = None  # держатель по последней попытке
+        self.watermark = None
+        self._deadline = 0.0  # до какого момента аренда наша наверняка
+
+    def heartbeat(self):
+        """Продлевает или перехватывает аренду. True — мы держатель."""
+        now = clock.now().timestamp()
+        with db_connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO leases (name, holder, expires) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    term = term + (holder != excluded.holder),
+                    holder = excluded.holder, expires = excluded.expires
+                WHERE holder = excluded.holder OR expires < ?
+            """, (self.name, self.holder, now + self.ttl, now))
+            cursor.execute("SELECT holder, term, watermark FROM leases WHERE name = ?", (self.name,))
+            holder, term, watermark = cursor.fetchone()
+            took_over = holder == self.holder and term != self.term
+            if took_over:
+                # Заявки прежнего держателя, прерванные на полпути, закрываем без повтора:
+                # сообщение могло уже уйти, а дважды его присылать нельзя
+                cursor.execute("UPDATE proposals SET processed = 1 WHERE processed = 2")
+                orphaned = cursor.rowcount
+        # Пока аренду держал другой, данные менял он: индексы в памяти этого экземпляра устарели
+        stale = took_over and (self.term or self.leader not in (None, self.holder))
+        self.leader = holder
+        if holder != self.holder:
+            self._deadline = 0.0
+            return False
+        self._deadline = now + self.ttl
+        if took_over:
+            self.term = term
+            self.watermark = datetime.strptime(watermark, '%Y-%m-%d %H:%M:%S') if watermark else None
+            if stale:
+                load_memory_state()
+            log_event('leader_acquired', holder=self.holder, term=term, orphaned_claims=orphaned, reloaded=bool(stale))
+        return True
+
+    def is_leader(self):
+        return clock.now().timestamp() < self._deadline
+
+    def save_watermark(self, window_end):
+        """Запоминает конец окна напоминаний: новый держатель продолжит с него."""
+        with db_connect() as conn:
+            conn.execute(
+                "UPDATE leases SET watermark = ? WHERE name = ? AND holder = ?",
+                (window_end.strftime('%Y-%m-%d %H:%M:%S'), self.name, self.holder)
+            )
+
+    def release(self):
+        """Отдаёт аренду при штатной остановке, чтобы резерв не ждал истечения срока."""
+        if not self.is_leader():
+            return
+        self._deadline = 0.0
+        with db_connect() as conn:
+            conn.execute(
+                "UPDATE leases SET expires = 0 WHERE name = ? AND holder = ?", (self.name, self.holder)
+            )
+
+    def keep_alive(self):
+        while True:
+            try:
+                self.heartbeat()
+            except Exception as e:
+                log_event('lease_error', logging.ERROR, holder=self.holder, **error_fields(e))
+            if LEASE_POLLING and not self.is_leader():
+                # Опрос закончится после текущего getUpdates; poll_while_leader продолжит его при захвате аренды
+                bot.stop_polling()
+            clock.sleep(LEADER_HEARTBEAT)
+
+leader_lease = LeaderLease('scheduler', INSTANCE_ID)
+
+# Предложение в планировщике: processed 0 — ждёт, 2 — взято в работу, 1 — обработано.
+# Переход 0 → 2 атомарен, поэтому одно напоминание не отправят два прохода,
+# даже если при смене держателя аренды они ненадолго пересеклись.
+
+def claim_proposal(proposal_id):
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE proposals SET processed = 2 WHERE id = ? AND processed = 0", (proposal_id,))
+        return cursor.rowcount == 1
+
+def finish_proposal(proposal_id, done):
+    """Закрывает заявку; при временной ошибке возвращает предложение в очередь."""
+    with db_connect() as conn:
+        conn.execute(
+            "UPDATE proposals SET processed = ? WHERE id = ? AND processed = 2", (1 if done else 0, proposal_id)
+        )
+
+def run_scheduled_jobs(now, since=None):
+    """Один проход планировщика: шаблоны, напоминания и вопрос «никто не откликнулся».
+
+    Напоминание уходит, если его момент попал в [since, now + интервал + 1 с).
+    background_worker передаёт в since конец окна прошлого прохода, поэтому
+    окна идут встык и напоминание не теряется, даже если проход затянулся.
+    Возвращает конец окна для следующего прохода.
+    """
+    since = since or now
+    window_end = now + timedelta(seconds=REMINDER_CHECK_INTERVAL + 1)
+    two_hours_ago = now - timedelta(hours=2)
+    materialize_templates(now)
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        # Индекс отсекает прогулки дальше REMINDER_MAX_MINUTES, условие на момент
+        # напоминания — остальные; точная граница окна проверяется ниже
+        cursor.execute("""
+            SELECT p.id, p.proposer_id, p.time_str, p.walk_datetime, COALESCE(s.reminder_minutes, 10) AS rem_mins,
+                   (SELECT COUNT(*) FROM votes v WHERE v.proposal_id = p.id AND v.vote_type = 'yes')
+            FROM proposals p
+            LEFT JOIN user_settings s ON p.proposer_id = s.user_id
+            WHERE p.processed = 0 AND p.walk_datetime > ? AND p.walk_datetime <= ?
+              AND datetime(p.walk_datetime, -COALESCE(s.reminder_minutes, 10) || ' minutes') BETWEEN ? AND ?
+        """, (now.strftime('%Y-%m-%d %H:%M:%S'),
+              (window_end + timedelta(minutes=REMINDER_MAX_MINUTES)).strftime('%Y-%m-%d %H:%M:%S'),
+              since.strftime('%Y-%m-%d %H:%M:%S'), window_end.strftime('%Y-%m-%d %H:%M:%S')))
+        reminders = []
+        for pid, proposer_id, time_str, walk_dt_str, rem_mins, going_count in cursor.fetchall():
+            walk_dt = datetime.strptime(walk_dt_str, '%Y-%m-%d %H:%M:%S')
+            if going_count > 0 and since <= walk_dt - timedelta(minutes=rem_mins) < window_end:
+                reminders.append((pid, proposer_id, time_str, rem_mins, going_count))
+
+        cursor.execute("""
+            SELECT p.id, p.proposer_id, p.time_str,
+                   EXISTS (SELECT 1 FROM votes v WHERE v.proposal_id = p.id AND v.vote_type = 'yes')
+            FROM proposals p
+            WHERE p.walk_datetime <= ? AND p.processed = 0
+        """, (two_hours_ago.strftime('%Y-%m-%d %H:%M:%S'),))
+        unanswered = []
+        for pid, proposer_id, time_str, has_votes in cursor.fetchall():
+            if has_votes or proposer_id in unreachable_users:
+                # Спрашивать нечего; иначе голоса пересчитывались бы каждый проход до очистки
+                cursor.execute("UPDATE proposals SET processed = 1 WHERE id = ? AND processed = 0", (pid,))
+            else:
+                unanswered.append((pid, proposer_id, time_str))
+
+    for pid, proposer_id, time_str, rem_mins, going_count in reminders:
+        if proposer_id in unreachable_users:
+            with db_connect() as conn:
+                conn.execute("UPDATE proposals SET processed = 1 WHERE id = ? AND processed = 0", (pid,))
+            continue
+        if not claim_proposal(pid):
+            continue
+        try:
+            markup = types.InlineKeyboardMarkup()
+            markup.add(types.InlineKeyboardButton("✅ Уже выхожу", callback_data=f"confirm_going_{pid}"))
+            markup.add(types.InlineKeyboardButton("❌ Не получится", callback_data=f"cancel_last_min_{pid}"))
+            delivery_scheduler.call(DELIVERY_REMINDER, lambda: bot.send_message(
+                proposer_id,
+                f"⏰ Через {rem_mins} минут начинается прогулка на {time_str}!\n"
+                f"Идёшь? Участников: {going_count}",
+                reply_markup=markup
+            ))
+            finish_proposal(pid, True)
+        except Exception as e:
+            finish_proposal(pid, False)
+            record_delivery_failure(proposer_id, e, proposal_id=pid, api_method='sendMessage', kind='reminder')
+
+    for pid, proposer_id, time_str in unanswered:
+        if not claim_proposal(pid):
+            continue
+        try:
+            markup = types.InlineKeyboardMarkup()
+            markup.add(types.InlineKeyboardButton("🕒 Напомнить через 1 час", callback_data=f"remind_later_{pid}"))
+            markup.add(types.InlineKeyboardButton("🗑️ Отменить", callback_data=f"cancel_proposal_{pid}"))
+            delivery_scheduler.call(DELIVERY_REMINDER, lambda: bot.send_message(
+                proposer_id,
+                f"🕗 Никто не откликнулся на прогулку на {time_str}.\nЧто делаем?",
+                reply_markup=markup
+            ))
+            finish_proposal(pid, True)
+        except Exception as e:
+            finish_proposal(pid, False)
+            record_delivery_failure(proposer_id, e, proposal_id=pid, api_method='sendMessage', kind='no_response')
+    return window_end
+
+def background_tick(since=None):
+    """Один проход фоновых задач держателя аренды; возвращает since для следующего."""
+    try:
+        started = time.perf_counter()
+        now = clock.now()
+        shard_bus.catch_up()
+        # Первый проход после захвата аренды продолжает окно прежнего держателя
+        since = run_scheduled_jobs(now, since or leader_lease.watermark)
+        leader_lease.save_watermark(since)
+        flush_digests(now)
+        archive_completed_walks(now)
+        auto_delete_old_proposals_by_walk_time()
+        cleanup_old_proposals()
+        shard_bus.prune()
+        with db_connect() as conn:
+            collect_worker_metrics(conn.cursor(), now, started)
+    except Exception as e:
+        log_event('worker_error', logging.ERROR, **error_fields(e))
+    return since
+
 def background_worker():
+    """Проходы планировщика, пока этот экземпляр держит аренду; иначе — ожидание в резерве."""
+    since = None
     while True:
+        if not leader_lease.is_leader():
+            since = None
+            clock.sleep(LEADER_HEARTBEAT)
+            continue
+        since = background_tick(since)
+        clock.sleep(REMINDER_CHECK_INTERVAL)
+
+# === РЕЗЕРВНЫЕ КОПИИ ===
+
+class BackupRestartedTooOften(Exception):
+    pass
+
+# Метрики последнего резервного копирования
+backup_metrics = {}
+
+def verify_snapshot(path):
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        conn.close()
+    return result == "ok", result
+
+def copy_database_online(target_path, pages=BACKUP_PAGES_PER_STEP, pause=BACKUP_STEP_PAUSE, max_restarts=3):
+    """Копирует живую базу небольшими шагами backup API.
+
+    Возвращает (самый долгий шаг, число перезапусков). Если запись из других
+    соединений слишком часто перезапускает копирование, снимок снимается одним
+    шагом — в режиме WAL это не блокирует писателей.
+    """
+    stats = {'longest_step': 0.0, 'restarts': 0, 'last_remaining': None, 'last_tick': None}
+
+    def progress(status, remaining, total):
+        now = time.perf_counter()
+        step = now - stats['last_tick'] - pause if stats['last_tick'] else now - stats['started']
+        stats['longest_step'] = max(stats['longest_step'], step)
+        stats['last_tick'] = now
+        if stats['last_remaining'] is not None and remaining > stats['last_remaining']:
+            stats['restarts'] += 1
+            if stats['restarts'] > max_restarts:
+                raise BackupRestartedTooOften()
+        stats['last_remaining'] = remaining
+
+    source = sqlite3.connect(DB_PATH)
+    try:
+        target = sqlite3.connect(target_path)
         try:
-            now = datetime.now()
-            two_hours_ago = now - timedelta(hours=2)
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT p.id, p.proposer_id, p.time_str, p.walk_datetime, COALESCE(s.reminder_minutes, 10) AS rem_mins
-                    FROM proposals p
-                    LEFT JOIN user_settings s ON p.proposer_id = s.user_id
-                    WHERE p.walk_datetime > ? AND p.processed = 0
-                """, (now.strftime('%Y-%m-%d %H:%M:%S'),))
-                all_proposals = cursor.fetchall()
-                for pid, proposer_id, time_str, walk_dt_str, rem_mins in all_proposals:
-                    walk_dt = datetime.strptime(walk_dt_str, '%Y-%m-%d %H:%M:%S')
-                    remind_time = walk_dt - timedelta(minutes=rem_mins)
-                    if now <= remind_time < now + timedelta(seconds=REMINDER_CHECK_INTERVAL + 1):
-                        cursor.execute("SELECT COUNT(*) FROM votes WHERE proposal_id = ? AND vote_type = 'yes'", (pid,))
-                        going_count = cursor.fetchone()[0]
-                        if going_count > 0:
-                            try:
-                                markup = types.InlineKeyboardMarkup()
-                                markup.add(types.InlineKeyboardButton("✅ Уже выхожу", callback_data=f"confirm_going_{pid}"))
-                                markup.add(types.InlineKeyboardButton("❌ Не получится", callback_data=f"cancel_last_min_{pid}"))
-                                bot.send_message(
-                                    proposer_id,
-                                    f"⏰ Через {rem_mins} минут начинается прогулка на {time_str}!\n"
-                                    f"Идёшь? Участников: {going_count}",
-                                    reply_markup=markup
-                                )
-                                cursor.execute("UPDATE proposals SET processed = 1 WHERE id = ?", (pid,))
-                            except Exception as e:
-                                print(f"❌ Ошибка отправки напоминания автору {proposer_id}: {e}")
-
-                cursor.execute("""
-                    SELECT id, proposer_id, proposer_name, time_str, walk_datetime
-                    FROM proposals
-                    WHERE walk_datetime <= ? AND processed = 0
-                """, (two_hours_ago.strftime('%Y-%m-%d %H:%M:%S'),))
-                candidates = cursor.fetchall()
-                for pid, proposer_id, proposer_name, time_str, _ in candidates:
-                    cursor.execute("SELECT COUNT(*) FROM votes WHERE proposal_id = ? AND vote_type = 'yes'", (pid,))
-                    yes_votes = cursor.fetchone()[0]
-                    if yes_votes == 0:
-                        try:
-                            markup = types.InlineKeyboardMarkup()
-                            markup.add(types.InlineKeyboardButton("🕒 Напомнить через 1 час", callback_data=f"remind_later_{pid}"))
-                            markup.add(types.InlineKeyboardButton("🗑️ Отменить", callback_data=f"cancel_proposal_{pid}"))
-                            bot.send_message(
-                                proposer_id,
-                                f"🕗 Никто не откликнулся на прогулку на {time_str}.\nЧто делаем?",
-                                reply_markup=markup
-                            )
-                            cursor.execute("UPDATE proposals SET processed = 1 WHERE id = ?", (pid,))
-                        except Exception as e:
-                            print(f"❌ Не удалось отправить уведомление автору {proposer_id}: {e}")
-
-            auto_delete_old_proposals_by_walk_time()
-            cleanup_old_proposals()
-            time.sleep(REMINDER_CHECK_INTERVAL)
+            stats['started'] = time.perf_counter()
+            try:
+                source.backup(target, pages=pages, progress=progress, sleep=pause)
+            except BackupRestartedTooOften:
+                started = time.perf_counter()
+                source.backup(target, pages=-1)
+                stats['longest_step'] = max(stats['longest_step'], time.perf_counter() - started)
+        finally:
+            target.close()
+    finally:
+        source.close()
+    return stats['longest_step'], stats['restarts']
+
+def list_snapshots():
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    base = os.path.splitext(os.path.basename(DB_PATH))[0]
+    return sorted(
+        os.path.join(BACKUP_DIR, name) for name in os.listdir(BACKUP_DIR)
+        if name.startswith(base + "-") and name.endswith(".db")
+    )
+
+def make_backup():
+    """Снимает проверенный снимок базы и удаляет лишние старые снимки."""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    base = os.path.splitext(os.path.basename(DB_PATH))[0]
+    final_path = os.path.join(BACKUP_DIR, f"{base}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db")
+    tmp_path = final_path + ".tmp"
+    started = time.perf_counter()
+    db_metrics.start_window()
+    try:
+        longest_step, restarts = copy_database_online(tmp_path)
+        ok, detail = verify_snapshot(tmp_path)
+        if not ok:
+            raise sqlite3.DatabaseError(f"integrity_check: {detail}")
+        os.replace(tmp_path, final_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    for old in list_snapshots()[:-BACKUP_KEEP]:
+        os.remove(old)
+    backup_metrics.update({
+        'path': final_path,
+        'finished_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'duration': round(time.perf_counter() - started, 3),
+        'longest_step': round(longest_step, 4),
+        'longest_transaction': round(db_metrics.window_max, 4),  # самый долгий блок `with db_connect()` за копирование
+        'restarts': restarts,
+        'size': os.path.getsize(final_path),
+    })
+    log_event('backup', **backup_metrics)
+    return final_path
+
+def database_in_use():
+    """Причина считать, что с базой работает запущенный бот, или None.
+
+    Живая аренда планировщика значит, что какой-то экземпляр её продлевает;
+    WAL, менявшийся в пределах срока аренды, — что кто-то недавно писал в базу.
+    """
+    if not os.path.exists(DB_PATH):
+        return None
+    with sqlite3.connect(DB_PATH) as conn:
+        try:
+            row = conn.execute(
+                "SELECT holder FROM leases WHERE expires > ? ORDER BY expires DESC LIMIT 1",
+                (clock.now().timestamp(),)
+            ).fetchone()
+        except sqlite3.OperationalError:
+            row = None  # база без таблицы аренд: бот её ещё не открывал
+    if row:
+        return f"аренду держит экземпляр {row[0]}"
+    wal_path = DB_PATH + '-wal'
+    if os.path.exists(wal_path) and os.path.getsize(wal_path) and time.time() - os.path.getmtime(wal_path) < LEADER_LEASE_TTL:
+        return "журнал WAL менялся только что"
+    return None
+
+def restore_backup(snapshot_path):
+    """Восстанавливает базу из снимка. Бот на время восстановления должен быть остановлен."""
+    busy = database_in_use()
+    if busy:
+        raise RuntimeError(f"База используется ({busy}); остановите бота перед восстановлением")
+    ok, detail = verify_snapshot(snapshot_path)
+    if not ok:
+        raise sqlite3.DatabaseError(f"Снимок повреждён: {detail}")
+    if os.path.exists(DB_PATH):
+        previous = f"{DB_PATH}.before-restore-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        with sqlite3.connect(DB_PATH) as src, sqlite3.connect(previous) as dst:
+            src.backup(dst)
+        print(f"📦 Текущая база сохранена в {previous}")
+    with sqlite3.connect(snapshot_path) as src, sqlite3.connect(DB_PATH) as dst:
+        src.backup(dst)
+    print(f"✅ База восстановлена из {snapshot_path}")
+
+def backup_due_in():
+    """Секунд до следующего снимка по возрасту последнего; 0 — пора.
+
+    Отсчёт идёт от снимка, а не от запуска: бот, перезапускаемый чаще
+    BACKUP_INTERVAL, иначе не снимал бы копий вовсе.
+    """
+    snapshots = list_snapshots()
+    if not snapshots:
+        return 0
+    wait = os.path.getmtime(snapshots[-1]) + BACKUP_INTERVAL - time.time()
+    return min(max(0, wait), BACKUP_INTERVAL)
+
+def backup_scheduler():
+    while True:
+        wait = backup_due_in()
+        if wait:
+            time.sleep(wait)
+            continue
+        if not leader_lease.is_leader():
+            time.sleep(LEADER_HEARTBEAT)
+            continue
+        try:
+            make_backup()
         except Exception as e:
-            print(f"🔥 Ошибка в фоновом потоке: {e}")
-            time.sleep(REMINDER_CHECK_INTERVAL)
+            log_event('backup_failed', logging.ERROR, **error_fields(e))
+            time.sleep(BACKUP_INTERVAL)
 
-# === ЗАПУСК ===
+# === ВЫГРУЗКА И ЗАГРУЗКА ===
 
-if __name__ == '__main__':
+# Что переносится между экземплярами: таблица → столбцы с локальными номерами и чьи это номера.
+# user_id — id в Telegram, они общие; номера предложений и шаблонов при слиянии сдвигаются.
+# Сообщения бота (user_proposal_messages, digest_message_id) другому боту не принадлежат и не переносятся.
+TRANSFER_TABLES = {
+    'users': {},
+    'user_settings': {},
+    'subscriptions': {},
+    'walk_templates': {'id': 'walk_templates'},
+    'proposals': {'id': 'proposals', 'template_id': 'walk_templates'},
+    'votes': {'proposal_id': 'proposals'},
+    'comments': {'proposal_id': 'proposals'},
+}
+TRANSFER_SKIP_COLUMNS = {'user_settings': {'digest_message_id'}}
+CSV_NULL = r'\N'  # так в CSV записан NULL
+ARCHIVE_TABLE_RE = re.compile(r'^walk_archive_(\d{4})_(\d{2})$')
+
+def transfer_tables(cursor):
+    """Таблицы выгрузки по порядку: сначала те, на чьи номера ссылаются остальные, затем архив."""
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'walk_archive_%' ORDER BY name")
+    archives = [name for (name,) in cursor.fetchall() if ARCHIVE_TABLE_RE.match(name)]
+    return list(TRANSFER_TABLES) + archives
+
+def remapped_columns(table):
+    if ARCHIVE_TABLE_RE.match(table):
+        return {'id': 'proposals'}
+    return TRANSFER_TABLES.get(table, {})
+
+def open_transfer_file(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+def csv_row(row):
+    """Строка для CSV: NULL — CSV_NULL, а строке с «\\» в начале он удваивается, чтобы её не спутать с NULL."""
+    values = []
+    for value in row:
+        if value is None:
+            value = CSV_NULL
+        elif isinstance(value, str) and value.startswith('\\'):
+            value = '\\' + value
+        values.append(value)
+    return values
+
+def csv_value(value):
+    """Обратное к csv_row для одного значения из CSV."""
+    if value == CSV_NULL:
+        return None
+    return value[1:] if value.startswith('\\') else value
+
+def export_data(path, fmt='ndjson', compress=False):
+    """Потоковая выгрузка: NDJSON одним файлом или CSV по файлу на таблицу в каталоге path.
+
+    NDJSON: первая строка — заголовок выгрузки, перед строками каждой таблицы —
+    {"table": ..., "columns": [...]}, сами строки — JSON-массивы. Все таблицы
+    читаются в одной транзакции, так что ссылки между ними согласованы, а в
+    памяти одновременно не больше TRANSFER_BATCH строк. В CSV NULL пишется
+    как CSV_NULL, пустая строка остаётся пустой.
+    """
+    started = time.perf_counter()
+    total = 0
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        tables = transfer_tables(cursor)
+        if fmt == 'ndjson':
+            out = open_transfer_file(path + ('.gz' if compress and not path.endswith('.gz') else ''), 'w')
+            out.write(json.dumps({'format': 'walk-bot', 'version': 1, 'created': datetime.now().isoformat()}) + "\n")
+        else:
+            os.makedirs(path, exist_ok=True)
+        for table in tables:
+            table_started = time.perf_counter()
+            cursor.execute(f"PRAGMA table_info({table})")
+            columns = [col[1] for col in cursor.fetchall() if col[1] not in TRANSFER_SKIP_COLUMNS.get(table, ())]
+            cursor.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY rowid")
+            if fmt == 'ndjson':
+                out.write(json.dumps({'table': table, 'columns': columns}, ensure_ascii=False) + "\n")
+                write_rows = lambda rows: out.writelines(
+                    json.dumps(row, ensure_ascii=False, separators=(',', ':')) + "\n" for row in rows
+                )
+                table_file = None
+            else:
+                table_file = open_transfer_file(os.path.join(path, f"{table}.csv" + ('.gz' if compress else '')), 'w')
+                writer = csv.writer(table_file)
+                writer.writerow(columns)
+                write_rows = lambda rows, writer=writer: writer.writerows(map(csv_row, rows))
+            count = 0
+            while True:
+                rows = cursor.fetchmany(TRANSFER_BATCH)
+                if not rows:
+                    break
+                write_rows(rows)
+                count += len(rows)
+            if table_file:
+                table_file.close()
+            total += count
+            elapsed = time.perf_counter() - table_started
+            print(f"   {table}: {count} строк, {count / elapsed if elapsed else 0:.0f} строк/с")
+        if fmt == 'ndjson':
+            out.close()
+        conn.rollback()
+    finally:
+        conn.close()
+    elapsed = time.perf_counter() - started
+    print(f"✅ Выгружено {total} строк за {elapsed:.2f} с ({total / elapsed if elapsed else 0:.0f} строк/с)")
+    return total
+
+def read_export(path, fmt):
+    """Строки выгрузки по порядку: (таблица, столбцы, пачка строк ≤ TRANSFER_BATCH)."""
+    if fmt == 'ndjson':
+        with open_transfer_file(path, 'r') as f:
+            header = json.loads(f.readline())
+            if header.get('format') != 'walk-bot':
+                raise ValueError(f"{path}: это не выгрузка бота")
+            table, columns, batch = None, None, []
+            for line in f:
+                item = json.loads(line)
+                if isinstance(item, dict):
+                    if batch:
+                        yield table, columns, batch
+                    table, columns, batch = item['table'], item['columns'], []
+                    continue
+                batch.append(item)
+                if len(batch) >= TRANSFER_BATCH:
+                    yield table, columns, batch
+                    batch = []
+            if batch:
+                yield table, columns, batch
+        return
+    names = sorted(os.listdir(path))
+    for table in list(TRANSFER_TABLES) + [n.split('.')[0] for n in names if ARCHIVE_TABLE_RE.match(n.split('.')[0])]:
+        file_name = next((n for n in (f"{table}.csv", f"{table}.csv.gz") if n in names), None)
+        if not file_name:
+            continue
+        with open_transfer_file(os.path.join(path, file_name), 'r') as f:
+            reader = csv.reader(f)
+            columns = next(reader)
+            batch = []
+            for row in reader:
+                batch.append(row)
+                if len(batch) >= TRANSFER_BATCH:
+                    yield table, columns, batch
+                    batch = []
+            if batch:
+                yield table, columns, batch
+
+def import_data(path, fmt='ndjson', resume=True):
+    """Потоковая загрузка выгрузки в DB_PATH; бот на это время должен быть остановлен.
+
+    Каждая пачка вставляется одним executemany в своей транзакции, после неё
+    в файл состояния пишется, сколько строк уже загружено, — прерванная
+    загрузка продолжается с этого места. Если в базе уже есть предложения или
+    шаблоны, их номера из выгрузки сдвигаются за последние номера базы; сдвиг
+    тоже хранится в состоянии. INSERT OR IGNORE оставляет в силе то, что в
+    базе уже было (пользователей, настройки), и делает повтор пачки безвредным.
+    """
+    busy = database_in_use()
+    if busy:
+        raise RuntimeError(f"База используется ({busy}); остановите бота перед загрузкой")
+    state_path = path.rstrip('/') + '.import-state'
+    state = None
+    if resume and os.path.exists(state_path):
+        with open(state_path, encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('db') != os.path.abspath(DB_PATH):
+            raise ValueError(f"{state_path} относится к другой базе: {state.get('db')}")
+        print(f"↩️ Продолжаю загрузку с {state['rows']}-й строки")
     init_db()
-    with sqlite3.connect(DB_PATH) as conn:
+    migrate_db()
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        cursor = conn.cursor()
+        if state is None:
+            offsets = {}
+            for table in ('proposals', 'walk_templates'):
+                cursor.execute(
+                    f"SELECT MAX(COALESCE((SELECT MAX(id) FROM {table}), 0), "
+                    f"COALESCE((SELECT seq FROM sqlite_sequence WHERE name = ?), 0))", (table,)
+                )
+                offsets[table] = cursor.fetchone()[0]
+            state = {'db': os.path.abspath(DB_PATH), 'offsets': offsets, 'rows': 0}
+        offsets = state['offsets']
+        if any(offsets.values()):
+            print(f"🔢 База не пуста: номера сдвигаются на {offsets}")
+        started = time.perf_counter()
+        position = loaded = 0
+        target_columns = {}
+        for table, columns, rows in read_export(path, fmt):
+            if position + len(rows) <= state['rows']:
+                position += len(rows)
+                continue
+            rows = rows[max(0, state['rows'] - position):]
+            position = max(position, state['rows'])
+            if table not in target_columns:
+                match = ARCHIVE_TABLE_RE.match(table)
+                if match:
+                    archive_table(cursor, datetime(int(match.group(1)), int(match.group(2)), 1))
+                cursor.execute(f"PRAGMA table_info({table})")
+                types_by_name = {col[1]: (col[2] or '').upper() for col in cursor.fetchall()}
+                if not types_by_name:
+                    raise ValueError(f"В базе нет таблицы {table}")
+                target_columns[table] = types_by_name
+            types_by_name = target_columns[table]
+            keep = [i for i, name in enumerate(columns) if name in types_by_name]
+            names = [columns[i] for i in keep]
+            shifts = {columns.index(col): offsets.get(owner, 0)
+                      for col, owner in remapped_columns(table).items() if col in columns}
+
+            def convert(row):
+                values = []
+                for i in keep:
+                    value = row[i]
+                    if fmt == 'csv':
+                        value = csv_value(value)
+                    if i in shifts and value not in (None, ''):
+                        value = int(value) + shifts[i]
+                    values.append(value)
+                return values
+
+            cursor.execute("BEGIN")
+            cursor.executemany(
+                f"INSERT OR IGNORE INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+                map(convert, rows)
+            )
+            conn.commit()
+            position += len(rows)
+            loaded += len(rows)
+            state['rows'] = position
+            with open(state_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(state_path + '.tmp', state_path)
+        elapsed = time.perf_counter() - started
+    finally:
+        conn.close()
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    print(f"✅ Загружено {loaded} строк за {elapsed:.2f} с ({loaded / elapsed if elapsed else 0:.0f} строк/с)")
+    return loaded
+
+def transfer_cli(argv):
+    parser = argparse.ArgumentParser(prog='telebot3.py', description="Выгрузка и загрузка данных бота")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('export', help='выгрузить пользователей, предложения, голоса, комментарии и настройки')
+    p.add_argument('path', help='файл .ndjson[.gz] или каталог для CSV')
+    p.add_argument('--format', choices=('ndjson', 'csv'), default='ndjson')
+    p.add_argument('--gzip', action='store_true', help='сжимать (для NDJSON — то же, что имя на .gz)')
+    p = sub.add_parser('import', help='загрузить выгрузку в базу, в том числе непустую')
+    p.add_argument('path')
+    p.add_argument('--format', choices=('ndjson', 'csv'), default='ndjson')
+    p.add_argument('--restart', action='store_true', help='не продолжать прерванную загрузку, а начать заново')
+    args = parser.parse_args(argv)
+    if args.command == 'export':
+        export_data(args.path, args.format, args.gzip)
+    else:
+        import_data(args.path, args.format, resume=not args.restart)
+
+# === ПРИЁМ ОБНОВЛЕНИЙ ===
+
+PRIORITY_CALLBACK, PRIORITY_VOTE, PRIORITY_NAVIGATION, PRIORITY_REPORT = range(4)
+PRIORITY_NAMES = ('ответы', 'голоса', 'меню', 'отчёты')
+# Запросы, которые читают много строк или шлют много сообщений
+REPORT_TEXTS = {"Текущие прогулки", "Мои предложения"}
+REPORT_COMMANDS = {'/my_proposals', '/search', '/templates'}
+
+def classify_update(update):
+    """(приоритет, user_id) входящего обновления."""
+    if update.callback_query:
+        call = update.callback_query
+        priority = PRIORITY_VOTE if (call.data or "").startswith("vote_") else PRIORITY_CALLBACK
+        return priority, call.from_user.id
+    if update.inline_query:
+        return PRIORITY_CALLBACK, update.inline_query.from_user.id
+    message = update.message
+    if not message:
+        return PRIORITY_NAVIGATION, None
+    user_id = message.from_user.id if message.from_user else None
+    if message.chat.id in bot.next_step_backend.handlers:
+        # Ответ внутри диалога: обычная навигация, даже если похож на отчёт
+        return PRIORITY_NAVIGATION, user_id
+    text = message.text or ""
+    command = text.split(maxsplit=1)[0].split('@')[0] if text.startswith('/') else None
+    if text in REPORT_TEXTS or command in REPORT_COMMANDS or message.location or message.venue:
+        return PRIORITY_REPORT, user_id
+    return PRIORITY_NAVIGATION, user_id
+
+class UpdateDispatcher:
+    """Очереди входящих обновлений между опросом и обработчиками.
+
+    У каждого пользователя одна очередь, и его обновления обрабатываются по
+    одному строго в порядке поступления (цепочки register_next_step_handler от
+    этого зависят). Обработчики выбирают пользователя по самому срочному из
+    ждущих у него обновлений, а при равной срочности — по кругу, чтобы один
+    активный пользователь не задерживал остальных. Нажатие кнопки поднимает
+    всю очередь пользователя, но не обгоняет его же более раннее сообщение.
+    Если очередь приоритета или пользователя заполнена, обновление
+    отбрасывается, а пользователь получает вежливое «попробуйте ещё раз» —
+    его отправляет отдельный поток, чтобы не тормозить опрос.
+    """
+
+    def __init__(self, process, workers=INGEST_WORKERS, limits=INGEST_QUEUE_LIMITS, user_limit=INGEST_USER_LIMIT):
+        self._process = process
+        self.workers = workers
+        self.limits = limits
+        self.user_limit = user_limit
+        self._cond = threading.Condition()
+        self._lanes = {}  # user_id → deque[(время постановки, приоритет, update)]
+        self._ready = [OrderedDict() for _ in limits]  # по самому срочному в очереди: свободные user_id
+        self._depth = [0] * len(limits)
+        self._pending = {}  # user_id → обновлений в очередях и в работе
+        self._busy = set()
+        self._notified = {}
+        self._notices = queue.Queue(INGEST_NOTICE_QUEUE)
+        self.notices_dropped = 0
+        self.counters = [{'queued': 0, 'processed': 0, 'shed': 0} for _ in limits]
+        self.wait_ewma = [0.0] * len(limits)
+        self._started = False
+        # Внешний пул потоков (tenants.py): вызывается, когда появилась работа для poll()
+        self.on_ready = None
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"ingest-{i}", daemon=True).start()
+        threading.Thread(target=self._send_notices, name="ingest-notices", daemon=True).start()
+
+    def submit(self, updates):
+        """Замена bot.process_new_updates: не блокирует поток опроса."""
+        shed = []
+        with self._cond:
+            for update in updates:
+                # Смещение для getUpdates обычно двигает сам process_new_updates
+                bot.last_update_id = max(bot.last_update_id, update.update_id)
+                priority, user_id = classify_update(update)
+                if (self._depth[priority] >= self.limits[priority]
+                        or self._pending.get(user_id, 0) >= self.user_limit):
+                    self.counters[priority]['shed'] += 1
+                    shed.append((priority, user_id, update))
+                    continue
+                lane = self._lanes.setdefault(user_id, deque())
+                lane.append((time.monotonic(), priority, update))
+                if user_id not in self._busy:
+                    self._make_ready(user_id, lane)
+                self._depth[priority] += 1
+                self._pending[user_id] = self._pending.get(user_id, 0) + 1
+                self.counters[priority]['queued'] += 1
+                self._cond.notify()
+        if self.on_ready and len(shed) < len(updates):
+            self.on_ready()
+        for priority, user_id, update in shed:
+            log_event('update_shed', logging.WARNING, priority=PRIORITY_NAMES[priority], user_id=user_id)
+            self._notify_busy(user_id, update)
+
+    def _make_ready(self, user_id, lane):
+        """Ставит свободного пользователя в круг по самому срочному из его обновлений."""
+        for users in self._ready:
+            users.pop(user_id, None)
+        self._ready[min(priority for _, priority, _ in lane)][user_id] = None
+
+    def _next_locked(self):
+        for users in self._ready:
+            if not users:
+                continue
+            user_id, _ = users.popitem(last=False)
+            lane = self._lanes[user_id]
+            enqueued_at, priority, update = lane.popleft()
+            if not lane:
+                del self._lanes[user_id]
+            self._depth[priority] -= 1
+            self._busy.add(user_id)
+            wait = time.monotonic() - enqueued_at
+            self.wait_ewma[priority] = 0.8 * self.wait_ewma[priority] + 0.2 * wait
+            return priority, user_id, update
+        return None
+
+    def poll(self):
+        """Следующее обновление для execute() или None, не дожидаясь."""
+        with self._cond:
+            return self._next_locked()
+
+    def execute(self, item):
+        priority, user_id, update = item
+        try:
+            self._process([update])
+        except Exception as e:
+            log_event('update_failed', logging.ERROR, priority=PRIORITY_NAMES[priority], **error_fields(e))
+        finally:
+            with self._cond:
+                self._busy.discard(user_id)
+                self._pending[user_id] -= 1
+                waiting = self._pending[user_id] > 0
+                if not waiting:
+                    del self._pending[user_id]
+                else:
+                    self._make_ready(user_id, self._lanes[user_id])
+                self.counters[priority]['processed'] += 1
+                # Следующее обновление этого пользователя могло ждать, пока он занят
+                self._cond.notify_all()
+            if waiting and self.on_ready:
+                self.on_ready()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                item = self._next_locked()
+                while item is None:
+                    self._cond.wait()
+                    item = self._next_locked()
+            self.execute(item)
+
+    def _notify_busy(self, user_id, update):
+        """Ставит «бот занят» в очередь уведомлений; сам вызов API делает _send_notices."""
+        if update.callback_query:
+            # Без ответа у пользователя крутится часик на кнопке
+            notice = (bot.answer_callback_query, update.callback_query.id, "⏳ Бот перегружен, нажмите ещё раз через минуту.")
+        elif update.message:
+            now = time.monotonic()
+            with self._cond:
+                if now - self._notified.get(user_id, -INGEST_BUSY_NOTICE_INTERVAL) < INGEST_BUSY_NOTICE_INTERVAL:
+                    return
+                self._notified[user_id] = now
+                if len(self._notified) > 10000:
+                    self._notified.clear()
+            notice = (bot.send_message, update.message.chat.id, "⏳ Сейчас очень много запросов. Попробуйте ещё раз через минуту.")
+        else:
+            return
+        try:
+            self._notices.put_nowait((user_id, notice))
+        except queue.Full:
+            self.notices_dropped += 1
+
+    def _send_notices(self):
+        while True:
+            user_id, (send, target, text) = self._notices.get()
+            try:
+                send(target, text)
+            except Exception as e:
+                log_event('busy_notice_failed', logging.WARNING, user_id=user_id, **error_fields(e))
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'depth': list(self._depth),
+                'busy_users': len(self._busy),
+                'notices_dropped': self.notices_dropped,
+                'wait_ms': [round(w * 1000, 1) for w in self.wait_ewma],
+                **{key: [c[key] for c in self.counters] for key in ('queued', 'processed', 'shed')},
+            }
+
+update_dispatcher = UpdateDispatcher(bot.process_new_updates)
+
+# === ШАРДЫ ===
+
+class ShardBus:
+    """Оповещения между процессами об изменённом состоянии в памяти.
+
+    У каждого процесса свои кэши карточек и предложений, индекс подписок и
+    множества unreachable_users/digest_users. Процесс, изменивший данные, пишет
+    в shard_events, что устарело; остальные дочитывают новые события перед
+    каждым обновлением и сбрасывают у себя эти записи. В однопроцессном режиме
+    шина выключена и publish() ничего не делает.
+    """
+
+    def __init__(self):
+        self.origin = 'main'
+        self.enabled = False
+        self._seen = 0
+        self._lock = threading.Lock()
+
+    def enable(self, origin):
+        self.origin = origin
+        with db_connect() as conn:
+            # seq из AUTOINCREMENT не переиспользуется: берём последний выданный, даже если событие удалено
+            self._seen = conn.execute(
+                "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'shard_events'), 0)"
+            ).fetchone()[0]
+        self.enabled = True
+
+    def publish(self, kind, *keys):
+        if not self.enabled or not keys:
+            return
+        now = time.time()
+        with db_connect() as conn:
+            conn.executemany(
+                "INSERT INTO shard_events (created, origin, kind, key) VALUES (?, ?, ?, ?)",
+                [(now, self.origin, kind, key) for key in keys]
+            )
+
+    def catch_up(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            with db_connect() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "SELECT seq, origin, kind, key FROM shard_events WHERE seq > ? ORDER BY seq", (self._seen,)
+                )
+                events = cursor.fetchall()
+            if events and events[0][0] != self._seen + 1:
+                # Пропущенные события уже удалены очисткой: неизвестно, что устарело, перечитываем всё
+                self._reload_all()
+            for seq, origin, kind, key in events:
+                self._seen = seq
+                if origin != self.origin:
+                    self._apply(kind, key)
+
+    def _apply(self, kind, key):
+        if kind in ('proposal', 'closed'):
+            proposal_cache.invalidate(key)
+            card_renderer.forget(key)
+            if kind == 'closed':
+                live_proposals.discard(key)
+        elif kind == 'user':
+            reload_user_state(key)
+        elif kind == 'pause':
+            if key and not broadcasts_paused.is_set():
+                pause_broadcasts(publish=False)
+            elif not key and broadcasts_paused.is_set():
+                resume_broadcasts(publish=False)
+
+    def _reload_all(self):
+        load_memory_state()
+        log_event('shard_resync', origin=self.origin)
+
+    def prune(self):
+        if self.enabled:
+            with db_connect() as conn:
+                conn.execute("DELETE FROM shard_events WHERE created < ?", (time.time() - SHARD_EVENTS_KEEP,))
+
+shard_bus = ShardBus()
+
+def reload_user_state(user_id):
+    """Перечитывает из базы всё, что держится в памяти по пользователю."""
+    with db_connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT u.lat, u.lon, u.delivery_status, COALESCE(st.digest_minutes, 0), st.quiet_from, st.quiet_to,
+                   s.weekdays, s.hour_from, s.hour_to, s.places, s.authors, s.radius_km
+            FROM users u
+            LEFT JOIN subscriptions s ON s.user_id = u.user_id
+            LEFT JOIN user_settings st ON st.user_id = u.user_id
+            WHERE u.user_id = ?
+        """, (user_id,))
+        row = cursor.fetchone()
+    if not row:
+        return
+    lat, lon, status, digest_minutes, quiet_from, quiet_to, *rule = row
+    subscription_index.set_rule(user_id, tuple(rule) if rule[0] is not None else None)
+    if lat is not None:
+        subscription_index.set_home(user_id, lat, lon)
+    if status in UNREACHABLE_STATUSES:
+        unreachable_users.add(user_id)
+    else:
+        unreachable_users.discard(user_id)
+    if digest_minutes:
+        digest_users[user_id] = digest_minutes
+    else:
+        digest_users.pop(user_id, None)
+    if quiet_from is not None:
+        quiet_hours[user_id] = (quiet_from, quiet_to)
+    else:
+        quiet_hours.pop(user_id, None)
+
+def route_key(update):
+    """По какому id обновление закрепляется за шардом: пользователь, иначе чат."""
+    for item in (update.message, update.edited_message, update.callback_query, update.inline_query):
+        if item is None:
+            continue
+        if item.from_user:
+            return item.from_user.id
+        if getattr(item, 'chat', None):
+            return item.chat.id
+    return 0
+
+class ShardRouter:
+    """Раздаёт входящие обновления процессам-шардам по route_key(update) % shards.
+
+    Все обновления одного пользователя попадают в один процесс, где их, как и в
+    однопроцессном режиме, по порядку обрабатывает UpdateDispatcher — цепочки
+    register_next_step_handler остаются корректными. База общая: SQLite в режиме
+    WAL сама пропускает писателей по одному, остальные ждут в таймауте соединения.
+    Упавший шард перезапускается при следующей отправке ему обновлений, новый
+    процесс получает пачки, которые старый не успел взять. Если шард падает
+    чаще SHARD_MAX_RESTARTS раз в минуту, останавливается весь бот.
+    """
+
+    def __init__(self, shards, db_path=None, log_dir=None):
+        self.shards = shards
+        self.db_path = db_path or DB_PATH
+        self.log_dir = log_dir  # None — журнал шардов в общий stdout
+        self._ctx = multiprocessing.get_context('spawn')  # fork после запуска потоков небезопасен
+        self.inboxes = [self._ctx.Queue() for _ in range(shards)]
+        self.done = [self._ctx.Value('q', 0) for _ in range(shards)]  # обработано или отброшено шардом
+        self.taken = [self._ctx.Value('q', 0) for _ in range(shards)]  # пачек, взятых шардом из очереди
+        self._unread = [deque() for _ in range(shards)]  # отправленные пачки, которые шард ещё не взял
+        self._ready = self._ctx.Semaphore(0)
+        self.routed = [0] * shards
+        self.processes = [None] * shards
+        self._restarts = [[] for _ in range(shards)]
+
+    def _spawn(self, index):
+        log_path = os.path.join(self.log_dir, f"shard-{index}.log") if self.log_dir else None
+        process = self._ctx.Process(
+            target=run_shard, name=f"shard-{index}", daemon=True,
+            args=(index, self.shards, self.inboxes[index], self.done[index], self.taken[index], self._ready,
+                  self.db_path, log_path),
+        )
+        process.start()
+        self.processes[index] = process
+
+    def start(self):
+        """Запускает процессы и ждёт, пока каждый загрузит индексы в память."""
+        for index in range(self.shards):
+            self._spawn(index)
+        for _ in self.processes:
+            if not self._ready.acquire(timeout=SHARD_START_TIMEOUT):
+                self.stop()
+                raise SystemExit(f"❌ Шарды не запустились за {SHARD_START_TIMEOUT} с")
+
+    def _revive(self, index):
+        """Перезапускает упавший шард и передаёт новому процессу недочитанные пачки старого.
+
+        Теряется только пачка, которую шард успел взять из очереди: он мог умереть
+        посреди её обработки. Шард, не загрузившийся за SHARD_START_TIMEOUT,
+        считается упавшим ещё раз.
+        """
+        process = self.processes[index]
+        # Из старой очереди не читаем: умерший процесс мог унести её блокировку чтения
+        self._forget_taken(index)
+        salvaged = [batch for _, batch in self._unread[index]]
+        pending = sum(len(batch) for batch in salvaged)
+        lost = self.routed[index] - self.done[index].value - pending
+        log_event('shard_died', logging.ERROR, shard=index, exitcode=process.exitcode, lost_updates=lost)
+        while True:
+            now = time.monotonic()
+            self._restarts[index] = [t for t in self._restarts[index] if now - t < 60] + [now]
+            if len(self._restarts[index]) > SHARD_MAX_RESTARTS:
+                # Бот останавливается, а не молча теряет 1/N пользователей; опрос идёт без потоков
+                # TeleBot (bot.threaded = False), так что SystemExit доходит до основного потока
+                raise SystemExit(f"❌ Шард {index} упал {len(self._restarts[index])} раз за минуту, бот остановлен")
+            self.inboxes[index] = self._ctx.Queue()
+            self.taken[index].value = 0
+            self._unread[index].clear()
+            self._spawn(index)
+            if self._ready.acquire(timeout=SHARD_START_TIMEOUT):
+                break
+            self.processes[index].kill()
+            self.processes[index].join()
+            log_event('shard_start_timeout', logging.ERROR, shard=index)
+        self.routed[index] = self.done[index].value
+        for batch in salvaged:
+            self._send(index, batch)
+        log_event('shard_restarted', shard=index, requeued_updates=pending)
+
+    def _forget_taken(self, index):
+        unread = self._unread[index]
+        while unread and unread[0][0] < self.taken[index].value:
+            unread.popleft()
+
+    def _send(self, index, batch):
+        self._forget_taken(index)
+        sent = self._unread[index][-1][0] + 1 if self._unread[index] else self.taken[index].value
+        self._unread[index].append((sent, batch))
+        self.routed[index] += len(batch)
+        self.inboxes[index].put(batch)
+
+    def submit(self, updates):
+        """Замена bot.process_new_updates в процессе опроса."""
+        batches = {}
+        for update in updates:
+            bot.last_update_id = max(bot.last_update_id, update.update_id)
+            batches.setdefault(route_key(update) % self.shards, []).append(update)
+        for index, batch in batches.items():
+            if not self.processes[index].is_alive():
+                self._revive(index)
+            self._send(index, batch)
+
+    def backlog(self):
+        """Сколько переданных каждому шарду обновлений ещё не обработано."""
+        return [routed - done.value for routed, done in zip(self.routed, self.done)]
+
+    def stop(self):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+
+def run_shard(index, shards, inbox, done, taken, ready, db_path, log_path=None):
+    """Точка входа процесса-шарда: свои очереди UpdateDispatcher и своя доля лимита API."""
+    global DB_PATH, update_dispatcher
+    DB_PATH = db_path
+    setup_logging(open(log_path, 'a', encoding='utf-8') if log_path else None)
+    load_memory_state()
+    shard_bus.enable(f"shard-{index}")
+    api_guard.max_concurrency = max(2, API_MAX_CONCURRENCY // shards)
+    api_guard.limit = min(api_guard.limit, api_guard.max_concurrency)
+    delivery_scheduler.rate = max(1, DELIVERY_RATE // shards)
+    delivery_scheduler.reserve = DELIVERY_URGENT_RESERVE * delivery_scheduler.rate
+    delivery_scheduler.start()
+
+    def process(updates):
+        shard_bus.catch_up()
+        try:
+            bot.process_new_updates(updates)
+        finally:
+            with done.get_lock():
+                done.value += 1
+
+    bot.threaded = False
+    update_dispatcher = UpdateDispatcher(process)
+    update_dispatcher.start()
+    ready.release()
+    while True:
+        try:
+            batch = inbox.get(timeout=SHARD_SYNC_INTERVAL)
+        except queue.Empty:
+            shard_bus.catch_up()
+            continue
+        if batch is None:
+            return
+        with taken.get_lock():
+            taken.value += 1
+        shed = sum(update_dispatcher.snapshot()['shed'])
+        update_dispatcher.submit(batch)
+        shed = sum(update_dispatcher.snapshot()['shed']) - shed
+        if shed:
+            with done.get_lock():
+                done.value += shed
+
+# === ЗАПИСЬ ТРАФИКА ===
+
+class UpdateRecorder:
+    """Пишет входящие обновления в JSONL для loadtest.py replay.
+
+    Идентификаторы пользователей и чатов заменяются стабильным хешем, имена —
+    псевдонимами, телефоны удаляются. Координаты («Рядом со мной», геометки
+    прогулок) округляются до центра клетки GEO_CELL_SIZE, адреса мест
+    удаляются. Текст сообщений сохраняется: по нему обработчики выбирают ветку
+    диалога.
+    """
+
+    UPDATE_FIELDS = ('message', 'edited_message', 'callback_query')
+
+    def __init__(self, path, salt=None):
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+        self._salt = salt or os.environ.get('RECORD_SALT') or os.urandom(8).hex()
+
+    def _anon_id(self, value):
+        digest = hashlib.sha256(f"{self._salt}:{abs(value)}".encode()).hexdigest()
+        anon = int(digest[:12], 16) % 10**10 + 1
+        return -anon if value < 0 else anon
+
+    def _anonymize(self, obj):
+        if isinstance(obj, list):
+            return [self._anonymize(item) for item in obj]
+        if not isinstance(obj, dict):
+            return obj
+        result = {}
+        is_person = 'first_name' in obj or 'type' in obj
+        for key, value in obj.items():
+            if key in ('phone_number', 'address', 'foursquare_id', 'google_place_id'):
+                continue
+            if key in ('latitude', 'longitude') and isinstance(value, (int, float)):
+                # Обработчикам хватает клетки сетки: по ней ищутся прогулки рядом
+                result[key] = round((math.floor(value / GEO_CELL_SIZE) + 0.5) * GEO_CELL_SIZE, 6)
+            elif is_person and key == 'id' and isinstance(value, int):
+                result[key] = self._anon_id(value)
+            elif is_person and key in ('first_name', 'last_name', 'username', 'title'):
+                result[key] = f"u{self._anon_id(obj.get('id', 0)) % 100000}" if key != 'last_name' else ""
+            else:
+                result[key] = self._anonymize(value)
+        return result
+
+    def record(self, updates):
+        lines = []
+        for update in updates:
+            raw = {'update_id': update.update_id}
+            for field in self.UPDATE_FIELDS:
+                obj = getattr(update, field, None)
+                if obj is not None and getattr(obj, 'json', None):
+                    raw[field] = obj.json
+            if len(raw) > 1:
+                lines.append(json.dumps({'ts': time.time(), 'update': self._anonymize(raw)}, ensure_ascii=False))
+        if lines:
+            with self._lock:
+                self._file.write("\n".join(lines) + "\n")
+                self._file.flush()
+
+    def wrap(self, process_new_updates):
+        def wrapper(updates):
+            try:
+                self.record(updates)
+            except Exception as e:
+                log_event('record_failed', logging.WARNING, **error_fields(e))
+            return process_new_updates(updates)
+        return wrapper
+
+# === ЗАПУСК ===
+
+def migrate_db():
+    with db_connect() as conn:
         cursor = conn.cursor()
         cursor.execute("PRAGMA table_info(proposals)")
         columns = [col[1] for col in cursor.fetchall()]
@@ -1174,6 +5244,71 @@ if __name__ == '__main__':
         if 'editable' not in columns:
             print("🔧 Добавляю editable...")
             cursor.execute("ALTER TABLE proposals ADD COLUMN editable BOOLEAN DEFAULT 1")
+        if 'template_id' not in columns:
+            print("🔧 Добавляю template_id...")
+            cursor.execute("ALTER TABLE proposals ADD COLUMN template_id INTEGER")
+        if 'geocell' not in columns:
+            print("🔧 Добавляю геометки...")
+            cursor.execute("ALTER TABLE proposals ADD COLUMN lat REAL")
+            cursor.execute("ALTER TABLE proposals ADD COLUMN lon REAL")
+            cursor.execute("ALTER TABLE proposals ADD COLUMN geocell TEXT")
+        if 'archived' not in columns:
+            print("🔧 Добавляю архив прогулок...")
+            cursor.execute("ALTER TABLE proposals ADD COLUMN archived BOOLEAN DEFAULT 0")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_proposals_geocell ON proposals (geocell, walk_datetime) "
+            "WHERE geocell IS NOT NULL"
+        )
+        cursor.execute("SELECT (SELECT COUNT(*) FROM proposals), (SELECT COUNT(*) FROM proposal_search)")
+        proposals_count, indexed_count = cursor.fetchone()
+        if proposals_count and not indexed_count:
+            print("🔧 Строю поисковый индекс...")
+            cursor.execute("""
+                INSERT INTO proposal_search (rowid, location, comment, participant_comments)
+                SELECT p.id, p.location, p.comment, COALESCE((
+                    SELECT group_concat(c.comment, ' ') FROM comments c WHERE c.proposal_id = p.id
+                ), '')
+                FROM proposals p
+            """)
+        # Планировщик и очистка выбирают предложения по диапазону времени прогулки
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_proposals_due ON proposals (processed, walk_datetime)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_proposals_walk ON proposals (walk_datetime)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_proposals_timestamp ON proposals (timestamp)")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_proposals_unarchived ON proposals (walk_datetime) WHERE archived = 0"
+        )
+        # Очистка удаляет ссылки на сообщения по предложению
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_user_messages_proposal ON user_proposal_messages (proposal_id)"
+        )
+        # Не больше одного экземпляра шаблона в день, даже если время в шаблоне поменяли
+        cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_proposals_template_day "
+            "ON proposals (template_id, date(walk_datetime)) WHERE template_id IS NOT NULL"
+        )
+        cursor.execute("PRAGMA table_info(users)")
+        user_columns = [col[1] for col in cursor.fetchall()]
+        if 'delivery_status' not in user_columns:
+            print("🔧 Добавляю delivery_status...")
+            cursor.execute("ALTER TABLE users ADD COLUMN delivery_status TEXT DEFAULT 'active'")
+        if 'lat' not in user_columns:
+            cursor.execute("ALTER TABLE users ADD COLUMN lat REAL")
+            cursor.execute("ALTER TABLE users ADD COLUMN lon REAL")
+        cursor.execute("PRAGMA table_info(user_settings)")
+        if 'digest_minutes' not in [col[1] for col in cursor.fetchall()]:
+            print("🔧 Добавляю режим сводки...")
+            cursor.execute("ALTER TABLE user_settings ADD COLUMN digest_minutes INTEGER DEFAULT 0")
+            cursor.execute("ALTER TABLE user_settings ADD COLUMN digest_flushed_at DATETIME")
+            cursor.execute("ALTER TABLE user_settings ADD COLUMN digest_message_id INTEGER")
+            cursor.execute("ALTER TABLE user_settings ADD COLUMN digest_day TEXT")
+        cursor.execute("PRAGMA table_info(user_settings)")
+        if 'quiet_from' not in [col[1] for col in cursor.fetchall()]:
+            print("🔧 Добавляю тихие часы...")
+            cursor.execute("ALTER TABLE user_settings ADD COLUMN quiet_from INTEGER")
+            cursor.execute("ALTER TABLE user_settings ADD COLUMN quiet_to INTEGER")
+        cursor.execute("PRAGMA table_info(subscriptions)")
+        if 'radius_km' not in [col[1] for col in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE subscriptions ADD COLUMN radius_km REAL DEFAULT 0")
         conn.commit()
         if 'walk_datetime' not in columns:
             cursor.execute("SELECT id, time_str, timestamp FROM proposals WHERE walk_datetime = '2025-01-01 00:00:00'")
@@ -1193,9 +5328,79 @@ if __name__ == '__main__':
             conn.commit()
             print(f"✅ Исправлено {len(old_records)} записей.")
 
+def prepare_storage():
+    """Создаёт и мигрирует схему, загружает в память индексы рассылки."""
+    init_db()
+    migrate_db()
+    load_memory_state()
+
+def load_memory_state():
+    """Заново читает из базы всё, что держится в памяти: индексы рассылки, множества и кэши."""
+    proposal_cache.clear()
+    card_renderer.clear()
+    live_proposals.load()
+    subscription_index.rebuild()
+    load_unreachable_users()
+    load_digest_users()
+    load_quiet_hours()
+
+def poll_while_leader():
+    """Опрос getUpdates в режиме LEASE_POLLING: только пока этот экземпляр держит аренду.
+
+    Накопившиеся обновления не пропускаются (нет skip_pending): при смене
+    держателя это сообщения, которые прежний не успел забрать.
+    """
+    while True:
+        if not leader_lease.is_leader():
+            clock.sleep(LEADER_HEARTBEAT)
+            continue
+        # polling(), а не infinity_polling(): тот не запустится, пока стоит флаг от stop_polling() в резерве
+        try:
+            bot.polling(non_stop=True, timeout=10, long_polling_timeout=5)
+        except Exception as e:
+            log_event('polling_error', logging.ERROR, **error_fields(e))
+            clock.sleep(LEADER_HEARTBEAT)
+
+if __name__ == '__main__':
+    setup_logging()
+    if len(sys.argv) > 1 and sys.argv[1] == 'backup':
+        init_db()
+        make_backup()
+        sys.exit(0)
+    if len(sys.argv) > 2 and sys.argv[1] == 'restore':
+        restore_backup(sys.argv[2])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] in ('export', 'import'):
+        transfer_cli(sys.argv[1:])
+        sys.exit(0)
+    prepare_storage()
+    # Обработчики выполняют потоки диспетчера или шарды, а не пул TeleBot
+    bot.threaded = False
+    if SHARDS > 1:
+        shard_router = ShardRouter(SHARDS)
+        shard_router.start()
+        shard_bus.enable('main')
+        bot.process_new_updates = shard_router.submit
+        print(f"🧩 Обработчики в {SHARDS} процессах")
+    else:
+        update_dispatcher.start()
+        bot.process_new_updates = update_dispatcher.submit
+    if RECORD_UPDATES_PATH:
+        bot.process_new_updates = UpdateRecorder(RECORD_UPDATES_PATH).wrap(bot.process_new_updates)
+        print(f"📼 Входящие обновления пишутся в {RECORD_UPDATES_PATH}")
+    threading.Thread(target=leader_lease.keep_alive, name="lease", daemon=True).start()
+    atexit.register(leader_lease.release)
     threading.Thread(target=background_worker, daemon=True).start()
+    threading.Thread(target=backup_scheduler, daemon=True).start()
+    threading.Thread(target=card_finalizer.run, name="finalizer", daemon=True).start()
+    if SHARDS == 1:
+        delivery_scheduler.start()
     privacy_status = "🔒 Приватный" if ALLOWED_USER_IDS else "🌐 Публичный"
     print(f"✅ Бот запущен. Режим: {privacy_status}")
     if ALLOWED_USER_IDS:
         print(f"   Разрешённые user_id: {sorted(ALLOWED_USER_IDS)}")
-    bot.infinity_polling(timeout=10, long_polling_timeout=5, skip_pending=True)
\ No newline at end of file
+    if LEASE_POLLING:
+        print("🔁 Обновления принимает только держатель аренды, этот экземпляр может быть резервом")
+        poll_while_leader()
+    else:
+        bot.infinity_polling(timeout=10, long_polling_timeout=5, skip_pending=True)
\ No newline at end of file
@@ -0,0 +1,365 @@
+"""Несколько городов (ботов с разными токенами) в одном процессе.
+
+Запуск:
+    python tenants.py tenants.json
+
+Конфигурация (JSON):
+    {
+      "workers": 8,
+      "max_share": 0.5,
+      "tenants": [
+        {"name": "spb", "token_env": "SPB_BOT_TOKEN", "db": "walk_spb.db", "admins": [111]},
+        {"name": "msk", "token": "123:abc", "db": "walk_msk.db", "allowed": [222, 333]}
+      ]
+    }
+
+workers — общий пул потоков обработки на все города, max_share — доля пула,
+которую может занять один город, pool_size — соединений в общем HTTP-пуле
+(по умолчанию API_POOL_SIZE на город). У города: token или token_env, db,
+backup_dir (по умолчанию backups/<name>), admins и allowed — как
+ADMIN_USER_IDS и ALLOWED_USER_IDS.
+
+Каждый город — отдельная копия модуля telebot3 со своим токеном, базой,
+каталогом резервных копий, ограничителем ApiGuard (лимиты Telegram считаются
+на токен) и очередями. Общие на процесс: потоки обработки (TenantPool),
+HTTP-пул соединений и куча отложенных фоновых задач (TenantTimer). Записи
+журнала каждого города несут поле tenant.
+"""
+import argparse
+import atexit
+import heapq
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import deque
+
+BOT_MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telebot3.py')
+TENANT_METRICS_INTERVAL = 60  # секунд между записями tenant_metrics в журнал
+TOKEN_RE = re.compile(r'/bot([^/]+)/')
+
+
+def load_tenant(entry):
+    """Загружает отдельную копию telebot3 для города entry из конфигурации."""
+    name = entry['name']
+    token = entry.get('token') or os.environ.get(entry.get('token_env', ''))
+    if not token:
+        raise ValueError(f"❌ Не задан токен города {name} (token или token_env)")
+    # Модуль читает токен и имя города из окружения при импорте
+    os.environ['BOT_TOKEN'] = token
+    os.environ['TENANT'] = name
+    spec = importlib.util.spec_from_file_location(f"telebot3_{name}", BOT_MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.DB_PATH = entry.get('db') or f"walk_{name}.db"
+    module.BACKUP_DIR = entry.get('backup_dir') or os.path.join(module.BACKUP_DIR, name)
+    module.ADMIN_USER_IDS.update(entry.get('admins', ()))
+    module.ALLOWED_USER_IDS.update(entry.get('allowed', ()))
+    return module
+
+
+class Tenant:
+    """Город в общем пуле: его модуль и счётчики занятых им потоков."""
+
+    def __init__(self, name, module):
+        self.name = name
+        self.module = module
+        self.cap = 1
+        self.busy = 0  # потоков на обработчиках и фоновых задачах
+        self.sending = 0  # потоков на доставке
+        self.tasks = deque()
+        self.processed = 0
+        self.busy_seconds = 0.0
+        self.since = None  # конец окна планировщика, см. telebot3.background_tick
+        self.workers = 0
+
+    def stats(self):
+        ingest = self.module.update_dispatcher.snapshot()
+        delivery = self.module.delivery_scheduler.snapshot()
+        api = self.module.api_guard.snapshot()
+        return {
+            'busy': self.busy, 'sending': self.sending, 'cap': self.cap, 'workers': self.workers,
+            'processed': self.processed, 'busy_seconds': self.busy_seconds,
+            'ingest_depth': sum(ingest['depth']), 'ingest_shed': sum(ingest['shed']),
+            'delivery_queued': delivery['queued'], 'api_in_flight': api['in_flight'],
+            'api_state': api['state'],
+        }
+
+
+class TokenRouter:
+    """apihelper.CUSTOM_REQUEST_SENDER один на процесс: вызов уходит в ApiGuard города по токену в адресе."""
+
+    def __init__(self, tenants):
+        self._guards = {tenant.module.BOT_TOKEN: tenant.module.api_guard for tenant in tenants}
+
+    def request(self, method, url, **kwargs):
+        match = TOKEN_RE.search(url)
+        guard = self._guards.get(match.group(1)) if match else None
+        if guard is None:
+            raise ValueError("вызов API с токеном, которого нет в конфигурации")
+        return guard.request(method, url, **kwargs)
+
+
+class TenantPool:
+    """Общие потоки обработки для всех городов.
+
+    Поток берёт работу у городов по кругу: сначала доставку (её темп держит
+    бюджет отправок города), затем фоновые задачи, затем входящие обновления.
+    Город занимает не больше cap потоков на обработчиках и столько же на
+    доставке, поэтому всплеск в одном городе не останавливает остальные.
+    Фоновые задачи всех городов вместе занимают не больше workers - 1 потоков:
+    проход планировщика ждёт очереди в доставке, а выдаёт её свободный поток.
+    """
+
+    def __init__(self, tenants, workers, max_share):
+        if workers < 2:
+            raise ValueError("❌ Общему пулу нужно хотя бы 2 потока")
+        self.tenants = tenants
+        self.workers = workers
+        self.cap = max(1, int(workers * max_share))
+        self._cond = threading.Condition()
+        self._turn = 0
+        self._tasks_running = 0
+        for tenant in tenants:
+            tenant.cap = self.cap
+            tenant.workers = workers
+
+    def start(self):
+        for tenant in self.tenants:
+            module = tenant.module
+            # Потоки очередей города не нужны: их работу забирает poll() общего пула
+            module.update_dispatcher.workers = 0
+            module.update_dispatcher.on_ready = self.wake
+            module.update_dispatcher.start()
+            module.delivery_scheduler.workers = 0
+            module.delivery_scheduler.on_ready = self.wake
+            module.delivery_scheduler.start()
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"pool-{i}", daemon=True).start()
+
+    def wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def submit(self, tenant, fn):
+        """Фоновая задача города; выполнится в очередь с его обработчиками."""
+        with self._cond:
+            tenant.tasks.append(fn)
+            self._cond.notify()
+
+    def _pick(self):
+        timeout = None
+        count = len(self.tenants)
+        for offset in range(count):
+            tenant = self.tenants[(self._turn + offset) % count]
+            kind = item = None
+            if tenant.sending < tenant.cap:
+                item, wait = tenant.module.delivery_scheduler.poll()
+                if item is not None:
+                    kind = 'delivery'
+                    tenant.sending += 1
+                elif wait is not None:
+                    timeout = wait if timeout is None else min(timeout, wait)
+            if kind is None and tenant.busy < tenant.cap:
+                # Фоновые задачи редки, но под потоком обновлений иначе не дождались бы потока
+                if tenant.tasks and self._tasks_running < self.workers - 1:
+                    kind, item = 'task', tenant.tasks.popleft()
+                    self._tasks_running += 1
+                else:
+                    item = tenant.module.update_dispatcher.poll()
+                    kind = 'update' if item is not None else None
+                if kind is not None:
+                    tenant.busy += 1
+            if kind is not None:
+                self._turn = (self._turn + offset + 1) % count
+                return tenant, kind, item, None
+        return None, None, None, timeout
+
+    def _work(self):
+        while True:
+            with self._cond:
+                tenant, kind, item, timeout = self._pick()
+                while tenant is None:
+                    self._cond.wait(timeout)
+                    tenant, kind, item, timeout = self._pick()
+            started = time.monotonic()
+            try:
+                if kind == 'delivery':
+                    tenant.module.delivery_scheduler.execute(item)
+                elif kind == 'update':
+                    tenant.module.update_dispatcher.execute(item)
+                else:
+                    item()
+            except Exception as e:
+                tenant.module.log_event('tenant_task_failed', logging.ERROR, **tenant.module.error_fields(e))
+            finally:
+                with self._cond:
+                    if kind == 'delivery':
+                        tenant.sending -= 1
+                    else:
+                        tenant.busy -= 1
+                    if kind == 'task':
+                        self._tasks_running -= 1
+                    tenant.processed += 1
+                    tenant.busy_seconds += time.monotonic() - started
+                    self._cond.notify_all()
+
+
+class TenantTimer:
+    """Одна куча отложенных фоновых задач на все города вместо своих потоков у каждого.
+
+    Задача снова встаёт в кучу через свой интервал после завершения, как в
+    циклах с clock.sleep в telebot3; задача может вернуть другую паузу.
+    Короткие задачи (inline) выполняются прямо в потоке таймера.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def every(self, tenant, interval, fn, first=0.0, inline=False):
+        self._push(time.monotonic() + first, (tenant, interval, fn, inline))
+
+    def _push(self, when, job):
+        with self._cond:
+            heapq.heappush(self._heap, (when, next(self._seq), job))
+            self._cond.notify()
+
+    def _fire(self, job):
+        tenant, interval, fn, _ = job
+        delay = None
+        try:
+            delay = fn()
+        except Exception as e:
+            tenant.module.log_event('tenant_job_failed', logging.ERROR, **tenant.module.error_fields(e))
+        self._push(time.monotonic() + (interval if delay is None else delay), job)
+
+    def start(self):
+        threading.Thread(target=self._run, name="tenant-timer", daemon=True).start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, job = heapq.heappop(self._heap)
+            if job[3]:
+                self._fire(job)
+            else:
+                self.pool.submit(job[0], lambda job=job: self._fire(job))
+
+
+def schedule_background(timer, tenant):
+    """Фоновые циклы telebot3 (аренда, планировщик, финализатор, копии) — задачами общей кучи."""
+    module = tenant.module
+    lease = module.leader_lease
+
+    def heartbeat():
+        try:
+            lease.heartbeat()
+        except Exception as e:
+            module.log_event('lease_error', logging.ERROR, holder=lease.holder, **module.error_fields(e))
+
+    def tick():
+        if not lease.is_leader():
+            tenant.since = None
+            return module.LEADER_HEARTBEAT
+        tenant.since = module.background_tick(tenant.since)
+
+    def finalize():
+        if not lease.is_leader() or module.broadcasts_paused.is_set():
+            return None
+        # Пока есть что снимать, следующая пачка идёт сразу
+        return 0 if module.card_finalizer.run_batch() else None
+
+    def backup():
+        wait = module.backup_due_in()
+        if wait:
+            return wait
+        if not lease.is_leader():
+            return module.LEADER_HEARTBEAT
+        module.make_backup()
+
+    def metrics():
+        module.log_event('tenant_metrics', **tenant.stats())
+
+    timer.every(tenant, module.LEADER_HEARTBEAT, heartbeat, inline=True)
+    timer.every(tenant, module.REMINDER_CHECK_INTERVAL, tick, first=module.LEADER_HEARTBEAT)
+    timer.every(tenant, module.REMINDER_CHECK_INTERVAL, finalize, first=module.LEADER_HEARTBEAT)
+    timer.every(tenant, module.BACKUP_INTERVAL, backup, first=module.LEADER_HEARTBEAT)
+    timer.every(tenant, TENANT_METRICS_INTERVAL, metrics, first=TENANT_METRICS_INTERVAL)
+
+
+def build_runtime(config, log_stream=None):
+    """Загружает города и связывает их с общими пулами; возвращает (города, пул, таймер)."""
+    entries = config['tenants']
+    names = [entry['name'] for entry in entries]
+    if len(set(names)) != len(names):
+        raise ValueError("❌ Имена городов в конфигурации повторяются")
+    saved = {key: os.environ.get(key) for key in ('BOT_TOKEN', 'TENANT')}
+    try:
+        tenants = [Tenant(entry['name'], load_tenant(entry)) for entry in entries]
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+    first = tenants[0].module
+    if first.SHARDS > 1:
+        raise ValueError("❌ SHARDS > 1 несовместимо с tenants.py: города делят один процесс")
+    # Логгер walkbot общий: обработчики ставит первая копия, остальные видят её очередь
+    first.setup_logging(log_stream)
+    transport = first.make_transport(config.get('pool_size') or first.API_POOL_SIZE * len(tenants))
+    for tenant in tenants:
+        module = tenant.module
+        module._log_listener = first._log_listener
+        module.api_transport = transport
+        module.tenant_stats = tenant.stats
+        module.prepare_storage()
+        # Обработчики выполняет общий пул, а не потоки TeleBot
+        module.bot.threaded = False
+        module.bot.worker_pool.close()
+        module.bot.process_new_updates = module.update_dispatcher.submit
+    first.apihelper.CUSTOM_REQUEST_SENDER = TokenRouter(tenants).request
+    pool = TenantPool(tenants, config.get('workers', first.INGEST_WORKERS * 2), config.get('max_share', 0.5))
+    timer = TenantTimer(pool)
+    for tenant in tenants:
+        schedule_background(timer, tenant)
+    return tenants, pool, timer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('config', help='JSON с городами и размерами общих пулов')
+    args = parser.parse_args()
+    with open(args.config, encoding='utf-8') as f:
+        config = json.load(f)
+    tenants, pool, timer = build_runtime(config)
+    pool.start()
+    timer.start()
+    for tenant in tenants:
+        module = tenant.module
+        atexit.register(module.leader_lease.release)
+        threading.Thread(
+            target=module.bot.infinity_polling, name=f"poll-{tenant.name}", daemon=True,
+            kwargs={'timeout': 10, 'long_polling_timeout': 5, 'skip_pending': True},
+        ).start()
+    print(f"✅ Городов: {len(tenants)} ({', '.join(t.name for t in tenants)}); "
+          f"общий пул {pool.workers} потоков, не больше {pool.cap} на город")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+# Модуль бота читает токен при импорте; сети тесты не касаются
+os.environ.setdefault('BOT_TOKEN', '0:test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telebot3  # noqa: E402
+
+
+@pytest.fixture
+def bot_module(tmp_path, monkeypatch):
+    """telebot3 с пустой базой во временном каталоге."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(telebot3, 'DB_PATH', str(tmp_path / 'walk.db'))
+    telebot3.init_db()
+    telebot3.migrate_db()
+    return telebot3
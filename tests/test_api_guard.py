@@ -0,0 +1,107 @@
+import time
+
+import pytest
+import requests
+
+import telebot3
+from telebot3 import ApiGuard, ApiOverloadedError
+
+URL = 'https://api.telegram.org/bot0:test/'
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self._body = body or {}
+
+    def json(self):
+        return self._body
+
+
+def make_guard(monkeypatch, outcomes, **kwargs):
+    """ApiGuard, у которого каждый вызов отдаёт следующий ответ из outcomes (исключение — бросает)."""
+    kwargs.setdefault('target_latency', 5)
+    guard = ApiGuard(**kwargs)
+    outcomes = iter(outcomes)
+
+    def send(method, url, **_):
+        outcome = next(outcomes)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(guard, 'send', send)
+    monkeypatch.setattr(telebot3, 'log_event', lambda *args, **kwargs: None)
+    return guard
+
+
+def test_success_grows_limit_additively(monkeypatch):
+    guard = make_guard(monkeypatch, [FakeResponse(200)], max_concurrency=16)
+    assert guard.limit == 8
+    guard.request('post', URL + 'sendMessage')
+    assert guard.limit == pytest.approx(8 + 1 / 8)
+    assert guard.state == ApiGuard.CLOSED
+
+
+def test_server_error_halves_limit(monkeypatch):
+    guard = make_guard(monkeypatch, [FakeResponse(502)], max_concurrency=16)
+    guard.request('post', URL + 'sendMessage')
+    assert guard.limit == 4
+    assert guard.counters['errors'] == 1
+
+
+def test_failures_open_circuit_and_shed_edits(monkeypatch):
+    guard = make_guard(monkeypatch, [requests.ConnectionError()] * 3, failure_threshold=3, cooldown=60)
+    for _ in range(3):
+        with pytest.raises(requests.ConnectionError):
+            guard.request('post', URL + 'sendMessage')
+    assert guard.state == ApiGuard.OPEN
+    with pytest.raises(ApiOverloadedError):
+        guard.request('post', URL + 'editMessageText')
+    assert guard.counters['shed'] == 1
+
+
+def test_retry_after_opens_circuit_at_once(monkeypatch):
+    guard = make_guard(monkeypatch, [FakeResponse(429, {'parameters': {'retry_after': 30}})])
+    guard.request('post', URL + 'sendMessage')
+    assert guard.state == ApiGuard.OPEN
+    assert guard._opened_until - time.monotonic() > 25
+
+
+def test_successful_probe_closes_circuit(monkeypatch):
+    guard = make_guard(monkeypatch, [requests.Timeout(), FakeResponse(200)], failure_threshold=1, cooldown=0.05)
+    with pytest.raises(requests.Timeout):
+        guard.request('post', URL + 'sendMessage')
+    assert guard.state == ApiGuard.OPEN
+    time.sleep(0.06)
+    guard.request('post', URL + 'sendMessage')
+    assert guard.state == ApiGuard.CLOSED
+
+
+def test_failed_probe_doubles_cooldown(monkeypatch):
+    guard = make_guard(monkeypatch, [requests.Timeout(), FakeResponse(503)], failure_threshold=1, cooldown=0.05)
+    with pytest.raises(requests.Timeout):
+        guard.request('post', URL + 'sendMessage')
+    time.sleep(0.06)
+    guard.request('post', URL + 'sendMessage')
+    assert guard.state == ApiGuard.OPEN
+    assert guard._cooldown == pytest.approx(0.1)
+
+
+def test_unexpected_error_counts_as_failure(monkeypatch):
+    guard = make_guard(monkeypatch, [requests.ConnectionError(), ValueError('bad json')],
+                       failure_threshold=1, cooldown=0.05)
+    with pytest.raises(requests.ConnectionError):
+        guard.request('post', URL + 'sendMessage')
+    time.sleep(0.06)
+    with pytest.raises(ValueError):
+        guard.request('post', URL + 'sendMessage')
+    assert guard.state == ApiGuard.OPEN
+    assert guard.counters['ok'] == 0
+
+
+def test_unguarded_methods_bypass_limiter(monkeypatch):
+    guard = make_guard(monkeypatch, [FakeResponse(502)])
+    guard.request('post', URL + 'getUpdates')
+    assert guard.counters['calls'] == 0
+    assert guard.state == ApiGuard.CLOSED
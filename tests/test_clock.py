@@ -0,0 +1,28 @@
+import threading
+from datetime import datetime, timedelta
+
+from telebot3 import VirtualClock
+
+START = datetime(2030, 1, 1, 12, 0)
+
+
+def test_sleep_waits_for_advance_and_leaves_time_alone():
+    clock = VirtualClock(START)
+    woke = threading.Event()
+    sleeper = threading.Thread(target=lambda: (clock.sleep(60), woke.set()), daemon=True)
+    sleeper.start()
+    assert not woke.wait(0.05)
+    assert clock.now() == START
+    clock.advance(30)
+    assert not woke.wait(0.05)
+    clock.advance(30)
+    assert woke.wait(1)
+    assert clock.now() == START + timedelta(seconds=60)
+
+
+def test_sleepers_do_not_advance_each_other():
+    clock = VirtualClock(START)
+    for _ in range(3):
+        threading.Thread(target=clock.sleep, args=(3600,), daemon=True).start()
+    clock.advance(1)
+    assert clock.now() == START + timedelta(seconds=1)
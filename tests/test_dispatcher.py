@@ -0,0 +1,63 @@
+from telebot import types
+
+from telebot3 import UpdateDispatcher
+
+_ids = iter(range(1, 10_000))
+
+
+def message(user_id, text):
+    update_id = next(_ids)
+    return types.Update.de_json({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': text,
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'u'},
+    }})
+
+
+def callback(user_id, data):
+    update_id = next(_ids)
+    return types.Update.de_json({'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'chat_instance': '1', 'data': data,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'u'},
+    }})
+
+
+def drain(dispatcher):
+    """Выполняет всё по одному, как единственный рабочий поток; возвращает порядок обработки."""
+    order = []
+    while True:
+        item = dispatcher.poll()
+        if item is None:
+            return order
+        order.append(item[2].update_id)
+        dispatcher.execute(item)
+
+
+def test_button_does_not_overtake_earlier_message_of_same_user():
+    dispatcher = UpdateDispatcher(lambda updates: None)
+    first = message(1, "18:30")
+    tap = callback(1, "vote_yes_1")
+    dispatcher.submit([first, tap])
+    assert drain(dispatcher) == [first.update_id, tap.update_id]
+
+
+def test_urgent_update_lifts_the_whole_queue_of_its_user():
+    dispatcher = UpdateDispatcher(lambda updates: None)
+    other = message(2, "Текущие прогулки")
+    first = message(1, "Текущие прогулки")
+    tap = callback(1, "resend_proposal_1")
+    dispatcher.submit([other, first, tap])
+    assert drain(dispatcher) == [first.update_id, tap.update_id, other.update_id]
+
+
+def test_users_with_equal_priority_take_turns():
+    dispatcher = UpdateDispatcher(lambda updates: None)
+    a1, a2, b1 = message(1, "Прогулки"), message(1, "Настройки"), message(2, "Прогулки")
+    dispatcher.submit([a1, a2, b1])
+    first = dispatcher.poll()
+    second = dispatcher.poll()
+    assert (first[2].update_id, second[2].update_id) == (a1.update_id, b1.update_id)
+    assert dispatcher.poll() is None  # a2 ждёт, пока обрабатывается a1
+    dispatcher.execute(first)
+    dispatcher.execute(second)
+    assert drain(dispatcher) == [a2.update_id]
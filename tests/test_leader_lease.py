@@ -0,0 +1,57 @@
+from datetime import datetime
+
+import pytest
+
+START = datetime(2030, 1, 1, 12, 0)
+
+
+@pytest.fixture
+def clock(bot_module, monkeypatch):
+    clock = bot_module.VirtualClock(START)
+    monkeypatch.setattr(bot_module, 'clock', clock)
+    return clock
+
+
+def test_standby_waits_for_expiry_then_takes_over(bot_module, clock):
+    first = bot_module.LeaderLease('scheduler', 'a', ttl=30)
+    second = bot_module.LeaderLease('scheduler', 'b', ttl=30)
+    assert first.heartbeat()
+    assert not second.heartbeat()
+    assert second.leader == 'a'
+
+    clock.advance(20)
+    assert first.heartbeat()  # продление отодвигает срок
+    clock.advance(20)
+    assert not second.heartbeat()
+
+    clock.advance(31)
+    assert not first.is_leader()
+    assert second.heartbeat()
+    assert second.term == first.term + 1
+    assert not first.heartbeat()
+    assert first.leader == 'b'
+
+
+def test_takeover_closes_interrupted_claims(bot_module, clock):
+    first = bot_module.LeaderLease('scheduler', 'a', ttl=30)
+    second = bot_module.LeaderLease('scheduler', 'b', ttl=30)
+    assert first.heartbeat()
+    proposal_id = bot_module.add_proposal(1, 'a', '12:00', datetime(2030, 1, 2, 12, 0), 'Парк')
+    with bot_module.db_connect() as conn:
+        conn.execute("UPDATE proposals SET processed = 2 WHERE id = ?", (proposal_id,))
+
+    clock.advance(31)
+    assert second.heartbeat()
+    with bot_module.db_connect() as conn:
+        processed, = conn.execute("SELECT processed FROM proposals WHERE id = ?", (proposal_id,)).fetchone()
+    assert processed == 1
+
+
+def test_release_hands_over_without_waiting(bot_module, clock):
+    first = bot_module.LeaderLease('scheduler', 'a', ttl=30)
+    second = bot_module.LeaderLease('scheduler', 'b', ttl=30)
+    assert first.heartbeat()
+    first.release()
+    assert not first.is_leader()
+    assert second.heartbeat()
+    assert second.term == first.term + 1
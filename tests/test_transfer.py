@@ -0,0 +1,65 @@
+import os
+from datetime import datetime
+
+import pytest
+
+TABLES = ('users', 'proposals', 'votes', 'comments')
+
+
+def dump(module, tables=TABLES):
+    with module.db_connect() as conn:
+        return {table: conn.execute(f"SELECT * FROM {table} ORDER BY rowid").fetchall() for table in tables}
+
+
+@pytest.fixture
+def source(bot_module):
+    with bot_module.db_connect() as conn:
+        conn.executemany("INSERT INTO users (user_id, first_name, username) VALUES (?, ?, ?)", [
+            (1, 'Аня', None),
+            (2, '', ''),
+            (3, r'\N', r'\x'),
+            (4, 'Боря, "Б."', 'line\nbreak'),
+        ])
+    walk = datetime(2030, 5, 1, 18, 30)
+    first = bot_module.add_proposal(1, 'Аня', '18:30', walk, 'Парк', '', coords=(55.75, 37.62))
+    second = bot_module.add_proposal(2, '', '19:00', walk.replace(hour=19), r'\N')
+    bot_module.add_vote(first, 2, '', 'yes')
+    bot_module.add_vote(second, 3, r'\N', 'no')
+    bot_module.save_comment(first, 3, r'\N', r'\\')
+    return bot_module
+
+
+@pytest.mark.parametrize('fmt, compress', [('ndjson', False), ('ndjson', True), ('csv', False), ('csv', True)])
+def test_export_import_round_trip(source, tmp_path, monkeypatch, fmt, compress):
+    expected = dump(source)
+    path = str(tmp_path / ('out.ndjson' if fmt == 'ndjson' else 'out'))
+    source.export_data(path, fmt, compress)
+    if fmt == 'ndjson' and compress:
+        path += '.gz'
+    monkeypatch.setattr(source, 'DB_PATH', str(tmp_path / 'copy.db'))
+    source.import_data(path, fmt)
+    assert dump(source) == expected
+
+
+def test_import_into_non_empty_database_shifts_ids(source, tmp_path):
+    path = str(tmp_path / 'out.ndjson')
+    source.export_data(path)
+    # Запись в базу была только что, а бот при этом не запущен: журнал WAL «старим»
+    os.utime(source.DB_PATH + '-wal', (0, 0))
+    source.import_data(path)
+    with source.db_connect() as conn:
+        ids = [row[0] for row in conn.execute("SELECT id FROM proposals ORDER BY id")]
+        votes = conn.execute("SELECT proposal_id, voter_id FROM votes ORDER BY proposal_id").fetchall()
+    assert ids == [1, 2, 3, 4]
+    assert votes == [(1, 2), (2, 3), (3, 2), (4, 3)]
+
+
+def test_import_refuses_while_lease_is_held(source, tmp_path):
+    path = str(tmp_path / 'out.ndjson')
+    source.export_data(path)
+    source.leader_lease.heartbeat()
+    try:
+        with pytest.raises(RuntimeError):
+            source.import_data(path)
+    finally:
+        source.leader_lease.release()